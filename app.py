@@ -17,41 +17,40 @@
 
 import argparse
 import asyncio
-import base64
+import copy
 import json
 import random
 # import gevent
 # from gevent import pywsgi
 # from geventwebsocket.handler import WebSocketHandler
-import re
-import shutil
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event, Thread
-from typing import Dict
+from typing import TYPE_CHECKING, Dict
 
 import aiohttp
 import aiohttp_cors
-import numpy as np
-import torch
-# import multiprocessing
-import torch.multiprocessing as mp
 from aiohttp import web
-from aiortc import RTCPeerConnection, RTCSessionDescription
-from aiortc.rtcrtpsender import RTCRtpSender
 # server.py
-from flask import Flask, jsonify, render_template, request, send_from_directory
-from flask_sockets import Sockets
-
-from basereal import BaseReal
-from llm import llm_response, ragflow_response
+import metrics
 from logger import logger
-from webrtc import HumanPlayer
+from sessionpool import SessionPool
+
+# 启动时只导入http服务需要的模块；模型、aiortc和llm相关模块较慢，在用到时才导入。
+# 各模块的导入耗时可以用 python importtime.py 查看
+if TYPE_CHECKING:
+    from basereal import BaseReal
+    from webrtc import HumanPlayer
 
-app = Flask(__name__)
-# sockets = Sockets(app)
-nerfreals: Dict[int, BaseReal] = {}  # sessionid:BaseReal
+nerfreals: Dict[int, "BaseReal"] = {}  # sessionid:BaseReal
+players: Dict[int, "HumanPlayer"] = {}  # sessionid:HumanPlayer, 用于/metrics读取track队列
 opt = None
 model = None
 avatar = None
+session_pool = None
+# 会话构造、LLM回复这类可能持续几秒的阻塞调用用单独的线程池，
+# 默认executor留给aiortc的音视频编码，不被它们占满
+blocking_executor = ThreadPoolExecutor(thread_name_prefix="blocking")
 
 
 #####webrtc###############################
@@ -65,29 +64,52 @@ def randN(N) -> int:
     return random.randint(min, max - 1)
 
 
-def build_nerfreal(sessionid: int) -> BaseReal:
-    opt.sessionid = sessionid
+def new_sessionid() -> int:
+    # router.py启动的多个worker各用一个余数类(id % stride == base)，id不会重复
+    while True:
+        sessionid = randN(6)
+        sessionid -= (sessionid - opt.session_id_base) % opt.session_id_stride
+        if sessionid not in nerfreals:
+            return sessionid
+
+
+def build_nerfreal(sessionid: int) -> "BaseReal":
+    # 每个会话用自己的opt副本传sessionid，/offer现场构造和会话池后台补充可以同时进行
+    sessopt = copy.copy(opt)
+    sessopt.sessionid = sessionid
     if opt.model == "wav2lip":
         from lipreal import LipReal
 
-        nerfreal = LipReal(opt, model, avatar)
+        nerfreal = LipReal(sessopt, model, avatar)
     elif opt.model == "musetalk":
         from musereal import MuseReal
 
-        nerfreal = MuseReal(opt, model, avatar)
+        nerfreal = MuseReal(sessopt, model, avatar)
     elif opt.model == "ernerf":
         from nerfreal import NeRFReal
 
-        nerfreal = NeRFReal(opt, model, avatar)
+        nerfreal = NeRFReal(sessopt, model, avatar)
     elif opt.model == "ultralight":
         from lightreal import LightReal
 
-        nerfreal = LightReal(opt, model, avatar)
+        nerfreal = LightReal(sessopt, model, avatar)
     return nerfreal
 
 
+def close_session(sessionid):
+    # failed时pc.close()还会再触发一次closed，这里要能重复调用
+    nerfreal = nerfreals.pop(sessionid, None)
+    players.pop(sessionid, None)
+    if nerfreal is not None:
+        nerfreal.close_session()
+
+
 # @app.route('/offer', methods=['POST'])
 async def offer(request):
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.rtcrtpsender import RTCRtpSender
+    from webrtc import HumanPlayer
+
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
@@ -98,13 +120,21 @@ async def offer(request):
             text=json.dumps({"code": -1, "msg": "已达到最大会话数限制"}),
             status=429,  # Too Many Requests
         )
-    sessionid = randN(6)  # len(nerfreals)
-    logger.info("sessionid=%d", sessionid)
-    nerfreals[sessionid] = None
-    nerfreal = await asyncio.get_event_loop().run_in_executor(
-        None, build_nerfreal, sessionid
-    )
-    nerfreals[sessionid] = nerfreal
+    warm = session_pool.take()
+    if warm is not None:
+        sessionid, nerfreal = warm
+        logger.info("sessionid=%d (warm pool)", sessionid)
+        nerfreals[sessionid] = nerfreal
+        session_pool.release_id(sessionid)
+    else:
+        sessionid = session_pool.reserve_id()
+        logger.info("sessionid=%d", sessionid)
+        nerfreals[sessionid] = None
+        session_pool.release_id(sessionid)
+        nerfreal = await asyncio.get_event_loop().run_in_executor(
+            blocking_executor, session_pool.build, sessionid
+        )
+        nerfreals[sessionid] = nerfreal
 
     pc = RTCPeerConnection()
     pcs.add(pc)
@@ -115,12 +145,13 @@ async def offer(request):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_session(sessionid)
         if pc.connectionState == "closed":
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_session(sessionid)
 
     player = HumanPlayer(nerfreals[sessionid])
+    players[sessionid] = player
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
     capabilities = RTCRtpSender.getCapabilities("video")
@@ -134,6 +165,7 @@ async def offer(request):
 
     answer = await pc.createAnswer()
     await pc.setLocalDescription(answer)
+    set_video_codec(nerfreal, player, transceiver, video_sender)
 
     # return jsonify({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type})
 
@@ -149,6 +181,17 @@ async def offer(request):
     )
 
 
+def set_video_codec(nerfreal, player, transceiver, video_sender):
+    # 协商出的视频编码，静音时据此选择预编码的idle包
+    # _codecs是aiortc的私有属性(requirements.txt里固定了版本)，取不到时不发预编码包
+    codecs = getattr(transceiver, "_codecs", None)
+    if codecs is None:
+        logger.warning("aiortc transceiver has no _codecs, idle packets disabled")
+    elif codecs:
+        nerfreal.video_codec = codecs[0].name
+    player.video.sender = video_sender
+
+
 async def human(request):
     params = await request.json()
 
@@ -166,8 +209,10 @@ async def human(request):
         #                                                   opt.llm_model,
         #                                                   opt.llm_url)
 
+        from llm import ragflow_response
+
         res = await asyncio.get_event_loop().run_in_executor(
-            None,
+            blocking_executor,
             ragflow_response,
             params["text"],
             nerfreals[sessionid],
@@ -274,7 +319,67 @@ async def is_speaking(request):
 #         )
 
 
+def _session_metrics():
+    return [(("active",), len(nerfreals)), (("max",), opt.max_session)]
+
+
+def _queue_metrics():
+    for sessionid, nerfreal in list(nerfreals.items()):
+        if nerfreal is None:  # 正在创建
+            continue
+        queues = [
+            ("asr.queue", nerfreal.asr.queue),
+            ("output_queue", nerfreal.asr.output_queue),
+            ("feat_queue", nerfreal.asr.feat_queue),  # ernerf里是特征张量，没有qsize
+            ("res_frame_queue", getattr(nerfreal, "res_frame_queue", None)),
+        ]
+        player = players.get(sessionid)
+        if player is not None:
+            queues.append(("audio_track", player.audio._queue))
+            queues.append(("video_track", player.video._queue))
+        for name, q in queues:
+            size = metrics.qsize(q)
+            if size is not None:
+                yield (sessionid, name), size
+
+
+metrics.GaugeCallback(
+    "livetalking_sessions", "active sessions and --max_session", ["state"], _session_metrics
+)
+metrics.GaugeCallback(
+    "livetalking_queue_depth", "items waiting in each per-session queue", ["sessionid", "queue"], _queue_metrics
+)
+
+
+async def health(request):
+    # router.py据此做最少负载分配和会话id->worker映射的清理
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {
+                "sessions": [k for k, v in nerfreals.items() if v is not None],
+                "active": len(nerfreals),
+                "max_session": opt.max_session,
+            }
+        ),
+    )
+
+
+async def metrics_handler(request):
+    return web.Response(
+        body=metrics.generate_latest().encode("utf-8"),
+        headers={"Content-Type": metrics.CONTENT_TYPE},
+    )
+
+
+async def on_startup(app):
+    app["loop_lag"] = asyncio.ensure_future(
+        metrics.watch_event_loop(metrics.EVENT_LOOP_LAG_SECONDS)
+    )
+
+
 async def on_shutdown(app):
+    app["loop_lag"].cancel()
     # close peer connections
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
@@ -291,8 +396,11 @@ async def post(url, data):
 
 
 async def run(push_url, sessionid):
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from webrtc import HumanPlayer
+
     nerfreal = await asyncio.get_event_loop().run_in_executor(
-        None, build_nerfreal, sessionid
+        blocking_executor, session_pool.build, sessionid
     )
     nerfreals[sessionid] = nerfreal
 
@@ -307,12 +415,14 @@ async def run(push_url, sessionid):
             pcs.discard(pc)
 
     player = HumanPlayer(nerfreals[sessionid])
+    players[sessionid] = player
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
 
     await pc.setLocalDescription(await pc.createOffer())
     answer = await post(push_url, pc.localDescription.sdp)
     await pc.setRemoteDescription(RTCSessionDescription(sdp=answer, type="answer"))
+    set_video_codec(nerfreal, player, pc.getTransceivers()[1], video_sender)
 
 
 ##########################################
@@ -438,6 +548,17 @@ if __name__ == "__main__":
         default=0,
         help="0 means load data from disk on-the-fly, 1 means preload to CPU, 2 means GPU.",
     )
+    parser.add_argument(
+        "--rays_cache",
+        action="store_true",
+        help="ernerf: compute ray directions once and memory-map fp16 torso/bg composites from a cache next to --pose",
+    )
+    parser.add_argument(
+        "--nerf_batch",
+        type=int,
+        default=1,
+        help="ernerf: frames rendered per model.render call, >1 trades latency for throughput",
+    )
     # (the default value is for the fox dataset)
     parser.add_argument(
         "--bound",
@@ -607,12 +728,44 @@ if __name__ == "__main__":
     parser.add_argument("--avatar_id", type=str, default="avator_1")
     parser.add_argument("--bbox_shift", type=int, default=5)
     parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        help="wav2lip/ultralight inference backend: torch, onnx (onnxruntime cpu, export with onnxbackend.py) "
+        "or int8 (quantized onnx, build with quantize.py)",
+    )
+    parser.add_argument(
+        "--compile",
+        type=str,
+        default="none",
+        help="none, trace (TorchScript, cached in models/compiled) or compile (torch.compile), falls back to eager on failure",
+    )
+    parser.add_argument(
+        "--compile_buckets",
+        type=int,
+        nargs="*",
+        default=None,
+        help="batch sizes compiled at warmup, default powers of two up to batch_size",
+    )
 
     # parser.add_argument('--customvideo', action='store_true', help="custom video")
     # parser.add_argument('--customvideo_img', type=str, default='data/customvideo/img')
     # parser.add_argument('--customvideo_imgnum', type=int, default=1)
 
     parser.add_argument("--customvideo_config", type=str, default="")
+    parser.add_argument(
+        "--customvideo_cache",
+        type=str,
+        default="raw",
+        help="raw: keep decoded custom video frames in RAM; encoded: keep jpg/png bytes, decode on demand",
+    )
+    parser.add_argument(
+        "--idle_packets",
+        type=int,
+        default=1,
+        help="webrtc sends pre-encoded packets for the idle loop, 0 to disable",
+    )
 
     parser.add_argument(
         "--tts", type=str, default="edgetts"
@@ -637,7 +790,20 @@ if __name__ == "__main__":
     )  # rtmp://localhost/live/livestream
 
     parser.add_argument("--max_session", type=int, default=1)  # multi session count
+    parser.add_argument(
+        "--session_pool",
+        type=int,
+        default=0,
+        help="number of pre-built idle sessions kept warm for /offer, counted against --max_session; 0 builds on each /offer",
+    )
     parser.add_argument("--listenport", type=int, default=8010)
+    parser.add_argument(
+        "--session_id_base",
+        type=int,
+        default=0,
+        help="session ids satisfy id %% session_id_stride == session_id_base, set by router.py per worker",
+    )
+    parser.add_argument("--session_id_stride", type=int, default=1)
 
     # 添加Ollama相关参数
     parser.add_argument(
@@ -686,7 +852,7 @@ if __name__ == "__main__":
         logger.info(opt)
         model = load_model()
         avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size, model)
+        warm_up(opt.batch_size, model, opt.compile, opt.compile_buckets)
         # for k in range(opt.max_session):
         #     opt.sessionid=k
         #     nerfreal = MuseReal(opt,audio_processor,vae, unet, pe,timesteps)
@@ -695,9 +861,9 @@ if __name__ == "__main__":
         from lipreal import LipReal, load_avatar, load_model, warm_up
 
         logger.info(opt)
-        model = load_model("./models/wav2lip.pth")
+        model = load_model("./models/wav2lip.pth", opt.backend)
         avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size, model, 256)
+        model = warm_up(opt.batch_size, model, 256, opt.compile, opt.compile_buckets)
         # for k in range(opt.max_session):
         #     opt.sessionid=k
         #     nerfreal = LipReal(opt,model)
@@ -707,8 +873,16 @@ if __name__ == "__main__":
 
         logger.info(opt)
         model = load_model(opt)
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size, avatar, 160)
+        avatar = load_avatar(opt.avatar_id, opt.backend)
+        avatar = warm_up(opt.batch_size, avatar, 160, opt.compile, opt.compile_buckets)
+
+    session_pool = SessionPool(
+        build_nerfreal,
+        new_sessionid,
+        opt.session_pool if opt.transport == "webrtc" else 0,
+        lambda: opt.max_session - len(nerfreals),
+    )
+    session_pool.start()
 
     if opt.transport == "rtmp":
         thread_quit = Event()
@@ -718,6 +892,7 @@ if __name__ == "__main__":
 
     #############################################################################
     appasync = web.Application()
+    appasync.on_startup.append(on_startup)
     appasync.on_shutdown.append(on_shutdown)
     appasync.router.add_post("/offer", offer)
     appasync.router.add_post("/human", human)
@@ -725,6 +900,8 @@ if __name__ == "__main__":
     appasync.router.add_post("/set_audiotype", set_audiotype)
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_get("/metrics", metrics_handler)
+    appasync.router.add_get("/health", health)
     # appasync.router.add_post("/close_session", close_session)
     appasync.router.add_static("/", path="web")
 
@@ -0,0 +1,111 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# asr输出的20ms音频帧存放在一块连续内存里：float32 pcm [2*capacity, chunk]，
+# 每帧的type和eventpoint编号存在并行的小数组里。每帧写两遍(slot和slot+capacity)，
+# 任意不超过capacity的连续帧都是一段连续内存，asr取特征窗口时直接切片，不再np.concatenate。
+# 推理侧按批read()，整批一次转成int16，不再每帧一个ndarray和tuple。
+
+from threading import Condition
+
+import numpy as np
+
+
+class AudioBatch:
+    """read()取出的一批音频帧：pcm为int16 [n, chunk]，types为int8 [n]，eventpoints为{帧下标: eventpoint}"""
+    __slots__ = ('pcm', 'types', 'eventpoints')
+
+    def __init__(self, pcm, types, eventpoints):
+        self.pcm = pcm
+        self.types = types
+        self.eventpoints = eventpoints
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        for i in range(len(self.types)):
+            yield self.pcm[i], int(self.types[i]), self.eventpoints.get(i)
+
+    def part(self, start, count):
+        """第start帧起的count帧，pcm和types是视图"""
+        eventpoints = {i - start: e for i, e in self.eventpoints.items() if start <= i < start + count}
+        return AudioBatch(self.pcm[start:start + count], self.types[start:start + count], eventpoints)
+
+    def is_silent(self):
+        """全部不是说话帧(静音或自定义音频)"""
+        return bool(self.types.all())
+
+
+class AudioRing:
+    """单写单读。write()和window()在asr线程里调用，read()在推理线程里调用。
+    未读的帧超过capacity时write()阻塞，capacity要大于读端最多积压的帧数加上asr窗口"""
+
+    def __init__(self, capacity, chunk):
+        self.capacity = capacity
+        self.chunk = chunk
+        self.pcm = np.zeros((2 * capacity, chunk), dtype=np.float32)
+        self.types = np.zeros(2 * capacity, dtype=np.int8)
+        self.events = np.full(2 * capacity, -1, dtype=np.int32)
+        self.eventpoints = {}  # eventpoint编号 -> eventpoint，一般只有句首句尾几帧有
+        self._next_event = 0
+        self.written = 0  # 累计写入的帧数
+        self.consumed = 0  # 累计读走的帧数
+        self._cond = Condition()
+
+    def write(self, frame, type, eventpoint=None):
+        with self._cond:
+            while self.written - self.consumed >= self.capacity:
+                self._cond.wait()
+        slot = self.written % self.capacity
+        event = -1
+        if eventpoint is not None:
+            event = self._next_event
+            self._next_event += 1
+            self.eventpoints[event] = eventpoint
+        for s in (slot, slot + self.capacity):
+            self.pcm[s] = frame
+            self.types[s] = type
+            self.events[s] = event
+        with self._cond:
+            self.written += 1
+            self._cond.notify_all()
+
+    def window(self, count):
+        """最近写入的count帧，[count * chunk]的零拷贝视图。还没写满时前面是0"""
+        start = (self.written - count) % self.capacity
+        return self.pcm[start:start + count].reshape(-1)
+
+    def read(self, count, timeout=None):
+        """取走最早的count帧，返回AudioBatch；超时返回None"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.written - self.consumed >= count, timeout):
+                return None
+        start = self.consumed % self.capacity
+        pcm = (self.pcm[start:start + count] * 32767).astype(np.int16)
+        types = self.types[start:start + count].copy()
+        eventpoints = {}
+        events = self.events[start:start + count]
+        for i in np.flatnonzero(events >= 0):
+            eventpoints[int(i)] = self.eventpoints.pop(int(events[i]))
+        with self._cond:
+            self.consumed += count
+            self._cond.notify_all()
+        return AudioBatch(pcm, types, eventpoints)
+
+    def qsize(self):
+        return self.written - self.consumed
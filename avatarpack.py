@@ -0,0 +1,118 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# wav2lip avatar的打包格式，由wav2lip/genavatar.py生成，avatar目录下：
+#   avatar.json        {"frames": N, "img_size": S, "full_ext": ".png"}，生成完成后才写入
+#   face_imgs.u8       uint8 [N, S, S, 3]的原始字节，np.memmap直接映射
+#   full_imgs.bin      每帧原图编码(png/jpg)后的字节依次拼接
+#   full_imgs.offsets  int64 [N+1]，第i帧为full_imgs.bin[offsets[i]:offsets[i+1]]
+#   coords.pkl         每帧人脸框(y1, y2, x1, x2)，和目录格式相同
+# 没有avatar.json时仍按full_imgs/、face_imgs/目录读取。
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+META_FILE = 'avatar.json'
+FACE_FILE = 'face_imgs.u8'
+FULL_FILE = 'full_imgs.bin'
+OFFSETS_FILE = 'full_imgs.offsets'
+
+
+def is_packed(avatar_path):
+    return os.path.exists(os.path.join(avatar_path, META_FILE))
+
+
+def read_meta(avatar_path):
+    with open(os.path.join(avatar_path, META_FILE)) as f:
+        return json.load(f)
+
+
+def load_faces(avatar_path):
+    """[N, S, S, 3]只读memmap"""
+    meta = read_meta(avatar_path)
+    size = meta['img_size']
+    return np.memmap(os.path.join(avatar_path, FACE_FILE), dtype=np.uint8, mode='r',
+                     shape=(meta['frames'], size, size, 3))
+
+
+def full_frame_bytes(avatar_path):
+    """每帧原图的编码字节，memmap上的切片，不读入内存"""
+    offsets = np.fromfile(os.path.join(avatar_path, OFFSETS_FILE), dtype=np.int64)
+    data = np.memmap(os.path.join(avatar_path, FULL_FILE), dtype=np.uint8, mode='r')
+    return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def read_full_imgs(avatar_path):
+    # imdecode会释放GIL，用线程池并行解码
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+        return list(pool.map(lambda data: cv2.imdecode(data, cv2.IMREAD_COLOR), full_frame_bytes(avatar_path)))
+
+
+class PackWriter:
+    """按帧序追加写入。truncate(frames)回到某个检查点，用于中断后继续"""
+
+    def __init__(self, avatar_path, img_size, full_ext):
+        self.avatar_path = avatar_path
+        self.img_size = img_size
+        self.full_ext = full_ext
+        self.frames = 0
+        self.full_bytes = 0
+        self._face = open(os.path.join(avatar_path, FACE_FILE), 'ab')
+        self._full = open(os.path.join(avatar_path, FULL_FILE), 'ab')
+        self._offsets = open(os.path.join(avatar_path, OFFSETS_FILE), 'ab')
+
+    def truncate(self, frames):
+        """只保留前frames帧"""
+        offsets = np.fromfile(os.path.join(self.avatar_path, OFFSETS_FILE), dtype=np.int64, count=frames + 1)
+        self.full_bytes = int(offsets[frames])
+        self._face.truncate(frames * self.img_size * self.img_size * 3)
+        self._full.truncate(self.full_bytes)
+        self._offsets.truncate((frames + 1) * 8)
+        self.frames = frames
+
+    def reset(self):
+        self._face.truncate(0)
+        self._full.truncate(0)
+        self._offsets.truncate(0)
+        self._offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+        self.frames = 0
+        self.full_bytes = 0
+
+    def append(self, face, full):
+        """face: uint8 [S, S, 3]; full: 编码后的原图字节"""
+        self._face.write(np.ascontiguousarray(face).tobytes())
+        self._full.write(full)
+        self.full_bytes += len(full)
+        self._offsets.write(np.int64(self.full_bytes).tobytes())
+        self.frames += 1
+
+    def flush(self):
+        for f in (self._face, self._full, self._offsets):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        self.flush()
+        for f in (self._face, self._full, self._offsets):
+            f.close()
+        meta = {'frames': self.frames, 'img_size': self.img_size, 'full_ext': self.full_ext}
+        with open(os.path.join(self.avatar_path, META_FILE), 'w') as f:
+            json.dump(meta, f)
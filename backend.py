@@ -0,0 +1,231 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 后端api客户端。请求在独立线程的事件循环里用复用连接的aiohttp发出，带超时和指数退避重试，
+# 调用方(会话构造、/record)不等待结果。
+# 会话先用本地的临时id，后端返回session_id后通过回调替换。
+# 通知类请求(如录像完成)先追加写入磁盘上的outbox，发送成功后写一条ack，
+# 进程重启后重发没有ack的记录。全部送达或ack攒多了之后重写文件，
+# 只保留没送达的记录和它们还需要的会话id映射。
+
+import asyncio
+import json
+import os
+import uuid
+from threading import Lock, Thread
+
+import aiohttp
+
+from logger import logger
+
+BACKEND_API = "http://localhost:8888"  # 后端API地址
+OUTBOX_PATH = './data/backend_outbox.jsonl'
+COMPACT_ACKS = 100  # 攒够这么多ack就重写outbox
+
+
+class BackendError(Exception):
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+
+class BackendClient:
+    def __init__(self, api=BACKEND_API, outbox_path=OUTBOX_PATH, timeout=5.0, retries=3):
+        self.api = api
+        self.outbox_path = outbox_path
+        self.timeout = timeout
+        self.retries = retries
+        self.session = None
+        self.outbox_lock = Lock()  # 保护outbox文件和下面几项
+        self.sessions = {}  # 还在创建的会话 临时会话id -> concurrent Future(后端会话id)
+        self.pending = {}  # outbox里还没送达的记录 id -> record
+        self.backend_ids = {}  # 临时会话id -> 后端会话id
+        self.closed = set()  # 已经结束、等记录送达后再丢掉映射的会话
+        self.acks = 0  # 上次重写后写入的ack数
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True, name='backend-client').start()
+        self._replay()
+
+    async def _post(self, path, token, payload=None):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                 connector=aiohttp.TCPConnector(limit=8))
+        delay = 0.5
+        for attempt in range(self.retries):
+            try:
+                async with self.session.post(self.api + path, json=payload,
+                                             headers={"Authorization": f"Bearer {token}"}) as response:
+                    if response.status == 200:
+                        try:
+                            return await response.json(content_type=None)
+                        except ValueError:  # 通知类接口可能返回空body或纯文本
+                            return None
+                    text = await response.text()
+                    if response.status < 500:  # 4xx重试也不会成功
+                        raise BackendError(f'{path}: {response.status} {text}', response.status)
+                    logger.warning(f'{path}: {response.status} {text}, attempt {attempt+1}/{self.retries}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f'{path}: {e!r}, attempt {attempt+1}/{self.retries}')
+            await asyncio.sleep(delay)
+            delay *= 2
+        raise BackendError(f'{path}: no response after {self.retries} attempts')
+
+    def create_session(self, provisional_id, token, on_created):
+        """向后端创建会话，立即返回。成功后在客户端线程里调用on_created(后端会话id)"""
+        with self.outbox_lock:  # _create_session结束时在锁里删掉这一项，不会早于这里的赋值
+            self.sessions[provisional_id] = asyncio.run_coroutine_threadsafe(
+                self._create_session(provisional_id, token, on_created), self.loop)
+
+    async def _create_session(self, provisional_id, token, on_created):
+        try:
+            data = await self._post('/digital-person/create-session', token)
+            sessionid = data["session_id"]
+        except Exception as e:
+            logger.error(f'create session failed, keep provisional id {provisional_id}: {e!r}')
+            with self.outbox_lock:
+                del self.sessions[provisional_id]
+                self.closed.discard(provisional_id)
+            return provisional_id
+        with self.outbox_lock:
+            # 之后由backend_ids提供后端id
+            self.backend_ids[provisional_id] = sessionid
+            self._write({'session': provisional_id, 'backend_id': sessionid})
+            del self.sessions[provisional_id]
+            self._drop_session(provisional_id)
+        on_created(sessionid)
+        return sessionid
+
+    def forget_session(self, provisional_id):
+        """会话结束时调用。映射在会话的通知都送达后丢掉，会话还在创建时等创建完成"""
+        with self.outbox_lock:
+            if provisional_id in self.sessions or provisional_id in self.backend_ids:
+                self.closed.add(provisional_id)
+                self._drop_session(provisional_id)
+
+    def _drop_session(self, provisional_id):
+        # 调用方持有outbox_lock
+        if (provisional_id in self.closed and provisional_id in self.backend_ids
+                and not any(r['session'] == provisional_id for r in self.pending.values())):
+            del self.backend_ids[provisional_id]
+            self.closed.discard(provisional_id)
+
+    def notify(self, path, token, payload, provisional_id=None):
+        """可靠送达的通知，先写outbox再发送。payload里的session_id在发送时换成后端会话id"""
+        record = {'id': uuid.uuid4().hex, 'path': path, 'token': token,
+                  'payload': payload, 'session': provisional_id}
+        with self.outbox_lock:
+            # 后端id已经知道时直接写进记录，重写outbox时就不依赖映射行
+            if provisional_id in self.backend_ids:
+                record['payload']['session_id'] = self.backend_ids[provisional_id]
+                record['session'] = None
+            self.pending[record['id']] = record
+            self._write(record)
+        asyncio.run_coroutine_threadsafe(self._deliver(record), self.loop)
+
+    async def _deliver(self, record):
+        delay = 1.0
+        while True:
+            try:
+                if record['session'] is not None:
+                    future = self.sessions.get(record['session'])
+                    if future is not None:
+                        record['payload']['session_id'] = await asyncio.wrap_future(future)
+                    elif record['session'] in self.backend_ids:  # 记录写入后会话才创建完成
+                        record['payload']['session_id'] = self.backend_ids[record['session']]
+                await self._post(record['path'], record['token'], record['payload'])
+                break
+            except BackendError as e:
+                if e.status is not None:
+                    logger.error(f'backend rejected {record["path"]}, drop: {e}')
+                    break
+                logger.warning(f'{e}, retry in {delay:.0f}s')
+            except Exception:
+                logger.exception(f'deliver {record["path"]} failed, retry in {delay:.0f}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+        with self.outbox_lock:
+            self._write({'ack': record['id']})
+            del self.pending[record['id']]
+            if record['session'] is not None:
+                self._drop_session(record['session'])
+            self.acks += 1
+            if not self.pending or self.acks >= COMPACT_ACKS:
+                self._compact()
+
+    def _write(self, entry):
+        # 调用方持有outbox_lock
+        os.makedirs(os.path.dirname(self.outbox_path), exist_ok=True)
+        with open(self.outbox_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self):
+        """重写outbox，只保留没送达的记录和它们用到的会话id映射。调用方持有outbox_lock"""
+        sessions = {r['session'] for r in self.pending.values() if r['session'] is not None}
+        lines = [{'session': s, 'backend_id': self.backend_ids[s]} for s in sessions if s in self.backend_ids]
+        lines += list(self.pending.values())
+        tmp_path = self.outbox_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in lines:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.outbox_path)
+        self.acks = 0
+
+    def _replay(self):
+        if not os.path.exists(self.outbox_path):
+            return
+        records, acked, backend_ids = {}, set(), {}
+        with open(self.outbox_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # 写到一半时进程退出
+                    continue
+                if 'ack' in entry:
+                    acked.add(entry['ack'])
+                elif 'backend_id' in entry:
+                    backend_ids[entry['session']] = entry['backend_id']
+                else:
+                    records[entry['id']] = entry
+        unsent = [r for id, r in records.items() if id not in acked]
+        for record in unsent:
+            # 上次运行的会话都已经不在了，不能再等它们的后端id
+            if record['session'] in backend_ids:
+                record['payload']['session_id'] = backend_ids[record['session']]
+            record['session'] = None
+        with self.outbox_lock:
+            self.pending = {r['id']: r for r in unsent}
+            self._compact()
+        if unsent:
+            logger.info(f'backend outbox: resend {len(unsent)} notifications')
+        for record in unsent:
+            asyncio.run_coroutine_threadsafe(self._deliver(record), self.loop)
+
+
+_client = None
+_client_lock = Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = BackendClient()
+    return _client
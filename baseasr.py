@@ -20,9 +20,10 @@ import time
 from queue import Queue
 
 import numpy as np
-import torch.multiprocessing as mp
 
+from audioring import AudioRing
 from basereal import BaseReal
+from ringqueue import RingQueue
 
 
 class BaseASR:
@@ -36,15 +37,25 @@ class BaseASR:
             self.sample_rate // self.fps
         )  # 320 samples per chunk (20ms * 16000 / 1000)
         self.queue = Queue()
-        self.output_queue = mp.Queue()
+        # 推理侧每批取走batch_size*2帧，最多积压约4批加上左右stride，ernerf还有warm_up的m帧；
+        # ernerf在同一个线程里先写2*nerf_batch帧再读，容量不够时write会一直阻塞
+        self.output_queue = AudioRing(opt.l + opt.m + opt.r + 8 * opt.batch_size
+                                      + 2 * getattr(opt, 'nerf_batch', 1) + 16, self.chunk)
 
         self.batch_size = opt.batch_size
 
-        self.frames = []
+        # 当前特征窗口(含左右stride)的帧数，窗口就是output_queue里最近写入的这些帧
+        self.window_frames = 0
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
         # self.context_size = 10
-        self.feat_queue = mp.Queue(2)
+        self.feat_queue = RingQueue(2)
+
+        # 静音帧共用一块只读内存，不再每20ms分配一次
+        self.silence = np.zeros(self.chunk, dtype=np.float32)
+        self.silence.setflags(write=False)
+        # 连续非说话帧(静音或自定义音频)的个数，用于判断是否进入空闲模式
+        self.silent_run = 0
 
         # self.warm_up()
 
@@ -65,23 +76,46 @@ class BaseASR:
                 frame = self.parent.get_audio_stream(self.parent.curr_state)
                 type = self.parent.curr_state
             else:
-                frame = np.zeros(self.chunk, dtype=np.float32)
+                frame = self.silence
                 type = 1
             eventpoint = None
 
+        if type == 0:
+            self.silent_run = 0
+        else:
+            self.silent_run += 1
         return frame, type, eventpoint
 
-    # return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
-    def get_audio_out(self):
-        return self.output_queue.get()
+    def is_idle(self):
+        # 整个窗口(含左右stride)都没有说话帧时，推理侧不会用到这批特征，可以跳过特征提取
+        return self.silent_run >= self.window_frames
+
+    def put_idle_feat(self):
+        # 空闲模式下用None代替特征，推理侧据此直接走静音分支
+        self.feat_queue.put(None)
+        self.trim_window()
+
+    def push_frames(self, count):
+        for _ in range(count):
+            frame, type, eventpoint = self.get_audio_frame()
+            self.output_queue.write(frame, type, eventpoint)
+        self.window_frames += count
+
+    def get_window(self):
+        # [N * chunk]，output_queue里的零拷贝视图
+        return self.output_queue.window(self.window_frames)
+
+    def trim_window(self):
+        # discard the old part, keep the strides for the next step
+        self.window_frames = self.stride_left_size + self.stride_right_size
+
+    # return AudioBatch: int16 pcm [count, chunk]; types 0-normal speak, 1-silence; eventpoints:custom event sync with audio
+    def get_audio_out(self, count):
+        return self.output_queue.read(count)
 
     def warm_up(self):
-        for _ in range(self.stride_left_size + self.stride_right_size):
-            audio_frame, type, eventpoint = self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame, type, eventpoint))
-        for _ in range(self.stride_left_size):
-            self.output_queue.get()
+        self.push_frames(self.stride_left_size + self.stride_right_size)
+        self.output_queue.read(self.stride_left_size)
 
     def run_step(self):
         pass
@@ -16,7 +16,6 @@
 ###############################################################################
 
 import math
-import torch
 import numpy as np
 
 import subprocess
@@ -24,33 +23,96 @@ import os
 import time
 import cv2
 import glob
-import resampy
-import requests
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import soundfile as sf
-
-import av
-from fractions import Fraction
 
 from ttsreal import EdgeTTS,SovitsTTS,XTTS,CosyVoiceTTS,FishTTS,TencentTTS
+from idleloop import PacketSplicer, get_packet_loop, has_packets
+from backend import get_client
 from logger import logger
 
 from tqdm import tqdm
 
 # 后端API配置
-BACKEND_API = "http://localhost:8888"  # 后端API地址
+
+# 自定义视频素材每个进程只加载一次，所有会话共享
+_custom_assets = {}
+_custom_assets_lock = Lock()
+
+def _read_pool():
+    # cv2.imread/imdecode和文件读取会释放GIL，用线程池并行
+    return ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
 
 def read_imgs(img_list):
-    frames = []
     logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
+    with _read_pool() as pool:
+        return list(tqdm(pool.map(cv2.imread, img_list), total=len(img_list)))
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class EncodedFrames:
+    """按下标解码的图片序列，带一个小的解码LRU，可被多个会话的线程同时访问。
+    data为图片文件的原始字节(jpg/png)时内存里只保留压缩数据；为None时每次从磁盘读，
+    用于已有预编码包的自定义视频，只有录制、过渡、未切入预编码包时才需要解码"""
+    def __init__(self, img_list, data=None, cachesize=16):
+        self.img_list = img_list
+        self.data = data
+        self.cachesize = cachesize
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.img_list)
+
+    def __getitem__(self, index):
+        with self._lock:
+            frame = self._cache.get(index)
+            if frame is not None:
+                self._cache.move_to_end(index)
+                return frame
+        if self.data is not None:
+            frame = cv2.imdecode(np.frombuffer(self.data[index], dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            frame = cv2.imread(self.img_list[index])
+        frame.setflags(write=False)
+        with self._lock:
+            self._cache[index] = frame
+            if len(self._cache) > self.cachesize:
+                self._cache.popitem(last=False)
+        return frame
+
+def load_custom_asset(item, cache='raw'):
+    """返回(frames, audio)，只读，进程内共享。
+    cache='raw'时解码后的BGR帧常驻内存；'encoded'时只保留图片文件字节，按需解码"""
+    import soundfile as sf
+    key = (item['imgpath'], item['audiopath'], cache)
+    with _custom_assets_lock:
+        asset = _custom_assets.get(key)
+        if asset is None:
+            input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
+            input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+            # 素材在协商编码之前加载、各会话共享，只有每种编码都有预编码包时才不预先解码
+            if has_packets(item['imgpath']):
+                frames = EncodedFrames(input_img_list)
+            elif cache == 'encoded':
+                with _read_pool() as pool:
+                    frames = EncodedFrames(input_img_list, list(pool.map(read_file, input_img_list)))
+            else:
+                frames = read_imgs(input_img_list)
+                for frame in frames:
+                    frame.setflags(write=False)
+            audio, sample_rate = sf.read(item['audiopath'], dtype='float32')
+            audio.setflags(write=False)
+            asset = (frames, audio)
+            _custom_assets[key] = asset
+    return asset
 
 class BaseReal:
     def __init__(self, opt):
@@ -84,6 +146,10 @@ class BaseReal:
         self._record_audio_pipe = None
         self.width = self.height = 0
 
+        # webrtc协商出的视频编码(H264/VP8)，由app在协商完成后设置；静音时用预编码包代替原始帧
+        self.video_codec = None
+        self.idle_splicer = PacketSplicer()
+
         self.curr_state=0
         self.custom_img_cycle = {}
         self.custom_audio_cycle = {}
@@ -93,36 +159,23 @@ class BaseReal:
         self.__loadcustom()
 
     def _init_session_from_backend(self):
-        """从后端获取会话信息"""
-        try:
-            if not self.backend_token:
-                logger.warning("No backend token provided, using default session")
-                self.video_dir = os.path.join('videos', self.username)
-                os.makedirs(self.video_dir, exist_ok=True)
-                return
-
-            # 创建会话
-            response = requests.post(
-                f"{BACKEND_API}/digital-person/create-session",
-                headers={"Authorization": f"Bearer {self.backend_token}"}
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                self.sessionid = data["session_id"]
-                # 确保视频目录存在
-                self.video_dir = os.path.join('videos', self.username, str(self.sessionid))
-                os.makedirs(self.video_dir, exist_ok=True)
-                logger.info(f"Session initialized from backend: {self.sessionid}, video_dir: {self.video_dir}")
-            else:
-                logger.error(f"Failed to create session: {response.text}")
-                raise Exception("Failed to create session from backend")
-                
-        except Exception as e:
-            logger.error(f"Error initializing session from backend: {str(e)}")
-            # 使用默认配置
-            self.video_dir = os.path.join('videos', self.username, str(self.sessionid))
+        """向后端注册会话，不等待结果：先用本地的临时会话id，后端返回后在回调里替换"""
+        self.provisional_sessionid = self.sessionid
+        if not self.backend_token:
+            logger.warning("No backend token provided, using default session")
+            self.video_dir = os.path.join('videos', self.username)
             os.makedirs(self.video_dir, exist_ok=True)
+            return
+
+        self.video_dir = os.path.join('videos', self.username, str(self.sessionid))
+        os.makedirs(self.video_dir, exist_ok=True)
+        get_client().create_session(self.sessionid, self.backend_token, self._on_backend_session)
+
+    def _on_backend_session(self, sessionid):
+        self.sessionid = sessionid
+        self.video_dir = os.path.join('videos', self.username, str(self.sessionid))
+        os.makedirs(self.video_dir, exist_ok=True)
+        logger.info(f"Session initialized from backend: {self.sessionid}, video_dir: {self.video_dir}")
 
     def put_msg_txt(self,msg,eventpoint=None):
         self.tts.put_msg_txt(msg,eventpoint)
@@ -141,6 +194,8 @@ class BaseReal:
             idx += self.chunk
     
     def __create_bytes_stream(self,byte_stream):
+        import resampy
+        import soundfile as sf
         #byte_stream=BytesIO(buffer)
         stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
         logger.info(f'[INFO]put audio stream {sample_rate}: {stream.shape}')
@@ -164,12 +219,12 @@ class BaseReal:
         return self.speaking
     
     def __loadcustom(self):
+        cache = self.opt.customvideo_cache if hasattr(self.opt, 'customvideo_cache') else 'raw'
         for item in self.opt.customopt:
             logger.info(item)
-            input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
-            input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-            self.custom_img_cycle[item['audiotype']] = read_imgs(input_img_list)
-            self.custom_audio_cycle[item['audiotype']], sample_rate = sf.read(item['audiopath'], dtype='float32')
+            frames, audio = load_custom_asset(item, cache)
+            self.custom_img_cycle[item['audiotype']] = frames
+            self.custom_audio_cycle[item['audiotype']] = audio
             self.custom_audio_index[item['audiotype']] = 0
             self.custom_index[item['audiotype']] = 0
             self.custom_opt[item['audiotype']] = item
@@ -184,10 +239,22 @@ class BaseReal:
     def notify(self,eventpoint):
         logger.info("notify:%s",eventpoint)
 
+    def _init_frame_size(self):
+        """从形象或自定义动作的源帧取录制分辨率；会话一开始就在播预编码包时，
+        record_video_data拿不到原始帧，不能等它来设置"""
+        if self.width:
+            return
+        sources = [getattr(self, 'frame_list_cycle', None)] + list(self.custom_img_cycle.values())
+        for frames in sources:
+            if frames is not None and len(frames) > 0:
+                self.height,self.width = frames[0].shape[:2]
+                return
+
     def start_recording(self):
         """开始录制视频"""
         if self.recording:
             return
+        self._init_frame_size()
 
         # 确保视频目录存在
         os.makedirs(self.video_dir, exist_ok=True)
@@ -229,6 +296,8 @@ class BaseReal:
         logger.info("Recording started")
     
     def record_video_data(self,image):
+        if image is None: #发送的是预编码包，没有解码原始帧(此时不在录制)
+            return
         if self.width == 0:
             print("image.shape:",image.shape)
             self.height,self.width,_ = image.shape
@@ -274,21 +343,34 @@ class BaseReal:
         except Exception as e:
             logger.error(f"Error cleaning up temporary files: {str(e)}")
 
-        # 通知后端视频录制完成
-        try:
-            if self.backend_token:
-                response = requests.post(
-                    f"{BACKEND_API}/digital-person/notify-video-complete",
-                    headers={"Authorization": f"Bearer {self.backend_token}"},
-                    json={
-                        "session_id": self.sessionid,
-                        "video_path": output_path
-                    }
-                )
-                if response.status_code != 200:
-                    logger.error(f"Failed to notify backend: {response.text}")
-        except Exception as e:
-            logger.error(f"Error notifying backend: {str(e)}")
+        # 通知后端视频录制完成，写入outbox后由后台线程发送
+        if self.backend_token:
+            get_client().notify("/digital-person/notify-video-complete", self.backend_token,
+                                {"session_id": self.sessionid, "video_path": output_path},
+                                self.provisional_sessionid)
+
+    def close_session(self):
+        """连接断开后调用，后端客户端在通知送达后丢掉这个会话的id映射"""
+        if self.backend_token:
+            get_client().forget_session(self.provisional_sessionid)
+
+    def get_idle_packet(self, frame_index, idx):
+        """静音帧frame_list_cycle[idx]对应的预编码包，frame_index为推理侧的帧序号。
+        返回None时按原方式发送原始帧"""
+        if self.mirror_index(len(self.frame_list_cycle), frame_index) != idx:
+            return None
+        imgdir = f"./data/avatars/{self.opt.avatar_id}/full_imgs"
+        return self._get_loop_packet(self.frame_list_cycle, imgdir, frame_index)
+
+    def get_custom_packet(self, audiotype, index):
+        """自定义视频第index帧(mirror_index之前的序号)对应的预编码包"""
+        return self._get_loop_packet(self.custom_img_cycle[audiotype],
+                                     self.custom_opt[audiotype]['imgpath'], index)
+
+    def _get_loop_packet(self, frames, imgdir, index):
+        if not self.video_codec or not self.opt.idle_packets:
+            return None
+        return self.idle_splicer.get(get_packet_loop(frames, self.video_codec, imgdir), index)
 
     def mirror_index(self,size, index):
         #size = len(self.coord_list_cycle)
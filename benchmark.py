@@ -0,0 +1,130 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 口型模型吞吐测试：按inference()里的方式取一批人脸输入、上传音频特征、前向、取回结果，
+# 在不同batch size下统计每批耗时和fps。音频特征用随机数，不影响耗时。
+# python benchmark.py --model ultralight --avatar_id ultralight_avatar1 --device cpu --batch_sizes 1 2 4 8 16
+# 对比多个后端：--backend torch onnx int8，对比编译模式：--compile none trace compile
+# ernerf：python benchmark.py --model ernerf --device cpu --batch_sizes 1 4 8
+#   ernerf的raymarching/gridencoder只有cuda实现，这里测的是渲染之后逐帧/批量的缩放、取回结果的开销
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+
+def load(opt, backend, compile_mode):
+    """返回(forward(img_batch, feat_batch), face_tensor, 音频特征形状)，音频特征形状不含batch维"""
+    if opt.model == 'wav2lip':
+        import lipreal
+        lipreal.device = opt.device
+        model = lipreal.load_model("./models/wav2lip.pth", backend)
+        model = lipreal.warm_up(max(opt.batch_sizes), model, 256, compile_mode, opt.batch_sizes)
+        _, face_tensor, _ = lipreal.load_avatar(opt.avatar_id)
+        return lambda img_batch, mel_batch: model(mel_batch, img_batch), face_tensor, (1, 80, 16)
+    elif opt.model == 'ultralight':
+        import lightreal
+        lightreal.device = opt.device
+        avatar = lightreal.load_avatar(opt.avatar_id, backend)
+        model, _, _, _, face_tensor = lightreal.warm_up(max(opt.batch_sizes), avatar, 160, compile_mode, opt.batch_sizes)
+        return model, face_tensor, (32, 32, 32)
+    raise ValueError(f'benchmark does not support model {opt.model}')
+
+
+@torch.no_grad()
+def run(forward, face_tensor, feat_shape, batch_size, iters, warmup):
+    length = face_tensor.shape[0]
+    indices = torch.arange(batch_size, device=face_tensor.device) % length
+    feats = np.random.rand(batch_size, *feat_shape).astype(np.float32)
+    timings = []
+    for i in range(warmup + iters):
+        t = time.perf_counter()
+        img_batch = face_tensor.index_select(0, indices)
+        feat_batch = torch.from_numpy(feats).to(face_tensor.device)
+        forward(img_batch, feat_batch).cpu().numpy()
+        if i >= warmup:
+            timings.append(time.perf_counter() - t)
+    return np.array(timings)
+
+
+def run_nerf_output(opt):
+    # 与Trainer.test_gui_with_data(逐帧，含depth)和test_gui_batch(批量，单次拷贝)相同的后处理
+    import torch.nn.functional as F
+    h, w = opt.nerf_size
+    print(f'ernerf output stage on {opt.device}, render {h}x{w} -> {opt.W}x{opt.H}')
+    print(f"{'batch':>6}{'per-frame ms':>14}{'batched ms':>12}{'speedup':>9}")
+    for batch_size in opt.batch_sizes:
+        preds = torch.rand(batch_size, h, w, 3, device=opt.device)
+        preds_depth = torch.rand(batch_size, h, w, device=opt.device)
+        sequential, batched = [], []
+        for i in range(opt.warmup + opt.iters):
+            t = time.perf_counter()
+            for b in range(batch_size):
+                pred = F.interpolate(preds[b:b+1].permute(0, 3, 1, 2), size=(opt.H, opt.W), mode='bilinear').permute(0, 2, 3, 1).contiguous()
+                F.interpolate(preds_depth[b:b+1].unsqueeze(1), size=(opt.H, opt.W), mode='nearest').squeeze(1)[0].cpu().numpy()
+                (pred[0].cpu().numpy() * 255).astype(np.uint8)
+            t1 = time.perf_counter()
+            pred = preds
+            if pred.shape[1:3] != (opt.H, opt.W):
+                pred = F.interpolate(pred.permute(0, 3, 1, 2), size=(opt.H, opt.W), mode='bilinear').permute(0, 2, 3, 1)
+            (pred * 255).to(torch.uint8).cpu().numpy()
+            t2 = time.perf_counter()
+            if i >= opt.warmup:
+                sequential.append(t1 - t)
+                batched.append(t2 - t1)
+        sequential, batched = np.mean(sequential), np.mean(batched)
+        print(f'{batch_size:>6}{sequential*1000:>14.2f}{batched*1000:>12.2f}{sequential/batched:>9.2f}')
+
+
+def main(opt):
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.model == 'ernerf':
+        return run_nerf_output(opt)
+    for backend in opt.backend:
+        for compile_mode in (opt.compile if backend == 'torch' else ['none']):
+            t = time.perf_counter()
+            forward, face_tensor, feat_shape = load(opt, backend, compile_mode)
+            # 启动时间包含加载模型、avatar、编译(或读取编译缓存)和预热
+            print(f'{opt.model} {backend} compile={compile_mode} on {opt.device}, {torch.get_num_threads()} threads, '
+                  f'{face_tensor.shape[0]} faces, startup {time.perf_counter()-t:.2f}s')
+            print(f"{'batch':>6}{'ms/batch':>12}{'p90 ms':>10}{'fps':>10}")
+            for batch_size in opt.batch_sizes:
+                timings = run(forward, face_tensor, feat_shape, batch_size, opt.iters, opt.warmup)
+                print(f'{batch_size:>6}{timings.mean()*1000:>12.2f}{np.percentile(timings, 90)*1000:>10.2f}'
+                      f'{batch_size/timings.mean():>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='ultralight')  # wav2lip
+    parser.add_argument('--avatar_id', type=str, default='avator_1')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--backend', type=str, nargs='+', default=['torch'], help="torch onnx int8")
+    parser.add_argument('--compile', type=str, nargs='+', default=['none'], help="none trace compile, torch backend only")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument('--nerf_size', type=int, nargs=2, default=[256, 256], help="ernerf render h w, small by default")
+    parser.add_argument('--W', type=int, default=450)
+    parser.add_argument('--H', type=int, default=450)
+    opt = parser.parse_args()
+
+    main(opt)
@@ -0,0 +1,127 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 口型模型的编译执行模式，在warm_up里按几个batch size分桶编译并预热：
+#   trace:   TorchScript trace+freeze，结果按模型权重hash和输入形状缓存到磁盘，
+#            非桶内的batch补零到最近的桶，超过最大桶时走eager
+#   compile: torch.compile(dynamic=False)，inductor的编译结果缓存在同一目录下
+# 任何一步失败都退回eager模型。
+
+import hashlib
+import os
+
+import torch
+
+from logger import logger
+
+COMPILE_CACHE = './models/compiled'
+
+
+def default_buckets(batch_size):
+    buckets = {batch_size}
+    bs = 1
+    while bs < batch_size:
+        buckets.add(bs)
+        bs *= 2
+    return sorted(buckets)
+
+
+def model_hash(model):
+    h = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        h.update(name.encode())
+        h.update(str(value.dtype).encode())
+        h.update(value.detach().float().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def _shape_key(inputs):
+    return '_'.join('x'.join(str(d) for d in x.shape) for x in inputs)
+
+
+class BucketedModel:
+    """按batch size选择预编译好的模块，调用方式与原模型相同"""
+    def __init__(self, eager, compiled):
+        self.eager = eager
+        self.compiled = compiled
+        self.buckets = sorted(compiled)
+
+    def __call__(self, *inputs):
+        batch_size = inputs[0].shape[0]
+        for bucket in self.buckets:
+            if bucket >= batch_size:
+                break
+        else:
+            return self.eager(*inputs)
+        module = self.compiled[bucket]
+        if bucket == batch_size:
+            return module(*inputs)
+        padded = [torch.cat([x, x.new_zeros((bucket - batch_size,) + tuple(x.shape[1:]))]) for x in inputs]
+        return module(*padded)[:batch_size]
+
+    def eval(self):
+        return self
+
+
+@torch.no_grad()
+def _trace(model, name, make_inputs, buckets):
+    param = next(model.parameters())
+    key = model_hash(model)
+    os.makedirs(COMPILE_CACHE, exist_ok=True)
+    compiled = {}
+    for batch_size in buckets:
+        inputs = make_inputs(batch_size)
+        path = os.path.join(COMPILE_CACHE, f'{name}-{key}-{param.device.type}-{str(param.dtype)[6:]}-{_shape_key(inputs)}.pt')
+        if os.path.exists(path):
+            module = torch.jit.load(path, map_location=param.device)
+            logger.info(f'{name}: loaded {path}')
+        else:
+            module = torch.jit.freeze(torch.jit.trace(model, inputs))
+            torch.jit.save(module, path)
+            logger.info(f'{name}: traced batch {batch_size}, saved {path}')
+        module(*inputs)  # 预热，TorchScript前几次调用会做profiling和图优化
+        module(*inputs)
+        compiled[batch_size] = module
+    return BucketedModel(model, compiled)
+
+
+@torch.no_grad()
+def _compile(model, name, make_inputs, buckets):
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(os.path.join(COMPILE_CACHE, 'inductor')))
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+    compiled = torch.compile(model, dynamic=False)
+    for batch_size in buckets:
+        compiled(*make_inputs(batch_size))
+        logger.info(f'{name}: compiled batch {batch_size}')
+    return compiled
+
+
+def compile_model(model, name, make_inputs, buckets, mode='none'):
+    """make_inputs(batch_size)返回一组示例输入(位置参数)；不是torch模型(onnx后端)时原样返回"""
+    if mode == 'none' or not isinstance(model, torch.nn.Module):
+        return model
+    try:
+        if mode == 'trace':
+            return _trace(model, name, make_inputs, buckets)
+        elif mode == 'compile':
+            return _compile(model, name, make_inputs, buckets)
+        raise ValueError(f'unknown compile mode {mode}')
+    except Exception:
+        logger.exception(f'{name}: {mode} failed, fall back to eager')
+        return model
@@ -1,16 +1,33 @@
+# 预处理各步骤按依赖关系组成DAG，互不依赖的步骤可以同时运行(--jobs)。
+# 每个步骤的key = 输入视频内容hash + 参数 + 步骤代码(包括调用的外部脚本) + 上游步骤的key，
+# 记录在<base_dir>/preprocess_cache.json里，key没变且输出还在的步骤直接跳过。
+# 逐帧的步骤(landmarks、background、torso)用--workers个worker并行，最后输出各步骤耗时。
 import os
 import glob
 import tqdm
 import json
+import time
+import hashlib
+import inspect
 import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 import cv2
 import numpy as np
 
+
+def run_cmd(cmd):
+    # 命令失败时抛异常，失败的步骤不会写入缓存
+    ret = subprocess.call(cmd, shell=True)
+    if ret != 0:
+        raise RuntimeError(f'command failed with exit code {ret}: {cmd}')
+
 def extract_audio(path, out_path, sample_rate=16000):
     
     print(f'[INFO] ===== extract audio from {path} to {out_path} =====')
-    cmd = f'ffmpeg -i {path} -f wav -ar {sample_rate} {out_path}'
-    os.system(cmd)
+    cmd = f'ffmpeg -y -i {path} -f wav -ar {sample_rate} {out_path}'
+    run_cmd(cmd)
     print(f'[INFO] ===== extracted audio =====')
 
 
@@ -21,7 +38,7 @@ def extract_audio_features(path, mode='wav2vec'):
         cmd = f'python nerf/asr.py --wav {path} --save_feats'
     else: # deepspeech
         cmd = f'python data_utils/deepspeech_features/extract_ds_features.py --input {path}'
-    os.system(cmd)
+    run_cmd(cmd)
     print(f'[INFO] ===== extracted audio labels =====')
 
 
@@ -29,8 +46,8 @@ def extract_audio_features(path, mode='wav2vec'):
 def extract_images(path, out_path, fps=25):
 
     print(f'[INFO] ===== extract images from {path} to {out_path} =====')
-    cmd = f'ffmpeg -i {path} -vf fps={fps} -qmin 1 -q:v 1 -start_number 0 {os.path.join(out_path, "%d.jpg")}'
-    os.system(cmd)
+    cmd = f'ffmpeg -y -i {path} -vf fps={fps} -qmin 1 -q:v 1 -start_number 0 {os.path.join(out_path, "%d.jpg")}'
+    run_cmd(cmd)
     print(f'[INFO] ===== extracted images =====')
 
 
@@ -38,29 +55,42 @@ def extract_semantics(ori_imgs_dir, parsing_dir):
 
     print(f'[INFO] ===== extract semantics from {ori_imgs_dir} to {parsing_dir} =====')
     cmd = f'python data_utils/face_parsing/test.py --respath={parsing_dir} --imgpath={ori_imgs_dir}'
-    os.system(cmd)
+    run_cmd(cmd)
     print(f'[INFO] ===== extracted semantics =====')
 
 
-def extract_landmarks(ori_imgs_dir):
+def extract_landmarks(ori_imgs_dir, workers=1):
 
     print(f'[INFO] ===== extract face landmarks from {ori_imgs_dir} =====')
 
     import face_alignment
     fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False)
     image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
-    for image_path in tqdm.tqdm(image_paths):
+
+    # 模型推理时torch会释放GIL，读图、检测和写文件在线程里重叠，共用一个模型
+    def process(image_path):
         input = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
         input = cv2.cvtColor(input, cv2.COLOR_BGR2RGB)
         preds = fa.get_landmarks(input)
-        if len(preds) > 0:
+        if preds is not None and len(preds) > 0:
             lands = preds[0].reshape(-1, 2)[:,:2]
             np.savetxt(image_path.replace('jpg', 'lms'), lands, '%f')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(tqdm.tqdm(pool.map(process, image_paths), total=len(image_paths)))
     del fa
     print(f'[INFO] ===== extracted face landmarks =====')
 
 
-def extract_background(base_dir, ori_imgs_dir):
+def background_dists(parse_path):
+    # 每个像素到最近前景像素的距离，和kd_tree最近邻的结果相同，[H*W, 1]
+    parse_img = cv2.imread(parse_path)
+    bg = (parse_img[..., 0] == 255) & (parse_img[..., 1] == 255) & (parse_img[..., 2] == 255)
+    dists = cv2.distanceTransform(bg.astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return dists.reshape(-1, 1)
+
+
+def extract_background(base_dir, ori_imgs_dir, workers=1):
     
     print(f'[INFO] ===== extract background image from {ori_imgs_dir} =====')
 
@@ -74,15 +104,10 @@ def extract_background(base_dir, ori_imgs_dir):
     h, w = tmp_image.shape[:2]
 
     # nearest neighbors
-    all_xys = np.mgrid[0:h, 0:w].reshape(2, -1).transpose()
-    distss = []
-    for image_path in tqdm.tqdm(image_paths):
-        parse_img = cv2.imread(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
-        bg = (parse_img[..., 0] == 255) & (parse_img[..., 1] == 255) & (parse_img[..., 2] == 255)
-        fg_xys = np.stack(np.nonzero(~bg)).transpose(1, 0)
-        nbrs = NearestNeighbors(n_neighbors=1, algorithm='kd_tree').fit(fg_xys)
-        dists, _ = nbrs.kneighbors(all_xys)
-        distss.append(dists)
+    parse_paths = [image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png') for image_path in image_paths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        distss = list(tqdm.tqdm(pool.map(background_dists, parse_paths), total=len(parse_paths)))
+        imgs = list(pool.map(cv2.imread, image_paths))
 
     distss = np.stack(distss)
     max_dist = np.max(distss, 0)
@@ -92,11 +117,7 @@ def extract_background(base_dir, ori_imgs_dir):
     bc_pixs_id = np.nonzero(bc_pixs)
     bc_ids = max_id[bc_pixs]
 
-    imgs = []
     num_pixs = distss.shape[1]
-    for image_path in image_paths:
-        img = cv2.imread(image_path)
-        imgs.append(img)
     imgs = np.stack(imgs).reshape(-1, num_pixs, 3)
 
     bc_img = np.zeros((h*w, 3), dtype=np.uint8)
@@ -117,124 +138,140 @@ def extract_background(base_dir, ori_imgs_dir):
     print(f'[INFO] ===== extracted background image =====')
 
 
-def extract_torso_and_gt(base_dir, ori_imgs_dir):
+_torso_bg_image = None
 
-    print(f'[INFO] ===== extract torso and gt images for {base_dir} =====')
 
-    from scipy.ndimage import binary_erosion, binary_dilation
+def _init_torso_worker(bg_path):
+    global _torso_bg_image
+    _torso_bg_image = cv2.imread(bg_path, cv2.IMREAD_UNCHANGED)
 
-    # load bg
-    bg_image = cv2.imread(os.path.join(base_dir, 'bc.jpg'), cv2.IMREAD_UNCHANGED)
-    
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
 
-    for image_path in tqdm.tqdm(image_paths):
-        # read ori image
-        ori_image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
-
-        # read semantics
-        seg = cv2.imread(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
-        head_part = (seg[..., 0] == 255) & (seg[..., 1] == 0) & (seg[..., 2] == 0)
-        neck_part = (seg[..., 0] == 0) & (seg[..., 1] == 255) & (seg[..., 2] == 0)
-        torso_part = (seg[..., 0] == 0) & (seg[..., 1] == 0) & (seg[..., 2] == 255)
-        bg_part = (seg[..., 0] == 255) & (seg[..., 1] == 255) & (seg[..., 2] == 255)
-
-        # get gt image
-        gt_image = ori_image.copy()
-        gt_image[bg_part] = bg_image[bg_part]
-        cv2.imwrite(image_path.replace('ori_imgs', 'gt_imgs'), gt_image)
-
-        # get torso image
-        torso_image = gt_image.copy() # rgb
-        torso_image[head_part] = bg_image[head_part]
-        torso_alpha = 255 * np.ones((gt_image.shape[0], gt_image.shape[1], 1), dtype=np.uint8) # alpha
-        
-        # torso part "vertical" in-painting...
-        L = 8 + 1
-        torso_coords = np.stack(np.nonzero(torso_part), axis=-1) # [M, 2]
-        # lexsort: sort 2D coords first by y then by x, 
-        # ref: https://stackoverflow.com/questions/2706605/sorting-a-2d-numpy-array-by-multiple-axes
-        inds = np.lexsort((torso_coords[:, 0], torso_coords[:, 1]))
-        torso_coords = torso_coords[inds]
-        # choose the top pixel for each column
-        u, uid, ucnt = np.unique(torso_coords[:, 1], return_index=True, return_counts=True)
-        top_torso_coords = torso_coords[uid] # [m, 2]
-        # only keep top-is-head pixels
-        top_torso_coords_up = top_torso_coords.copy() - np.array([1, 0])
-        mask = head_part[tuple(top_torso_coords_up.T)] 
-        if mask.any():
-            top_torso_coords = top_torso_coords[mask]
-            # get the color
-            top_torso_colors = gt_image[tuple(top_torso_coords.T)] # [m, 3]
-            # construct inpaint coords (vertically up, or minus in x)
-            inpaint_torso_coords = top_torso_coords[None].repeat(L, 0) # [L, m, 2]
-            inpaint_offsets = np.stack([-np.arange(L), np.zeros(L, dtype=np.int32)], axis=-1)[:, None] # [L, 1, 2]
-            inpaint_torso_coords += inpaint_offsets
-            inpaint_torso_coords = inpaint_torso_coords.reshape(-1, 2) # [Lm, 2]
-            inpaint_torso_colors = top_torso_colors[None].repeat(L, 0) # [L, m, 3]
-            darken_scaler = 0.98 ** np.arange(L).reshape(L, 1, 1) # [L, 1, 1]
-            inpaint_torso_colors = (inpaint_torso_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
-            # set color
-            torso_image[tuple(inpaint_torso_coords.T)] = inpaint_torso_colors
-
-            inpaint_torso_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
-            inpaint_torso_mask[tuple(inpaint_torso_coords.T)] = True
-        else:
-            inpaint_torso_mask = None
-            
-
-        # neck part "vertical" in-painting...
-        push_down = 4
-        L = 48 + push_down + 1
-
-        neck_part = binary_dilation(neck_part, structure=np.array([[0, 1, 0], [0, 1, 0], [0, 1, 0]], dtype=bool), iterations=3)
-
-        neck_coords = np.stack(np.nonzero(neck_part), axis=-1) # [M, 2]
-        # lexsort: sort 2D coords first by y then by x, 
-        # ref: https://stackoverflow.com/questions/2706605/sorting-a-2d-numpy-array-by-multiple-axes
-        inds = np.lexsort((neck_coords[:, 0], neck_coords[:, 1]))
-        neck_coords = neck_coords[inds]
-        # choose the top pixel for each column
-        u, uid, ucnt = np.unique(neck_coords[:, 1], return_index=True, return_counts=True)
-        top_neck_coords = neck_coords[uid] # [m, 2]
-        # only keep top-is-head pixels
-        top_neck_coords_up = top_neck_coords.copy() - np.array([1, 0])
-        mask = head_part[tuple(top_neck_coords_up.T)] 
-        
-        top_neck_coords = top_neck_coords[mask]
-        # push these top down for 4 pixels to make the neck inpainting more natural...
-        offset_down = np.minimum(ucnt[mask] - 1, push_down)
-        top_neck_coords += np.stack([offset_down, np.zeros_like(offset_down)], axis=-1)
+def extract_torso_and_gt_one(image_path):
+
+    from scipy.ndimage import binary_erosion, binary_dilation
+
+    bg_image = _torso_bg_image
+
+    # read ori image
+    ori_image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
+
+    # read semantics
+    seg = cv2.imread(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
+    head_part = (seg[..., 0] == 255) & (seg[..., 1] == 0) & (seg[..., 2] == 0)
+    neck_part = (seg[..., 0] == 0) & (seg[..., 1] == 255) & (seg[..., 2] == 0)
+    torso_part = (seg[..., 0] == 0) & (seg[..., 1] == 0) & (seg[..., 2] == 255)
+    bg_part = (seg[..., 0] == 255) & (seg[..., 1] == 255) & (seg[..., 2] == 255)
+
+    # get gt image
+    gt_image = ori_image.copy()
+    gt_image[bg_part] = bg_image[bg_part]
+    cv2.imwrite(image_path.replace('ori_imgs', 'gt_imgs'), gt_image)
+
+    # get torso image
+    torso_image = gt_image.copy() # rgb
+    torso_image[head_part] = bg_image[head_part]
+    torso_alpha = 255 * np.ones((gt_image.shape[0], gt_image.shape[1], 1), dtype=np.uint8) # alpha
+
+    # torso part "vertical" in-painting...
+    L = 8 + 1
+    torso_coords = np.stack(np.nonzero(torso_part), axis=-1) # [M, 2]
+    # lexsort: sort 2D coords first by y then by x, 
+    # ref: https://stackoverflow.com/questions/2706605/sorting-a-2d-numpy-array-by-multiple-axes
+    inds = np.lexsort((torso_coords[:, 0], torso_coords[:, 1]))
+    torso_coords = torso_coords[inds]
+    # choose the top pixel for each column
+    u, uid, ucnt = np.unique(torso_coords[:, 1], return_index=True, return_counts=True)
+    top_torso_coords = torso_coords[uid] # [m, 2]
+    # only keep top-is-head pixels
+    top_torso_coords_up = top_torso_coords.copy() - np.array([1, 0])
+    mask = head_part[tuple(top_torso_coords_up.T)] 
+    if mask.any():
+        top_torso_coords = top_torso_coords[mask]
         # get the color
-        top_neck_colors = gt_image[tuple(top_neck_coords.T)] # [m, 3]
+        top_torso_colors = gt_image[tuple(top_torso_coords.T)] # [m, 3]
         # construct inpaint coords (vertically up, or minus in x)
-        inpaint_neck_coords = top_neck_coords[None].repeat(L, 0) # [L, m, 2]
+        inpaint_torso_coords = top_torso_coords[None].repeat(L, 0) # [L, m, 2]
         inpaint_offsets = np.stack([-np.arange(L), np.zeros(L, dtype=np.int32)], axis=-1)[:, None] # [L, 1, 2]
-        inpaint_neck_coords += inpaint_offsets
-        inpaint_neck_coords = inpaint_neck_coords.reshape(-1, 2) # [Lm, 2]
-        inpaint_neck_colors = top_neck_colors[None].repeat(L, 0) # [L, m, 3]
+        inpaint_torso_coords += inpaint_offsets
+        inpaint_torso_coords = inpaint_torso_coords.reshape(-1, 2) # [Lm, 2]
+        inpaint_torso_colors = top_torso_colors[None].repeat(L, 0) # [L, m, 3]
         darken_scaler = 0.98 ** np.arange(L).reshape(L, 1, 1) # [L, 1, 1]
-        inpaint_neck_colors = (inpaint_neck_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
+        inpaint_torso_colors = (inpaint_torso_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
         # set color
-        torso_image[tuple(inpaint_neck_coords.T)] = inpaint_neck_colors
-
-        # apply blurring to the inpaint area to avoid vertical-line artifects...
-        inpaint_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
-        inpaint_mask[tuple(inpaint_neck_coords.T)] = True
-
-        blur_img = torso_image.copy()
-        blur_img = cv2.GaussianBlur(blur_img, (5, 5), cv2.BORDER_DEFAULT)
+        torso_image[tuple(inpaint_torso_coords.T)] = inpaint_torso_colors
+
+        inpaint_torso_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
+        inpaint_torso_mask[tuple(inpaint_torso_coords.T)] = True
+    else:
+        inpaint_torso_mask = None
+
+
+    # neck part "vertical" in-painting...
+    push_down = 4
+    L = 48 + push_down + 1
+
+    neck_part = binary_dilation(neck_part, structure=np.array([[0, 1, 0], [0, 1, 0], [0, 1, 0]], dtype=bool), iterations=3)
+
+    neck_coords = np.stack(np.nonzero(neck_part), axis=-1) # [M, 2]
+    # lexsort: sort 2D coords first by y then by x, 
+    # ref: https://stackoverflow.com/questions/2706605/sorting-a-2d-numpy-array-by-multiple-axes
+    inds = np.lexsort((neck_coords[:, 0], neck_coords[:, 1]))
+    neck_coords = neck_coords[inds]
+    # choose the top pixel for each column
+    u, uid, ucnt = np.unique(neck_coords[:, 1], return_index=True, return_counts=True)
+    top_neck_coords = neck_coords[uid] # [m, 2]
+    # only keep top-is-head pixels
+    top_neck_coords_up = top_neck_coords.copy() - np.array([1, 0])
+    mask = head_part[tuple(top_neck_coords_up.T)] 
+
+    top_neck_coords = top_neck_coords[mask]
+    # push these top down for 4 pixels to make the neck inpainting more natural...
+    offset_down = np.minimum(ucnt[mask] - 1, push_down)
+    top_neck_coords += np.stack([offset_down, np.zeros_like(offset_down)], axis=-1)
+    # get the color
+    top_neck_colors = gt_image[tuple(top_neck_coords.T)] # [m, 3]
+    # construct inpaint coords (vertically up, or minus in x)
+    inpaint_neck_coords = top_neck_coords[None].repeat(L, 0) # [L, m, 2]
+    inpaint_offsets = np.stack([-np.arange(L), np.zeros(L, dtype=np.int32)], axis=-1)[:, None] # [L, 1, 2]
+    inpaint_neck_coords += inpaint_offsets
+    inpaint_neck_coords = inpaint_neck_coords.reshape(-1, 2) # [Lm, 2]
+    inpaint_neck_colors = top_neck_colors[None].repeat(L, 0) # [L, m, 3]
+    darken_scaler = 0.98 ** np.arange(L).reshape(L, 1, 1) # [L, 1, 1]
+    inpaint_neck_colors = (inpaint_neck_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
+    # set color
+    torso_image[tuple(inpaint_neck_coords.T)] = inpaint_neck_colors
+
+    # apply blurring to the inpaint area to avoid vertical-line artifects...
+    inpaint_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
+    inpaint_mask[tuple(inpaint_neck_coords.T)] = True
+
+    blur_img = torso_image.copy()
+    blur_img = cv2.GaussianBlur(blur_img, (5, 5), cv2.BORDER_DEFAULT)
+
+    torso_image[inpaint_mask] = blur_img[inpaint_mask]
+
+    # set mask
+    mask = (neck_part | torso_part | inpaint_mask)
+    if inpaint_torso_mask is not None:
+        mask = mask | inpaint_torso_mask
+    torso_image[~mask] = 0
+    torso_alpha[~mask] = 0
+
+    cv2.imwrite(image_path.replace('ori_imgs', 'torso_imgs').replace('.jpg', '.png'), np.concatenate([torso_image, torso_alpha], axis=-1))
+
+
+def extract_torso_and_gt(base_dir, ori_imgs_dir, workers=1):
 
-        torso_image[inpaint_mask] = blur_img[inpaint_mask]
+    print(f'[INFO] ===== extract torso and gt images for {base_dir} =====')
 
-        # set mask
-        mask = (neck_part | torso_part | inpaint_mask)
-        if inpaint_torso_mask is not None:
-            mask = mask | inpaint_torso_mask
-        torso_image[~mask] = 0
-        torso_alpha[~mask] = 0
+    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
 
-        cv2.imwrite(image_path.replace('ori_imgs', 'torso_imgs').replace('.jpg', '.png'), np.concatenate([torso_image, torso_alpha], axis=-1))
+    # 逐帧的numpy处理大多持有GIL，用进程池；每个进程启动时读一次背景图。
+    # 其他步骤可能同时在线程里运行，用spawn而不是fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_torso_worker,
+                             initargs=(os.path.join(base_dir, 'bc.jpg'),)) as pool:
+        list(tqdm.tqdm(pool.map(extract_torso_and_gt_one, image_paths, chunksize=8), total=len(image_paths)))
 
     print(f'[INFO] ===== extracted torso and gt images =====')
 
@@ -251,7 +288,7 @@ def face_tracking(ori_imgs_dir):
 
     cmd = f'python data_utils/face_tracking/face_tracker.py --path={ori_imgs_dir} --img_h={h} --img_w={w} --frame_num={len(image_paths)}'
 
-    os.system(cmd)
+    run_cmd(cmd)
 
     print(f'[INFO] ===== finished face tracking =====')
 
@@ -342,11 +379,163 @@ def save_transforms(base_dir, ori_imgs_dir):
     print(f'[INFO] ===== finished saving transforms =====')
 
 
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# 外部脚本的相对路径相对于ernerf目录(运行预处理时的当前目录)
+ERNERF_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def script_digest(path):
+    """外部脚本的hash。目录时hash其中所有.py(脚本会import同目录的模块)"""
+    full_path = os.path.join(ERNERF_DIR, path)
+    if os.path.isdir(full_path):
+        h = hashlib.sha1()
+        for file in sorted(glob.glob(os.path.join(full_path, '*.py'))):
+            h.update(os.path.basename(file).encode())
+            h.update(file_digest(file).encode())
+        return h.hexdigest()
+    if os.path.isfile(full_path):
+        return file_digest(full_path)
+    return 'missing'
+
+
+def has_files(pattern):
+    return len(glob.glob(pattern)) > 0
+
+
+class Stage:
+    """DAG中的一个步骤。fn无参数；outputs为必须存在的glob模式；
+    params、code(用到的函数)和scripts(调用的外部脚本或脚本目录)都算进key里，改了参数或代码会重新运行"""
+
+    def __init__(self, task, name, fn, deps=(), outputs=(), params=(), code=(), scripts=()):
+        self.task = task
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.outputs = outputs
+        self.params = params
+        self.code = code
+        self.scripts = scripts
+
+    def key(self, video_digest, dep_keys):
+        h = hashlib.sha1()
+        h.update(video_digest.encode())
+        h.update(json.dumps([self.name, list(self.params)]).encode())
+        for fn in self.code:
+            h.update(inspect.getsource(fn).encode())
+        for path in self.scripts:
+            h.update(f'{path}:{script_digest(path)}'.encode())
+        for dep in self.deps:
+            h.update(dep_keys[dep].encode())
+        return h.hexdigest()
+
+    def done(self):
+        return all(has_files(pattern) for pattern in self.outputs)
+
+
+def build_stages(opt, base_dir, wav_path, ori_imgs_dir, parsing_dir):
+    workers = opt.workers
+    return [
+        Stage(1, 'audio', lambda: extract_audio(opt.path, wav_path),
+              outputs=[wav_path], code=[extract_audio]),
+        Stage(2, 'audio_features', lambda: extract_audio_features(wav_path, mode=opt.asr), deps=['audio'],
+              outputs=[os.path.join(base_dir, 'aud*.npy')], params=[opt.asr], code=[extract_audio_features],
+              scripts=['nerf/asr.py', 'data_utils/deepspeech_features']),
+        Stage(3, 'images', lambda: extract_images(opt.path, ori_imgs_dir),
+              outputs=[os.path.join(ori_imgs_dir, '*.jpg')], code=[extract_images]),
+        Stage(4, 'semantics', lambda: extract_semantics(ori_imgs_dir, parsing_dir), deps=['images'],
+              outputs=[os.path.join(parsing_dir, '*.png')], code=[extract_semantics],
+              scripts=['data_utils/face_parsing']),
+        Stage(5, 'background', lambda: extract_background(base_dir, ori_imgs_dir, workers), deps=['images', 'semantics'],
+              outputs=[os.path.join(base_dir, 'bc.jpg')], code=[extract_background, background_dists]),
+        Stage(6, 'torso', lambda: extract_torso_and_gt(base_dir, ori_imgs_dir, workers), deps=['images', 'semantics', 'background'],
+              outputs=[os.path.join(base_dir, 'gt_imgs', '*.jpg'), os.path.join(base_dir, 'torso_imgs', '*.png')],
+              code=[extract_torso_and_gt, extract_torso_and_gt_one]),
+        Stage(7, 'landmarks', lambda: extract_landmarks(ori_imgs_dir, workers), deps=['images'],
+              outputs=[os.path.join(ori_imgs_dir, '*.lms')], code=[extract_landmarks]),
+        Stage(8, 'face_tracking', lambda: face_tracking(ori_imgs_dir), deps=['images', 'landmarks'],
+              outputs=[os.path.join(base_dir, 'track_params.pt')], code=[face_tracking],
+              scripts=['data_utils/face_tracking']),
+        Stage(9, 'transforms', lambda: save_transforms(base_dir, ori_imgs_dir), deps=['images', 'face_tracking'],
+              outputs=[os.path.join(base_dir, 'transforms_train.json'), os.path.join(base_dir, 'transforms_val.json')],
+              code=[save_transforms]),
+    ]
+
+
+def load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_cache(cache_path, cache):
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def timed(stage):
+    t = time.perf_counter()
+    stage.fn()
+    return time.perf_counter() - t
+
+
+def run_stages(stages, cache_path, video_digest, jobs=1, force=False):
+    """按依赖关系调度，同时最多运行jobs个步骤。返回[(步骤名, 耗时或None表示跳过)]"""
+    cache = load_cache(cache_path)
+    keys = {}
+    report = []
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for stage in [s for s in pending if all(d in keys for d in s.deps)]:
+                pending.remove(stage)
+                key = stage.key(video_digest, keys)
+                if not force and cache.get(stage.name) == key and stage.done():
+                    print(f'[INFO] ===== skip {stage.name}, inputs unchanged =====')
+                    keys[stage.name] = key
+                    report.append((stage.name, None))
+                    continue
+                running[pool.submit(timed, stage)] = (stage, key)
+            if not running:
+                # 刚跳过的步骤可能让下游步骤就绪
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key = running.pop(future)
+                elapsed = future.result()
+                if not stage.done():
+                    raise RuntimeError(f'stage {stage.name} produced no output')
+                keys[stage.name] = key
+                cache[stage.name] = key
+                save_cache(cache_path, cache)
+                report.append((stage.name, elapsed))
+    return report
+
+
+def print_report(report, total):
+    print(f'[INFO] ===== preprocess timing =====')
+    for name, elapsed in report:
+        print(f'{name:>16}: ' + ('cached' if elapsed is None else f'{elapsed:8.1f}s'))
+    print(f'{"total":>16}: {total:8.1f}s')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('path', type=str, help="path to video file")
     parser.add_argument('--task', type=int, default=-1, help="-1 means all")
     parser.add_argument('--asr', type=str, default='wav2vec', help="wav2vec or deepspeech")
+    parser.add_argument('--jobs', type=int, default=2, help="stages that may run at the same time")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="workers for per-frame stages")
+    parser.add_argument('--force', action='store_true', help="ignore the cache and rerun every stage")
 
     opt = parser.parse_args()
 
@@ -363,40 +552,20 @@ if __name__ == '__main__':
     os.makedirs(gt_imgs_dir, exist_ok=True)
     os.makedirs(torso_imgs_dir, exist_ok=True)
 
-
-    # extract audio
-    if opt.task == -1 or opt.task == 1:
-        extract_audio(opt.path, wav_path)
-
-    # extract audio features
-    if opt.task == -1 or opt.task == 2:
-        extract_audio_features(wav_path, mode=opt.asr)
-
-    # extract images
-    if opt.task == -1 or opt.task == 3:
-        extract_images(opt.path, ori_imgs_dir)
-
-    # face parsing
-    if opt.task == -1 or opt.task == 4:
-        extract_semantics(ori_imgs_dir, parsing_dir)
-
-    # extract bg
-    if opt.task == -1 or opt.task == 5:
-        extract_background(base_dir, ori_imgs_dir)
-
-    # extract torso images and gt_images
-    if opt.task == -1 or opt.task == 6:
-        extract_torso_and_gt(base_dir, ori_imgs_dir)
-
-    # extract face landmarks
-    if opt.task == -1 or opt.task == 7:
-        extract_landmarks(ori_imgs_dir)
-
-    # face tracking
-    if opt.task == -1 or opt.task == 8:
-        face_tracking(ori_imgs_dir)
-
-    # save transforms.json
-    if opt.task == -1 or opt.task == 9:
-        save_transforms(base_dir, ori_imgs_dir)
-
+    stages = build_stages(opt, base_dir, wav_path, ori_imgs_dir, parsing_dir)
+    cache_path = os.path.join(base_dir, 'preprocess_cache.json')
+    t = time.perf_counter()
+    video_digest = file_digest(opt.path)
+    if opt.task == -1:
+        report = run_stages(stages, cache_path, video_digest, jobs=opt.jobs, force=opt.force)
+    else:
+        # 单独指定的步骤总是运行，不检查缓存；它和下游步骤的缓存都作废
+        stage = next(s for s in stages if s.task == opt.task)
+        stale = {stage.name}
+        for s in stages:
+            if stale.intersection(s.deps):
+                stale.add(s.name)
+        cache = {name: key for name, key in load_cache(cache_path).items() if name not in stale}
+        save_cache(cache_path, cache)
+        report = [(stage.name, timed(stage))]
+    print_report(report, time.perf_counter() - t)
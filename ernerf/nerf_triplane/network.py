@@ -29,11 +29,11 @@ class AudioAttNet(nn.Module):
         )
 
     def forward(self, x):
-        # x: [1, seq_len, dim_aud]
-        y = x.permute(0, 2, 1)  # [1, dim_aud, seq_len]
+        # x: [B, seq_len, dim_aud]
+        y = x.permute(0, 2, 1)  # [B, dim_aud, seq_len]
         y = self.attentionConvNet(y) 
-        y = self.attentionNet(y.view(1, self.seq_len)).view(1, self.seq_len, 1)
-        return torch.sum(y * x, dim=1) # [1, dim_aud]
+        y = self.attentionNet(y.view(-1, self.seq_len)).view(-1, self.seq_len, 1)
+        return torch.sum(y * x, dim=1) # [B, dim_aud]
 
 
 # Audio feature extractor
@@ -222,15 +222,24 @@ class NeRFNetwork(NeRFRenderer):
     def encode_audio(self, a):
         # a: [1, 29, 16] or [8, 29, 16], audio features from deepspeech
         # if emb, a should be: [1, 16] or [8, 16]
+        # batched playback: [B, 1/8, 29, 16] --> [B, 64]
 
         # fix audio traininig
         if a is None: return None
 
+        batch = a.shape[0] if a.dim() == (3 if self.emb else 4) else None
+        if batch is not None:
+            a = a.flatten(0, 1)
+
         if self.emb:
             a = self.embedding(a).transpose(-1, -2).contiguous() # [1/8, 29, 16]
 
         enc_a = self.audio_net(a) # [1/8, 64]
 
+        if batch is not None:
+            enc_a = enc_a.view(batch, -1, enc_a.shape[-1]) # [B, 1/8, 64]
+            return self.audio_att_net(enc_a) if self.att > 0 else enc_a[:, 0]
+
         if self.att > 0:
             enc_a = self.audio_att_net(enc_a.unsqueeze(0)) # [1, 64]
             
@@ -282,7 +291,8 @@ class NeRFNetwork(NeRFRenderer):
         if enc_x is None:
             enc_x = self.encode_x(x, bound=self.bound)
 
-        enc_a = enc_a.repeat(enc_x.shape[0], 1)
+        if enc_a.shape[0] != enc_x.shape[0]: # per-point codes when rendering several frames at once
+            enc_a = enc_a.repeat(enc_x.shape[0], 1)
         aud_ch_att = self.aud_ch_att_net(enc_x)
         enc_w = enc_a * aud_ch_att
 
@@ -2,6 +2,7 @@ import os
 import cv2
 import glob
 import json
+import hashlib
 import tqdm
 import numpy as np
 from scipy.spatial.transform import Slerp, Rotation
@@ -13,7 +14,7 @@ import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
-from .utils import get_audio_features, get_rays, get_bg_coords, convert_poses
+from .utils import get_audio_features, get_rays, get_bg_coords, convert_poses, get_ray_directions, get_rays_from_directions
 
 # ref: https://github.com/NVlabs/instant-ngp/blob/b76004c8cf478880227401ae763be4c02f80b62f/include/neural-graphics-primitives/nerf_loader.h#L50
 def nerf_matrix_to_ngp(pose, scale=0.33, offset=[0, 0, 0]):
@@ -99,6 +100,12 @@ class NeRFDataset_Test:
         self.training = False
         self.num_rays = -1
         self.preload = opt.preload # 0 = disk, 1 = cpu, 2 = gpu
+        # playback cache: ray directions are computed once, torso+bg composites are precomputed
+        # per frame in fp16 and memory-mapped from disk, collate only gathers
+        self.use_cache = getattr(opt, 'rays_cache', False)
+        self.cache_bg = self.use_cache and opt.torso_imgs!='' and not opt.torso
+        self.bg_cache = None
+        self.directions = None
 
         # load nerf-compatible format data.
         
@@ -180,7 +187,7 @@ class NeRFDataset_Test:
             if self.opt.torso_imgs!='':
                 torso_img_path = os.path.join(self.opt.torso_imgs, str(f['img_id']) + '.png')
 
-                if self.preload > 0:
+                if self.preload > 0 and not self.cache_bg:
                     torso_img = cv2.imread(torso_img_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
                     torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA)
                     torso_img = torso_img.astype(np.float32) / 255 # [H, W, 3/4]
@@ -190,11 +197,11 @@ class NeRFDataset_Test:
                     self.torso_img.append(torso_img_path)
         
         if self.opt.torso_imgs!='':
-            if self.preload > 0:
+            if self.preload > 0 and not self.cache_bg:
                 self.torso_img = torch.from_numpy(np.stack(self.torso_img, axis=0)) # [N, H, W, C]
             else:
                 self.torso_img = np.array(self.torso_img)
-            if self.preload > 1:  #gpu
+            if self.preload > 1 and not self.cache_bg:  #gpu
                 self.torso_img = self.torso_img.to(torch.half).to(self.device)
             
         
@@ -213,6 +220,9 @@ class NeRFDataset_Test:
 
         self.bg_img = bg_img
 
+        if self.cache_bg:
+            self.bg_cache = self.load_bg_cache(frames)
+
         self.poses = np.stack(self.poses, axis=0)
 
         # smooth camera path...
@@ -272,7 +282,39 @@ class NeRFDataset_Test:
 
         # directly build the coordinate meshgrid in [-1, 1]^2
         self.bg_coords = get_bg_coords(self.H, self.W, self.device) # [1, H*W, 2] in [-1, 1]
-    
+
+        if self.use_cache:
+            self.directions = get_ray_directions(self.intrinsics, self.H, self.W, self.device) # [1, H*W, 3]
+
+    def load_bg_cache(self, frames):
+        # torso composited over bg for every frame, [N, H*W, 3] fp16, rebuilt when inputs change
+        key = hashlib.sha1(json.dumps([self.H, self.W, [f['img_id'] for f in frames]]).encode())
+        # bg is hashed by content: 'white'/'black' and the bc.jpg fallback are all arrays by now
+        key.update(np.ascontiguousarray(self.bg_img).tobytes())
+        for torso_img_path in self.torso_img:
+            st = os.stat(torso_img_path)
+            key.update(f'{os.path.abspath(torso_img_path)}:{st.st_mtime_ns}:{st.st_size}'.encode())
+        cache_path = os.path.join(os.path.dirname(self.opt.pose),
+                                  f'bg_cache_{key.hexdigest()[:12]}.npy')
+        if not os.path.exists(cache_path):
+            tmp_path = cache_path + '.tmp'
+            cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                              shape=(len(self.torso_img), self.H * self.W, 3))
+            for i, torso_img_path in enumerate(tqdm.tqdm(self.torso_img, desc='Building bg cache')):
+                torso_img = cv2.imread(torso_img_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
+                torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA)
+                torso_img = torso_img.astype(np.float32) / 255
+                composed = torso_img[..., :3] * torso_img[..., 3:] + self.bg_img * (1 - torso_img[..., 3:])
+                cache[i] = composed.reshape(-1, 3)
+            cache.flush()
+            del cache
+            os.replace(tmp_path, cache_path)
+        print(f'[INFO] load bg cache {cache_path}')
+        cache = np.load(cache_path, mmap_mode='r')
+        if self.preload > 1:
+            return torch.from_numpy(np.ascontiguousarray(cache)).to(self.device)
+        return cache
+
     def mirror_index(self, index):
         size = self.poses.shape[0]
         turn = index // size
@@ -284,22 +326,27 @@ class NeRFDataset_Test:
 
     def collate(self, index):
 
-        B = len(index) # a list of length 1
-        # assert B == 1
+        B = len(index) # 1, or K consecutive frames in batched playback
 
         results = {}
 
         # audio use the original index
         if self.auds is not None:
-            auds = get_audio_features(self.auds, self.opt.att, index[0]).to(self.device)
+            if B == 1:
+                auds = get_audio_features(self.auds, self.opt.att, index[0]).to(self.device)
+            else:
+                auds = torch.stack([get_audio_features(self.auds, self.opt.att, i) for i in index]).to(self.device)
             results['auds'] = auds
 
         # head pose and bg image may mirror (replay --> <-- --> <--).
-        index[0] = self.mirror_index(index[0])
+        index = [self.mirror_index(i) for i in index]
 
         poses = self.poses[index].to(self.device) # [B, 4, 4]
         
-        rays = get_rays(poses, self.intrinsics, self.H, self.W, self.num_rays, self.opt.patch_size)
+        if self.directions is not None:
+            rays = get_rays_from_directions(poses, self.directions)
+        else:
+            rays = get_rays(poses, self.intrinsics, self.H, self.W, self.num_rays, self.opt.patch_size)
 
         results['index'] = index # for ind. code
         results['H'] = self.H
@@ -313,13 +360,20 @@ class NeRFDataset_Test:
             results['eye'] = None
         
         # load bg
-        if self.opt.torso_imgs!='':
+        if self.bg_cache is not None:
+            bg_img = self.bg_cache[index]
+            if isinstance(bg_img, np.ndarray):
+                bg_img = torch.from_numpy(bg_img)
+            bg_img = bg_img.to(self.device, non_blocking=True)
+        elif self.opt.torso_imgs!='':
             bg_torso_img = self.torso_img[index]
             if self.preload == 0: # on the fly loading
-                bg_torso_img = cv2.imread(bg_torso_img[0], cv2.IMREAD_UNCHANGED) # [H, W, 4]
-                bg_torso_img = cv2.cvtColor(bg_torso_img, cv2.COLOR_BGRA2RGBA)
-                bg_torso_img = bg_torso_img.astype(np.float32) / 255 # [H, W, 3/4]
-                bg_torso_img = torch.from_numpy(bg_torso_img).unsqueeze(0)
+                imgs = []
+                for path in bg_torso_img:
+                    img = cv2.imread(path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
+                    img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+                    imgs.append(img.astype(np.float32) / 255) # [H, W, 3/4]
+                bg_torso_img = torch.from_numpy(np.stack(imgs, axis=0))
             bg_torso_img = bg_torso_img[..., :3] * bg_torso_img[..., 3:] + self.bg_img * (1 - bg_torso_img[..., 3:])
             bg_torso_img = bg_torso_img.view(B, -1, 3).to(self.device)
             if not self.opt.torso:
@@ -340,7 +394,7 @@ class NeRFDataset_Test:
 
         return results
 
-    def dataloader(self):
+    def dataloader(self, batch_size=1):
 
     
         # test with novel auds, then use its length
@@ -350,7 +404,7 @@ class NeRFDataset_Test:
         else:
             size = 2 * self.poses.shape[0]
 
-        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=False, num_workers=0)
+        loader = DataLoader(list(range(size)), batch_size=batch_size, collate_fn=self.collate, shuffle=False, num_workers=0)
         loader._data = self # an ugly fix... we need poses in trainer.
 
         # do evaluate if has gt images and use self-driven setting
@@ -156,12 +156,13 @@ class NeRFRenderer(nn.Module):
 
 
     def run_cuda(self, rays_o, rays_d, auds, bg_coords, poses, eye=None, index=0, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, T_thresh=1e-4, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # rays_o, rays_d: [B, N, 3], B > 1 only at inference (batched playback)
         # auds: [B, 16]
         # index: [B]
         # return: image: [B, N, 3], depth: [B, N]
 
         prefix = rays_o.shape[:-1]
+        B, rays_per_frame = rays_o.shape[0], rays_o.shape[1]
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
         bg_coords = bg_coords.contiguous().view(-1, 2)
@@ -188,10 +189,18 @@ class NeRFRenderer(nn.Module):
         enc_a = self.encode_audio(auds) # [1, 64]
 
         if enc_a is not None and self.smooth_lips:
-            if self.enc_a is not None:
-                _lambda = 0.35
-                enc_a = _lambda * self.enc_a + (1 - _lambda) * enc_a
-            self.enc_a = enc_a
+            # frames of a batch are smoothed in order, same as rendering them one by one
+            smoothed = []
+            for a in enc_a.split(1):
+                if self.enc_a is not None:
+                    _lambda = 0.35
+                    a = _lambda * self.enc_a + (1 - _lambda) * a
+                self.enc_a = a
+                smoothed.append(a)
+            enc_a = torch.cat(smoothed) if B > 1 else smoothed[0]
+
+        if B > 1 and eye is not None and eye.shape[0] == 1:
+            eye = eye.expand(B, -1)
 
         
         if self.individual_dim > 0:
@@ -257,7 +266,12 @@ class NeRFRenderer(nn.Module):
 
                 xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
 
-                sigmas, rgbs, ambients_aud, ambients_eye, uncertainties = self(xyzs, dirs, enc_a, ind_code, eye)
+                if B > 1:
+                    # samples are laid out n_step per alive ray, condition each on its own frame
+                    frame = (rays_alive.long() // rays_per_frame).repeat_interleave(n_step)
+                    sigmas, rgbs, ambients_aud, ambients_eye, uncertainties = self(xyzs, dirs, enc_a[frame], ind_code, None if eye is None else eye[frame])
+                else:
+                    sigmas, rgbs, ambients_aud, ambients_eye, uncertainties = self(xyzs, dirs, enc_a, ind_code, eye)
                 sigmas = self.density_scale * sigmas
 
                 # raymarching.composite_rays_uncertainty(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, ambients, uncertainties, weights_sum, depth, image, ambient_sum, uncertainty_sum, T_thresh)
@@ -269,8 +283,11 @@ class NeRFRenderer(nn.Module):
 
                 step += n_step
             
-        torso_results = self.run_torso(rays_o, bg_coords, poses, index, bg_color)
-        bg_color = torso_results['bg_color']
+        if B > 1:
+            bg_color = torch.cat([self._frame_bg(rays_o, bg_coords, poses, index, bg_color, b, rays_per_frame) for b in range(B)])
+        else:
+            torso_results = self.run_torso(rays_o, bg_coords, poses, index, bg_color)
+            bg_color = torso_results['bg_color']
 
         image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
         image = image.view(*prefix, 3)
@@ -291,6 +308,15 @@ class NeRFRenderer(nn.Module):
         return results
     
 
+    def _frame_bg(self, rays_o, bg_coords, poses, index, bg_color, b, n):
+        # torso + background of frame b in a batch, [n, 3]
+        if torch.is_tensor(bg_color) and bg_color.dim() == 3 and bg_color.shape[0] > 1:
+            bg_color = bg_color[b]
+        bg = self.run_torso(rays_o[b * n:(b + 1) * n], bg_coords, poses[b:b + 1], index, bg_color)['bg_color']
+        if not torch.is_tensor(bg):
+            bg = torch.tensor(bg, device=rays_o.device)
+        return bg.float().reshape(-1, 3) if bg.numel() == n * 3 else bg.float().expand(n, 3)
+
     def run_torso(self, rays_o, bg_coords, poses, index=0, bg_color=None, **kwargs):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
         # auds: [B, 16]
@@ -334,6 +334,35 @@ def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
     return results
 
 
+def get_ray_directions(intrinsics, H, W, device):
+    ''' camera-space unit ray directions of all pixels, same as get_rays with N=-1 before rotation
+    Returns:
+        directions: [1, H*W, 3]
+    '''
+    fx, fy, cx, cy = intrinsics
+    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device))
+    i = i.t().reshape([1, H*W]) + 0.5
+    j = j.t().reshape([1, H*W]) + 0.5
+    zs = torch.ones_like(i)
+    xs = (i - cx) / fx * zs
+    ys = (j - cy) / fy * zs
+    directions = torch.stack((xs, ys, zs), dim=-1)
+    return directions / torch.norm(directions, dim=-1, keepdim=True)
+
+
+def get_rays_from_directions(poses, directions):
+    ''' full-image rays from precomputed directions, only a [B, 3, 3] rotation per frame
+    Args:
+        poses: [B, 4, 4], cam2world
+        directions: [1, N, 3]
+    Returns:
+        rays_o, rays_d: [B, N, 3]
+    '''
+    rays_d = directions @ poses[:, :3, :3].transpose(-1, -2) # (B, N, 3)
+    rays_o = poses[..., :3, 3][..., None, :].expand_as(rays_d) # [B, N, 3]
+    return {'rays_o': rays_o, 'rays_d': rays_d}
+
+
 def seed_everything(seed):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -1175,6 +1204,37 @@ class Trainer(object):
     # [GUI] test with provided data
     def test_gui_with_data(self, data, W, H):
         
+        preds, preds_depth = self.render_data(data)
+
+        # the H/W in data may be differnt to GUI, so we still need to resize...
+        preds = F.interpolate(preds.permute(0, 3, 1, 2), size=(H, W), mode='bilinear').permute(0, 2, 3, 1).contiguous()
+        preds_depth = F.interpolate(preds_depth.unsqueeze(1), size=(H, W), mode='nearest').squeeze(1)
+
+        pred = preds[0].detach().cpu().numpy()
+        pred_depth = preds_depth[0].detach().cpu().numpy()
+
+        outputs = {
+            'image': pred,
+            'depth': pred_depth,
+        }
+
+        return outputs
+
+    def test_gui_batch(self, data, W, H, depth=False):
+        # render all frames of data in one call, image: [B, H, W, 3] uint8 fetched with a single copy
+        preds, preds_depth = self.render_data(data)
+
+        if preds.shape[1:3] != (H, W):
+            preds = F.interpolate(preds.permute(0, 3, 1, 2), size=(H, W), mode='bilinear').permute(0, 2, 3, 1)
+        outputs = {'image': (preds * 255).to(torch.uint8).cpu().numpy()}
+        if depth:
+            outputs['depth'] = F.interpolate(preds_depth.unsqueeze(1), size=(H, W), mode='nearest').squeeze(1).cpu().numpy()
+
+        return outputs
+
+    def render_data(self, data):
+        # preds: [B, h, w, 3] in data resolution, preds_depth: [B, h, w]
+
         self.model.eval()
 
         if self.ema is not None:
@@ -1193,19 +1253,7 @@ class Trainer(object):
         if self.opt.color_space == 'linear':
             preds = linear_to_srgb(preds)
 
-        # the H/W in data may be differnt to GUI, so we still need to resize...
-        preds = F.interpolate(preds.permute(0, 3, 1, 2), size=(H, W), mode='bilinear').permute(0, 2, 3, 1).contiguous()
-        preds_depth = F.interpolate(preds_depth.unsqueeze(1), size=(H, W), mode='nearest').squeeze(1)
-
-        pred = preds[0].detach().cpu().numpy()
-        pred_depth = preds_depth[0].detach().cpu().numpy()
-
-        outputs = {
-            'image': pred,
-            'depth': pred_depth,
-        }
-
-        return outputs
+        return preds, preds_depth
 
     def train_one_epoch(self, loader):
         self.log(f"==> Start Training Epoch {self.epoch}, lr={self.optimizer.param_groups[0]['lr']:.6f} ...")
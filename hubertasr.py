@@ -17,20 +17,21 @@ class HubertASR(BaseASR):
     def run_step(self):
         start_time = time.time()
         
-        for _ in range(self.batch_size * 2):
-            audio_frame, type,eventpoint = self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame, type,eventpoint))
+        self.push_frames(self.batch_size * 2)
         
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
+        if self.window_frames <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames)  # [N * chunk]
+        if self.is_idle():
+            self.put_idle_feat()
+            return
+
+        inputs = self.get_window()  # [N * chunk]
 
         mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
         mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
 
         self.feat_queue.put(mel_chunks)
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        self.trim_window()
         #print(f"Processing audio costs {(time.time() - start_time) * 1000}ms")
 
@@ -0,0 +1,241 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 静音循环和自定义视频(set_audiotype)的预编码包。这些循环按mirror_index正放+倒放，
+# 周期为2N帧，这里把这2N帧编码成H264/VP8包，webrtc发送时直接打包发出，
+# 省掉每帧bgr->yuv转换和编码。编码参数与aiortc的编码器保持一致。
+# 可以离线预编码，保存到图片目录旁边的 <imgdir>.packets/<codec>.npz，运行时直接加载；
+# 没有离线结果时在后台线程里编码。
+# python idleloop.py --avatar_id wav2lip256_avatar1 --customvideo_config data/custom_config.json
+
+import argparse
+import fractions
+import glob
+import os
+from threading import Thread, Lock
+
+import av
+import cv2
+import numpy as np
+from av import VideoFrame
+
+import avatarpack
+from logger import logger
+
+DEFAULT_BITRATE = 1000000  # aiortc默认码率
+DEFAULT_GOP = 25  # 1秒一个关键帧，也就是可切入的位置
+VIDEO_FPS = 25
+
+_CODECS = {
+    'h264': 'libx264',
+    'vp8': 'libvpx',
+}
+
+_loops = {}
+_loops_lock = Lock()
+
+
+def mirror_index(size, index):
+    turn = index // size
+    res = index % size
+    if turn % 2 == 0:
+        return res
+    else:
+        return size - res - 1
+
+
+def packets_path(imgdir, codec):
+    return os.path.join(os.path.normpath(imgdir) + '.packets', f'{codec}.npz')
+
+
+def list_imgs(imgdir):
+    img_list = glob.glob(os.path.join(imgdir, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+
+class PacketLoop:
+    """nframes帧按mirror_index展开后的2N帧编码结果，packets[i]对应第i帧"""
+    def __init__(self, nframes, codec='h264', bitrate=DEFAULT_BITRATE, gop=DEFAULT_GOP):
+        self.nframes = nframes
+        self.codec = codec
+        self.bitrate = bitrate
+        self.gop = gop
+        self.length = 2 * nframes
+        self.packets = []
+        self.keyframes = []
+        self.ready = False
+
+    def encode(self, frames):
+        height, width = frames[0].shape[:2]
+        codec = av.CodecContext.create(_CODECS[self.codec], 'w')
+        codec.width = width
+        codec.height = height
+        codec.bit_rate = self.bitrate
+        codec.pix_fmt = 'yuv420p'
+        codec.framerate = fractions.Fraction(VIDEO_FPS, 1)
+        codec.time_base = fractions.Fraction(1, VIDEO_FPS)
+        codec.gop_size = self.gop
+        if self.codec == 'h264':
+            codec.options = {'profile': 'baseline', 'level': '31', 'tune': 'zerolatency'}
+        else:
+            codec.options = {'deadline': 'realtime', 'lag-in-frames': '0'}
+        codec.open()
+
+        packets = []
+        for i in range(self.length):
+            frame = VideoFrame.from_ndarray(frames[mirror_index(self.nframes, i)], format='bgr24')
+            frame.pts = i
+            packets.extend(codec.encode(frame))
+        packets.extend(codec.encode(None))
+        if len(packets) != self.length or not packets[0].is_keyframe:
+            # 编码器有延迟帧时无法一一对应，放弃预编码
+            logger.warning(f'packet loop {self.codec}: got {len(packets)} packets for {self.length} frames, disabled')
+            return
+        self.packets = [bytes(p) for p in packets]
+        self.keyframes = [p.is_keyframe for p in packets]
+        self.ready = True
+        logger.info(f'packet loop {self.codec} encoded: {self.length} frames, '
+                    f'{sum(len(p) for p in self.packets)/1024/1024:.1f}MB')
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        sizes = np.array([len(p) for p in self.packets], dtype=np.int64)
+        np.savez(path,
+                 data=np.frombuffer(b''.join(self.packets), dtype=np.uint8),
+                 offsets=np.concatenate([[0], np.cumsum(sizes)]),
+                 keyframes=np.array(self.keyframes, dtype=bool),
+                 meta=np.array([self.nframes, self.bitrate, self.gop], dtype=np.int64))
+
+    def load(self, path):
+        with np.load(path) as f:
+            nframes, bitrate, gop = f['meta'].tolist()
+            if nframes != self.nframes:
+                logger.warning(f'{path}: encoded for {nframes} frames but got {self.nframes}, ignored')
+                return False
+            data = f['data'].tobytes()
+            offsets = f['offsets'].tolist()
+            self.keyframes = f['keyframes'].tolist()
+        self.packets = [data[offsets[i]:offsets[i+1]] for i in range(self.length)]
+        self.bitrate = bitrate
+        self.gop = gop
+        self.ready = True
+        logger.info(f'packet loop {self.codec} loaded from {path}: {self.length} frames')
+        return True
+
+    def is_keyframe(self, index):
+        return self.ready and self.keyframes[index % self.length]
+
+    def packet(self, index):
+        return av.Packet(self.packets[index % self.length])
+
+
+def get_packet_loop(frames, codec, imgdir=None):
+    """每个进程、每套循环帧、每种编码只准备一次。imgdir下有离线预编码结果时直接加载，
+    否则后台编码，编码完成前返回的loop.ready为False"""
+    codec = (codec or '').lower()
+    if codec not in _CODECS or not frames:
+        return None
+    key = (imgdir or id(frames), codec)
+    loop = _loops.get(key)
+    if loop is not None:
+        return loop
+    with _loops_lock:
+        loop = _loops.get(key)
+        if loop is None:
+            loop = PacketLoop(len(frames), codec)
+            path = packets_path(imgdir, codec) if imgdir else None
+            if path is None or not os.path.exists(path) or not loop.load(path):
+                Thread(target=_encode, args=(loop, frames), daemon=True).start()
+            _loops[key] = loop
+    return loop
+
+
+def has_packets(imgdir, codec=None):
+    """imgdir有codec的离线预编码包。codec为None时要求每种编码都有，
+    用于还不知道会话会协商出哪种编码的时候"""
+    codecs = [codec.lower()] if codec else list(_CODECS)
+    return all(os.path.exists(packets_path(imgdir, c)) for c in codecs)
+
+
+def _encode(loop, frames):
+    try:
+        loop.encode(frames)
+    except Exception:
+        logger.exception('packet loop encode')
+
+
+class PacketSplicer:
+    """决定某一帧是否可以用预编码包代替：只在关键帧处切入，切入后连续发同一个循环的包。
+    一旦有一帧不用包(说话/过渡)或换了循环(静音<->自定义视频)，要等到关键帧才能再切入"""
+    def __init__(self):
+        self.active = None
+
+    def get(self, loop, index):
+        if loop is None or not loop.ready:
+            self.active = None
+            return None
+        if self.active is not loop:
+            if not loop.is_keyframe(index):
+                self.active = None
+                return None
+            self.active = loop
+        return loop.packet(index)
+
+    def stop(self):
+        self.active = None
+
+
+def encode_dir(imgdir, codecs, bitrate, gop):
+    img_list = list_imgs(imgdir)
+    avatar_path = os.path.dirname(os.path.normpath(imgdir))
+    if img_list:
+        logger.info(f'{imgdir}: reading {len(img_list)} images...')
+        frames = [cv2.imread(p) for p in img_list]
+    elif avatarpack.is_packed(avatar_path): #wav2lip打包格式，full_imgs目录不存在
+        logger.info(f'{avatar_path}: reading packed frames...')
+        frames = avatarpack.read_full_imgs(avatar_path)
+    else:
+        logger.warning(f'{imgdir}: no images')
+        return
+    for codec in codecs:
+        loop = PacketLoop(len(frames), codec, bitrate, gop)
+        loop.encode(frames)
+        if loop.ready:
+            path = packets_path(imgdir, codec)
+            loop.save(path)
+            logger.info(f'saved {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avatar_id', type=str, default='', help="encode data/avatars/<avatar_id>/full_imgs")
+    parser.add_argument('--customvideo_config', type=str, default='', help="encode every imgpath in the config")
+    parser.add_argument('--imgdir', type=str, nargs='*', default=[], help="extra image directories")
+    parser.add_argument('--codec', type=str, nargs='+', default=['h264', 'vp8'], choices=list(_CODECS))
+    parser.add_argument('--bitrate', type=int, default=DEFAULT_BITRATE)
+    parser.add_argument('--gop', type=int, default=DEFAULT_GOP, help="keyframe interval, packets are only spliced in at keyframes")
+    opt = parser.parse_args()
+
+    imgdirs = list(opt.imgdir)
+    if opt.avatar_id:
+        imgdirs.append(f'./data/avatars/{opt.avatar_id}/full_imgs')
+    if opt.customvideo_config:
+        import json
+        with open(opt.customvideo_config, 'r') as file:
+            imgdirs += [item['imgpath'] for item in json.load(file)]
+    for imgdir in imgdirs:
+        encode_dir(imgdir, opt.codec, opt.bitrate, opt.gop)
@@ -0,0 +1,131 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 启动导入耗时报告，基于 python -X importtime。按--model/--tts/--transport导入
+# app.py在这组参数下实际会用到的模块，分别统计app本身和全部模块的耗时，列出最慢的顶层导入。
+# python importtime.py --model wav2lip --tts edgetts --transport webrtc
+# 作为回归基准：先 --save importtime.json，改动后 --baseline importtime.json，变慢超过阈值时返回非0
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+MODEL_MODULES = {
+    'wav2lip': ['lipreal'],
+    'musetalk': ['musereal'],
+    'ultralight': ['lightreal'],
+    'ernerf': ['nerfreal'],
+}
+# tts在第一次合成时才导入的库
+TTS_MODULES = {
+    'edgetts': ['edge_tts', 'soundfile', 'resampy'],
+    'gpt-sovits': ['requests', 'soundfile', 'resampy'],
+    'xtts': ['requests', 'soundfile', 'resampy'],
+    'cosyvoice': ['requests', 'soundfile', 'resampy'],
+    'fishtts': ['requests', 'soundfile', 'resampy'],
+    'tencent': ['requests', 'soundfile', 'resampy'],
+}
+TRANSPORT_MODULES = {
+    'webrtc': ['aiortc', 'webrtc'],
+    'rtcpush': ['aiortc', 'webrtc'],
+    'rtmp': [],
+}
+
+LINE_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+def measure(modules):
+    """在新进程里导入modules，返回[(模块名, self us, cumulative us, 深度)]"""
+    code = '; '.join(f'import {m}' for m in modules)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise SystemExit(f'import failed:\n{proc.stderr[-2000:]}')
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = LINE_RE.match(line)
+        if m:
+            entries.append((m.group(4), int(m.group(1)), int(m.group(2)), (len(m.group(3)) - 1) // 2))
+    return entries
+
+
+def total_ms(entries):
+    return sum(cum for _, _, cum, depth in entries if depth == 0) / 1000
+
+
+def best_of(modules, runs):
+    # 取耗时最少的一次，减小磁盘缓存和系统负载的影响
+    return min((measure(modules) for _ in range(runs)), key=total_ms)
+
+
+def report(opt):
+    startup = ['app'] + MODEL_MODULES[opt.model]
+    full = startup + TTS_MODULES[opt.tts] + TRANSPORT_MODULES[opt.transport]
+    app_entries = best_of(['app'], opt.runs)
+    startup_entries = best_of(startup, opt.runs)
+    full_entries = best_of(full, opt.runs)
+
+    result = {
+        'model': opt.model, 'tts': opt.tts, 'transport': opt.transport,
+        'app_ms': round(total_ms(app_entries), 1),
+        'startup_ms': round(total_ms(startup_entries), 1),
+        'full_ms': round(total_ms(full_entries), 1),
+    }
+    print(f"import app: {result['app_ms']:.1f}ms")
+    print(f"import app + {opt.model}: {result['startup_ms']:.1f}ms")
+    print(f"+ tts {opt.tts} + transport {opt.transport}: {result['full_ms']:.1f}ms")
+    print(f"\ntop {opt.top} top-level imports (cumulative):")
+    top = sorted((e for e in full_entries if e[3] == 0), key=lambda e: -e[2])[:opt.top]
+    for name, _, cum, _ in top:
+        print(f'{cum/1000:>10.1f}ms  {name}')
+    return result
+
+
+def check(result, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    failed = False
+    for key in ('app_ms', 'startup_ms', 'full_ms'):
+        limit = baseline[key] * (1 + tolerance)
+        status = 'ok'
+        if result[key] > limit:
+            status = 'REGRESSION'
+            failed = True
+        print(f'{key}: {result[key]:.1f}ms, baseline {baseline[key]:.1f}ms, limit {limit:.1f}ms  {status}')
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='wav2lip', choices=list(MODEL_MODULES))
+    parser.add_argument('--tts', type=str, default='edgetts', choices=list(TTS_MODULES))
+    parser.add_argument('--transport', type=str, default='rtcpush', choices=list(TRANSPORT_MODULES))
+    parser.add_argument('--runs', type=int, default=3, help="take the fastest of N fresh interpreters")
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--save', type=str, default='', help="write the result as a baseline json")
+    parser.add_argument('--baseline', type=str, default='', help="compare with a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown vs baseline")
+    opt = parser.parse_args()
+
+    result = report(opt)
+    if opt.save:
+        with open(opt.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if opt.baseline and not check(result, opt.baseline, opt.tolerance):
+        sys.exit(1)
@@ -34,9 +34,11 @@ import torch.multiprocessing as mp
 
 
 from hubertasr import HubertASR
-import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from ringqueue import RingQueue
+from compiled import compile_model, default_buckets
+from weights import load_weights
 
 #from imgcache import ImgCache
 
@@ -48,13 +50,11 @@ import cv2
 import torch
 import numpy as np
 import torch.nn as nn
-from torch import optim
 from tqdm import tqdm
-from transformers import Wav2Vec2Processor, HubertModel
-from torch.utils.data import DataLoader
 from ultralight.unet import Model
 from ultralight.audio2feature import Audio2Feature
 from logger import logger
+import metrics
 
 device = "cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu")
 print('Using {} for inference.'.format(device))
@@ -63,14 +63,19 @@ def load_model(opt):
     audio_processor = Audio2Feature()
     return audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id, backend='torch'):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl" 
     
-    model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
-    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+    if backend in ('onnx', 'int8'):
+        from onnxbackend import OrtModel, backend_file
+        model = OrtModel(backend_file(f"{avatar_path}/ultralight", backend))
+    else:
+        model = Model(6, 'hubert')  # 假设Model是你自定义的类
+        load_weights(model, f"{avatar_path}/ultralight.pth") #有ultralight.safetensors时内存映射加载
+        model = model.to(device)
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
@@ -81,17 +86,34 @@ def load_avatar(avatar_id):
     input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
+    face_tensor = build_face_tensor(face_list_cycle)
+
+    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle,face_tensor
 
-    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
+@torch.no_grad()
+def build_face_tensor(face_list_cycle):
+    # 模型的图像输入与音频无关，一次性算好放在device上：[N,6,160,160]，
+    # 前3通道为人脸中间160x160，后3通道为嘴部区域涂黑的同一区域，已归一化到0~1
+    faces = np.empty((len(face_list_cycle), 6, 160, 160), dtype=np.uint8)
+    for i, crop_img in enumerate(face_list_cycle):
+        img_real_ex = crop_img[4:164, 4:164]
+        img_masked = cv2.rectangle(img_real_ex.copy(),(5,5,150,145),(0,0,0),-1)
+        faces[i, :3] = img_real_ex.transpose(2,0,1)
+        faces[i, 3:] = img_masked.transpose(2,0,1)
+    return torch.from_numpy(faces).to(device).float().div_(255.0) #uint8上传，减少传输量
 
 
 @torch.no_grad()
-def warm_up(batch_size,avatar,modelres):
+def warm_up(batch_size,avatar,modelres,compile_mode='none',buckets=None):
+    # 预热函数，compile_mode不为none时返回换成编译后模型的avatar
     logger.info('warmup model...')
-    model,_,_,_ = avatar
+    model = compile_model(avatar[0], 'ultralight',
+                          lambda bs: (torch.ones(bs, 6, modelres, modelres).to(device), torch.ones(bs, 32, 32, 32).to(device)),
+                          buckets or default_buckets(batch_size), compile_mode)
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
+    return (model,) + tuple(avatar[1:])
 
 def read_imgs(img_list):
     frames = []
@@ -145,11 +167,17 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
-    length = len(face_list_cycle)
+def inference(quit_event, batch_size, face_tensor, audio_feat_queue, audio_out_queue, res_frame_queue, model):
+    length = face_tensor.shape[0]
+    # 一个镜像周期(2N帧)内每帧对应的人脸下标，每批只在device上做一次index_select
+    mirror_indices = torch.tensor([__mirror_index(length,i) for i in range(2*length)], device=face_tensor.device)
+    batch_offsets = torch.arange(batch_size, device=face_tensor.device)
     index = 0
     count = 0
     counttime = 0
+    infer_seconds = metrics.INFER_BATCH_SECONDS.labels('ultralight')
+    silent_batches = metrics.INFER_BATCHES.labels('ultralight', 'silent')
+    speaking_batches = metrics.INFER_BATCHES.labels('ultralight', 'speaking')
     logger.info('start inference')
 
     while not quit_event.is_set():
@@ -158,50 +186,27 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type_,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type_,eventpoint))
-            if type_==0:
-                is_all_silence=False
-        if is_all_silence:
+        audio_frames = audio_out_queue.read(batch_size*2)
+        is_all_silence = audio_frames.is_silent()
+        if is_all_silence or mel_batch is None: #mel_batch为None表示asr处于空闲模式，没有提取特征
+            silent_batches.inc()
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((None,__mirror_index(length,index),audio_frames.part(i*2,2)))
                 index = index + 1
         else:
             t = time.perf_counter()
-            img_batch = []
-
-            for i in range(batch_size):
-                idx = __mirror_index(length, index + i)
-                #face = face_list_cycle[idx]
-                crop_img = face_list_cycle[idx] #face[ymin:ymax, xmin:xmax]
-#                h, w = crop_img.shape[:2]
-                #crop_img = cv2.resize(crop_img, (168, 168), cv2.INTER_AREA)
-                #crop_img_ori = crop_img.copy()
-                img_real_ex = crop_img[4:164, 4:164].copy()
-                img_real_ex_ori = img_real_ex.copy()
-                img_masked = cv2.rectangle(img_real_ex_ori,(5,5,150,145),(0,0,0),-1)
-    
-                img_masked = img_masked.transpose(2,0,1).astype(np.float32)
-                img_real_ex = img_real_ex.transpose(2,0,1).astype(np.float32)
-    
-                img_real_ex_T = torch.from_numpy(img_real_ex / 255.0)
-                img_masked_T = torch.from_numpy(img_masked / 255.0)
-                img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
-                img_batch.append(img_concat_T)
-
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
-            mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
-            img_batch = torch.stack(img_batch).squeeze(1)
-
+            img_batch = face_tensor.index_select(0, mirror_indices[(batch_offsets + index) % (2*length)])
+            # mel_batch为[batch_size, 32, 1024]的连续数组
+            mel_batch = torch.from_numpy(mel_batch).view(-1, 32, 32, 32).to(face_tensor.device)
 
             with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
+                pred = model(img_batch, mel_batch)
             pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 
-            counttime += (time.perf_counter() - t)
+            dt = time.perf_counter() - t
+            counttime += dt
+            infer_seconds.observe(dt)
+            speaking_batches.inc()
             count += batch_size
             if count >= 100:
                 logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
@@ -209,7 +214,7 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
                 counttime = 0
             for i,res_frame in enumerate(pred):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames.part(i*2,2)))
                 index = index + 1
 
 #            for i, pred_frame in enumerate(pred):
@@ -234,10 +239,10 @@ class LightReal(BaseReal):
         
         self.batch_size = opt.batch_size
         self.idx = 0
-        self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
+        self.res_frame_queue = RingQueue(self.batch_size*2)
         #self.__loadavatar()
         audio_processor = model
-        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensor = avatar
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -250,23 +255,30 @@ class LightReal(BaseReal):
 
    
     def process_frames(self,quit_event,loop=None,audio_track=None,video_track=None):
-        
+        frame_index = -1 #与inference中的index一致
         while not quit_event.is_set():
             try:
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
-            if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
+            frame_index += 1
+            packet = None
+            if audio_frames.is_silent(): #全为静音数据，只需要取fullimg
                 self.speaking = False
-                audiotype = audio_frames[0][1]
+                audiotype = int(audio_frames.types[0])
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
                     mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
-                    combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    packet = self.get_custom_packet(audiotype, self.custom_index[audiotype])
+                    if packet is None or self.recording:
+                        combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    else:
+                        combine_frame = None #发预编码包，不需要原始帧
                     self.custom_index[audiotype] += 1
                     # if not self.custom_opt[audiotype].loop and self.custom_index[audiotype]>=len(self.custom_img_cycle[audiotype]):
                     #     self.curr_state = 1  #当前视频不循环播放，切换到静音状态
                 else:
                     combine_frame = self.frame_list_cycle[idx]
+                    packet = self.get_idle_packet(frame_index, idx)
                     #combine_frame = self.imagecache.get_img(idx)
             else:
                 self.speaking = True
@@ -285,20 +297,22 @@ class LightReal(BaseReal):
                 combine_frame[y1:y2, x1:x2] = crop_img_ori
                 #print('blending time:',time.perf_counter()-t)
 
-            new_frame = VideoFrame.from_ndarray(combine_frame, format="bgr24")
-            asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+            if packet is not None: #静音循环直接发预编码包
+                video_track._queue.put((packet,None))
+            else:
+                self.idle_splicer.stop()
+                new_frame = VideoFrame.from_ndarray(combine_frame, format="bgr24")
+                video_track._queue.put((new_frame,None))
             self.record_video_data(combine_frame)
 
-            for audio_frame in audio_frames:
-                frame,type_,eventpoint = audio_frame
-                frame = (frame * 32767).astype(np.int16)
+            audio_out = []
+            for frame,type_,eventpoint in audio_frames: #int16，read()时整批转换
                 new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                 new_frame.planes[0].update(frame.tobytes())
                 new_frame.sample_rate=16000
-                # if audio_track._queue.qsize()>10:
-                #     time.sleep(0.1)
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                audio_out.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
+            audio_track._queue.put_many(audio_out) #一个视频帧的两帧音频一次交给aiortc
                 #self.notify(eventpoint)
         logger.info('lightreal process_frames thread stop') 
             
@@ -310,7 +324,7 @@ class LightReal(BaseReal):
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+        Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensor,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
                                            self.model,)).start()  #mp.Process
         
 
@@ -30,17 +30,17 @@ class LipASR(BaseASR):
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
-        # get a frame of audio
-        for _ in range(self.batch_size*2):
-            frame,type,eventpoint = self.get_audio_frame()
-            self.frames.append(frame)
-            # put to output
-            self.output_queue.put((frame,type,eventpoint))
+        # get audio frames, put to output
+        self.push_frames(self.batch_size*2)
         # context not enough, do not run network.
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
+        if self.window_frames <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        if self.is_idle():
+            self.put_idle_feat()
+            return
+
+        inputs = self.get_window() # [N * chunk]
         mel = audio.melspectrogram(inputs)
         #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
         # cut off stride
@@ -50,7 +50,7 @@ class LipASR(BaseASR):
         mel_step_size = 16
         i = 0
         mel_chunks = []
-        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
+        while i < (self.window_frames-self.stride_left_size-self.stride_right_size)/2:
             start_idx = int(left + i * mel_idx_multiplier)
             #print(start_idx)
             if start_idx + mel_step_size > len(mel[0]):
@@ -60,5 +60,5 @@ class LipASR(BaseASR):
             i += 1
         self.feat_queue.put(mel_chunks)
         
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        # discard the old part
+        self.trim_window()
@@ -34,36 +34,30 @@ import torch.multiprocessing as mp
 
 
 from lipasr import LipASR
-import asyncio
 from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
 from basereal import BaseReal
+from ringqueue import RingQueue
+import avatarpack
+from compiled import compile_model, default_buckets
+from weights import load_weights
 
 #from imgcache import ImgCache
 
 from tqdm import tqdm
 from logger import logger
+import metrics
 
 device = "cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu")
 print('Using {} for inference.'.format(device))
 
-def _load(checkpoint_path):
-	if device == 'cuda':
-		checkpoint = torch.load(checkpoint_path) #,weights_only=True
-	else:
-		checkpoint = torch.load(checkpoint_path,
-								map_location=lambda storage, loc: storage)
-	return checkpoint
-
-def load_model(path):
+def load_model(path, backend='torch'):
+	if backend in ('onnx', 'int8'):
+		from onnxbackend import OrtModel, backend_file
+		return OrtModel(backend_file(os.path.splitext(path)[0], backend))
 	model = Wav2Lip()
 	logger.info("Load checkpoint from: {}".format(path))
-	checkpoint = _load(path)
-	s = checkpoint["state_dict"]
-	new_s = {}
-	for k, v in s.items():
-		new_s[k.replace('module.', '')] = v
-	model.load_state_dict(new_s)
+	load_weights(model, path) #有wav2lip.safetensors时内存映射加载
 
 	model = model.to(device)
 	return model.eval()
@@ -76,6 +70,10 @@ def load_avatar(avatar_id):
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
+    if avatarpack.is_packed(avatar_path): #genavatar.py生成的打包格式
+        frame_list_cycle = avatarpack.read_full_imgs(avatar_path)
+        face_tensor = build_face_tensor(avatarpack.load_faces(avatar_path))
+        return frame_list_cycle,face_tensor,coord_list_cycle
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     frame_list_cycle = read_imgs(input_img_list)
@@ -83,16 +81,31 @@ def load_avatar(avatar_id):
     input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
+    face_tensor = build_face_tensor(face_list_cycle)
+
+    return frame_list_cycle,face_tensor,coord_list_cycle
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+@torch.no_grad()
+def build_face_tensor(face_list_cycle, dtype=torch.float32):
+    # 模型的图像输入与音频无关，一次性算好放在device上：[N,6,H,W]，
+    # 前3通道为下半脸置零的人脸，后3通道为原人脸，已归一化到0~1
+    faces = torch.from_numpy(np.stack(face_list_cycle)).to(device) #uint8上传，减少传输量
+    faces = faces.permute(0, 3, 1, 2).to(dtype).div_(255.)
+    masked = faces.clone()
+    masked[:, :, faces.shape[2]//2:] = 0
+    return torch.cat((masked, faces), dim=1).contiguous()
 
 @torch.no_grad()
-def warm_up(batch_size,model,modelres):
-    # 预热函数
+def warm_up(batch_size,model,modelres,compile_mode='none',buckets=None):
+    # 预热函数，compile_mode不为none时返回编译后的模型
     logger.info('warmup model...')
+    model = compile_model(model, 'wav2lip',
+                          lambda bs: (torch.ones(bs, 1, 80, 16).to(device), torch.ones(bs, 6, modelres, modelres).to(device)),
+                          buckets or default_buckets(batch_size), compile_mode)
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
     model(mel_batch, img_batch)
+    return model
 
 def read_imgs(img_list):
     frames = []
@@ -111,7 +124,7 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def inference(quit_event,batch_size,face_tensor,audio_feat_queue,audio_out_queue,res_frame_queue,model):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -119,10 +132,16 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     # face_list_cycle = read_imgs(input_face_list)
     
     #input_latent_list_cycle = torch.load(latents_out_path)
-    length = len(face_list_cycle)
+    length = face_tensor.shape[0]
+    # 一个镜像周期(2N帧)内每帧对应的人脸下标，每批只在device上做一次index_select
+    mirror_indices = torch.tensor([__mirror_index(length,i) for i in range(2*length)], device=device)
+    batch_offsets = torch.arange(batch_size, device=device)
     index = 0
     count=0
     counttime=0
+    infer_seconds = metrics.INFER_BATCH_SECONDS.labels('wav2lip')
+    silent_batches = metrics.INFER_BATCHES.labels('wav2lip', 'silent')
+    speaking_batches = metrics.INFER_BATCHES.labels('wav2lip', 'speaking')
     logger.info('start inference')
     while not quit_event.is_set():
         starttime=time.perf_counter()
@@ -132,42 +151,28 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
         except queue.Empty:
             continue
             
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
+        audio_frames = audio_out_queue.read(batch_size*2)
+        is_all_silence = audio_frames.is_silent()
 
-        if is_all_silence:
+        if is_all_silence or mel_batch is None: #mel_batch为None表示asr处于空闲模式，没有提取特征
+            silent_batches.inc()
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((None,__mirror_index(length,index),audio_frames.part(i*2,2)))
                 index = index + 1
         else:
             # print('infer=======')
             t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-            
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+            img_batch = face_tensor.index_select(0, mirror_indices[(batch_offsets + index) % (2*length)])
+            mel_batch = torch.from_numpy(np.asarray(mel_batch, dtype=np.float32)).unsqueeze(1).to(device)
 
             with torch.no_grad():
                 pred = model(mel_batch, img_batch)
             pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 
-            counttime += (time.perf_counter() - t)
+            dt = time.perf_counter() - t
+            counttime += dt
+            infer_seconds.observe(dt)
+            speaking_batches.inc()
             count += batch_size
             #_totalframe += 1
             if count>=100:
@@ -176,7 +181,7 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
                 counttime=0
             for i,res_frame in enumerate(pred):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames.part(i*2,2)))
                 index = index + 1
             #print('total batch time:',time.perf_counter()-starttime)            
     logger.info('lipreal inference processor stop')
@@ -193,10 +198,10 @@ class LipReal(BaseReal):
         
         self.batch_size = opt.batch_size
         self.idx = 0
-        self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
+        self.res_frame_queue = RingQueue(self.batch_size*2)
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.frame_list_cycle,self.face_tensor,self.coord_list_cycle = avatar
 
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
@@ -208,23 +213,30 @@ class LipReal(BaseReal):
 
    
     def process_frames(self,quit_event,loop=None,audio_track=None,video_track=None):
-        
+        frame_index = -1 #与inference中的index一致
         while not quit_event.is_set():
             try:
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
-            if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
+            frame_index += 1
+            packet = None
+            if audio_frames.is_silent(): #全为静音数据，只需要取fullimg
                 self.speaking = False
-                audiotype = audio_frames[0][1]
+                audiotype = int(audio_frames.types[0])
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
                     mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
-                    combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    packet = self.get_custom_packet(audiotype, self.custom_index[audiotype])
+                    if packet is None or self.recording:
+                        combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    else:
+                        combine_frame = None #发预编码包，不需要原始帧
                     self.custom_index[audiotype] += 1
                     # if not self.custom_opt[audiotype].loop and self.custom_index[audiotype]>=len(self.custom_img_cycle[audiotype]):
                     #     self.curr_state = 1  #当前视频不循环播放，切换到静音状态
                 else:
                     combine_frame = self.frame_list_cycle[idx]
+                    packet = self.get_idle_packet(frame_index, idx)
                     #combine_frame = self.imagecache.get_img(idx)
             else:
                 self.speaking = True
@@ -242,20 +254,22 @@ class LipReal(BaseReal):
                 #print('blending time:',time.perf_counter()-t)
 
             image = combine_frame #(outputs['image'] * 255).astype(np.uint8)
-            new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-            asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+            if packet is not None: #静音循环直接发预编码包
+                video_track._queue.put((packet,None))
+            else:
+                self.idle_splicer.stop()
+                new_frame = VideoFrame.from_ndarray(image, format="bgr24")
+                video_track._queue.put((new_frame,None))
             self.record_video_data(image)
 
-            for audio_frame in audio_frames:
-                frame,type,eventpoint = audio_frame
-                frame = (frame * 32767).astype(np.int16)
+            audio_out = []
+            for frame,type,eventpoint in audio_frames: #int16，read()时整批转换
                 new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                 new_frame.planes[0].update(frame.tobytes())
                 new_frame.sample_rate=16000
-                # if audio_track._queue.qsize()>10:
-                #     time.sleep(0.1)
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                audio_out.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
+            audio_track._queue.put_many(audio_out) #一个视频帧的两帧音频一次交给aiortc
                 #self.notify(eventpoint)
         logger.info('lipreal process_frames thread stop') 
             
@@ -268,7 +282,7 @@ class LipReal(BaseReal):
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
+        Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensor,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
                                            self.model,)).start()  #mp.Process
 
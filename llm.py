@@ -2,10 +2,14 @@ import time
 import os
 import requests
 import json
-from basereal import BaseReal
+from typing import TYPE_CHECKING
 from logger import logger
+import metrics
 
-def llm_response(message, nerfreal: BaseReal, model_name="llama3", ollama_url="http://localhost:11434"):
+if TYPE_CHECKING:
+    from basereal import BaseReal
+
+def llm_response(message, nerfreal: "BaseReal", model_name="llama3", ollama_url="http://localhost:11434"):
     """
     使用本地Ollama模型处理用户消息并将结果发送到数字人
     
@@ -58,6 +62,7 @@ def llm_response(message, nerfreal: BaseReal, model_name="llama3", ollama_url="h
                         if first:
                             end = time.perf_counter()
                             logger.info(f"llm Time to first chunk: {end-start}s")
+                            metrics.LLM_FIRST_TOKEN_SECONDS.observe(end-start)
                             first = False
                         
                         lastpos = 0
@@ -90,7 +95,7 @@ def llm_response(message, nerfreal: BaseReal, model_name="llama3", ollama_url="h
         return error_msg    
     
 
-def ragflow_response(message, nerfreal : BaseReal, ragflow_url = "http://localhost:8080", agent_id = "a4cf97b82a3311f0b9a9529bb6126436"):
+def ragflow_response(message, nerfreal: "BaseReal", ragflow_url = "http://localhost:8080", agent_id = "a4cf97b82a3311f0b9a9529bb6126436"):
     '''调用ragflow接口，'''
     from ragflow.ragflow import rag_client
     import asyncio
@@ -109,14 +114,19 @@ def ragflow_response(message, nerfreal : BaseReal, ragflow_url = "http://localho
         
         msg = "" # 流式响应收到的总消息
         lastpos = 0
+        first = True
+        start = time.perf_counter()
         
         # 使用异步迭代器处理响应
         async def process_response():
-            nonlocal msg, lastpos
+            nonlocal msg, lastpos, first
             try:
                 async for chunk in async_gen:
                     chunk_data = json.loads(chunk)
                     if chunk_data["type"] == "text":
+                        if first:
+                            metrics.LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter()-start)
+                            first = False
                         msg = chunk_data["content"]
                         result = msg[lastpos:]
                         nerfreal.put_msg_txt(result) 
@@ -0,0 +1,217 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# prometheus文本格式的运行时指标，不依赖prometheus_client。
+# 热路径上只做属性自增(无锁，依赖GIL，极端并发下可能丢少量计数)，
+# 队列深度、会话数、RSS等在抓取时通过回调读取，不占用推理线程的时间。
+
+import asyncio
+import os
+import time
+from bisect import bisect_left
+
+from logger import logger
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+_collectors = []
+
+
+def _fmt_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        _metrics.append(self)
+
+    def labels(self, *labelvalues):
+        # 热路径上应在模块加载时取好child，避免每次查字典
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labelvalues, child in list(self._children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, labelvalues))
+        return lines
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labelnames, labelvalues):
+        return [f'{name}{_fmt_labels(labelnames, labelvalues)} {self.value}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._children[()].value = value
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labelnames, labelvalues):
+        lines = []
+        acc = 0
+        for bound, count in zip(self.buckets, self.counts):
+            acc += count
+            lines.append(f'{name}_bucket{_fmt_labels(labelnames, labelvalues, ("le", bound))} {acc}')
+        acc += self.counts[-1]
+        lines.append(f'{name}_bucket{_fmt_labels(labelnames, labelvalues, ("le", "+Inf"))} {acc}')
+        lines.append(f'{name}_sum{_fmt_labels(labelnames, labelvalues)} {self.sum}')
+        lines.append(f'{name}_count{_fmt_labels(labelnames, labelvalues)} {acc}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+
+class GaugeCallback:
+    """抓取时才调用fn()，fn返回[(labelvalues, value), ...]"""
+    def __init__(self, name, documentation, labelnames, fn):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._failed = False  # 只记录第一次失败，避免每次抓取都刷日志
+        _collectors.append(self)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        try:
+            for labelvalues, value in self.fn():
+                lines.append(f'{self.name}{_fmt_labels(self.labelnames, labelvalues)} {value}')
+        except Exception:
+            if not self._failed:
+                self._failed = True
+                logger.warning(f'metrics: callback for {self.name} failed, gauge omitted', exc_info=True)
+        return lines
+
+
+def qsize(q):
+    # mp.Queue.qsize在macOS上未实现，拿不到时返回None
+    try:
+        return q.qsize()
+    except (NotImplementedError, AttributeError):
+        return None
+
+
+def process_rss():
+    # 只有linux能拿到当前值，其他平台返回None，不输出这个样本(ru_maxrss是峰值，不能代替)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+async def watch_event_loop(histogram, interval=0.1):
+    """每interval秒醒来一次，实际醒来时间比预定晚了多少就是事件循环的延迟"""
+    while True:
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(time.perf_counter() - t - interval, 0.0))
+
+
+def generate_latest():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+    for collector in _collectors:
+        lines.extend(collector.collect())
+    return '\n'.join(lines) + '\n'
+
+
+INFER_BATCH_SECONDS = Histogram('livetalking_infer_batch_seconds',
+                                'lip-sync model latency per speaking batch', ['model'])
+INFER_BATCHES = Counter('livetalking_infer_batches_total',
+                        'inference batches by kind (silent batches skip the model)', ['model', 'kind'])
+TTS_FIRST_CHUNK_SECONDS = Histogram('livetalking_tts_first_chunk_seconds',
+                                    'tts time to first audio chunk', ['tts'])
+LLM_FIRST_TOKEN_SECONDS = Histogram('livetalking_llm_first_token_seconds',
+                                    'llm time to first streamed token')
+EVENT_LOOP_LAG_SECONDS = Histogram('livetalking_event_loop_lag_seconds',
+                                   'how late the http/webrtc event loop woke up from a 100ms sleep',
+                                   buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+WEBRTC_FRAMES_SENT = Counter('livetalking_webrtc_frames_sent_total',
+                             'frames handed to aiortc, rate() gives send fps', ['kind'])
+
+GaugeCallback('livetalking_process_rss_bytes', 'resident set size of this process', [],
+              lambda: [((), rss) for rss in [process_rss()] if rss is not None])
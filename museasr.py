@@ -32,15 +32,16 @@ class MuseASR(BaseASR):
     def run_step(self):
         ############################################## extract audio feature ##############################################
         start_time = time.time()
-        for _ in range(self.batch_size*2):
-            audio_frame,type,eventpoint = self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame,type,eventpoint))
+        self.push_frames(self.batch_size*2)
         
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
+        if self.window_frames <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        if self.is_idle():
+            self.put_idle_feat()
+            return
+
+        inputs = self.get_window() # [N * chunk]
         whisper_feature = self.audio_processor.audio2feat(inputs)
         # for feature in whisper_feature:
         #     self.audio_feats.append(feature)        
@@ -49,5 +50,5 @@ class MuseASR(BaseASR):
         #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
         #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
         self.feat_queue.put(whisper_chunks)
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        # discard the old part
+        self.trim_window()
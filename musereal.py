@@ -41,17 +41,20 @@ from musetalk.utils.utils import load_all_model,load_diffusion_model,load_audio_
 from musetalk.whisper.audio2feature import Audio2Feature
 
 from museasr import MuseASR
-import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from ringqueue import RingQueue
+from compiled import compile_model, default_buckets
 
 from tqdm import tqdm
 from logger import logger
+import metrics
+
+device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
 
 def load_model():
     # load model weights
     audio_processor,vae, unet, pe = load_all_model()
-    device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
     timesteps = torch.tensor([0], device=device)
     pe = pe.half()
     vae.vae = vae.vae.half()
@@ -78,6 +81,9 @@ def load_avatar(avatar_id):
     # }
 
     input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
+    # 每帧一个[1,8,32,32]的列表合成一个连续的[N,8,32,32]，dtype与load_model中unet.model.half()一致，
+    # 推理时按镜像下标index_select，不再每批循环+torch.cat
+    input_latent_list_cycle = torch.cat(input_latent_list_cycle, dim=0).to(device=device, dtype=torch.float16).contiguous()
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
     input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -91,10 +97,19 @@ def load_avatar(avatar_id):
     return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
 
 @torch.no_grad()
-def warm_up(batch_size,model):
-    # 预热函数
+def warm_up(batch_size,model,compile_mode='none',buckets=None):
+    # 预热函数，compile_mode不为none时编译unet(直接替换unet.model)
     logger.info('warmup model...')
     vae, unet, pe, timesteps, audio_processor = model
+    if compile_mode == 'trace':
+        # unet返回的是UNet2DConditionOutput，trace后拿不到.sample，用torch.compile代替
+        logger.info('musetalk unet does not support trace, use compile')
+        compile_mode = 'compile'
+    unet.model = compile_model(unet.model, 'musetalk_unet',
+                               lambda bs: (torch.ones(bs, 8, 32, 32, device=unet.device, dtype=unet.model.dtype),
+                                           timesteps,
+                                           torch.ones(bs, 50, 384, device=unet.device, dtype=unet.model.dtype)),
+                               buckets or default_buckets(batch_size), compile_mode)
     #batch_size = 16
     #timesteps = torch.tensor([0], device=unet.device)
     whisper_batch = np.ones((batch_size, 50, 384), dtype=np.uint8)
@@ -137,10 +152,16 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
     # vae.vae = vae.vae.half()
     # unet.model = unet.model.half()
     
-    length = len(input_latent_list_cycle)
+    length = input_latent_list_cycle.shape[0]
+    # 一个镜像周期(2N帧)内每帧对应的latent下标
+    mirror_indices = torch.tensor([__mirror_index(length,i) for i in range(2*length)], device=input_latent_list_cycle.device)
+    batch_offsets = torch.arange(batch_size, device=input_latent_list_cycle.device)
     index = 0
     count=0
     counttime=0
+    infer_seconds = metrics.INFER_BATCH_SECONDS.labels('musetalk')
+    silent_batches = metrics.INFER_BATCHES.labels('musetalk', 'silent')
+    speaking_batches = metrics.INFER_BATCHES.labels('musetalk', 'speaking')
     logger.info('start inference')
     while render_event.is_set():
         starttime=time.perf_counter()
@@ -148,34 +169,24 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
-        if is_all_silence:
+        audio_frames = audio_out_queue.read(batch_size*2)
+        is_all_silence = audio_frames.is_silent()
+        if is_all_silence or whisper_chunks is None: #whisper_chunks为None表示asr处于空闲模式，没有提取特征
+            silent_batches.inc()
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((None,__mirror_index(length,index),audio_frames.part(i*2,2)))
                 index = index + 1
         else:
             # print('infer=======')
             t=time.perf_counter()
             whisper_batch = np.stack(whisper_chunks)
-            latent_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                latent = input_latent_list_cycle[idx]
-                latent_batch.append(latent)
-            latent_batch = torch.cat(latent_batch, dim=0)
+            latent_batch = input_latent_list_cycle.index_select(0, mirror_indices[(batch_offsets + index) % (2*length)])
             
             # for i, (whisper_batch,latent_batch) in enumerate(gen):
             audio_feature_batch = torch.from_numpy(whisper_batch)
             audio_feature_batch = audio_feature_batch.to(device=unet.device,
                                                             dtype=unet.model.dtype)
             audio_feature_batch = pe(audio_feature_batch)
-            latent_batch = latent_batch.to(dtype=unet.model.dtype)
             # print('prepare time:',time.perf_counter()-t)
             # t=time.perf_counter()
 
@@ -192,7 +203,10 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
 
             # print('vae time:',time.perf_counter()-t)
             #print('diffusion len=',len(recon))
-            counttime += (time.perf_counter() - t)
+            dt = time.perf_counter() - t
+            counttime += dt
+            infer_seconds.observe(dt)
+            speaking_batches.inc()
             count += batch_size
             #_totalframe += 1
             if count>=100:
@@ -201,7 +215,7 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
                 counttime=0
             for i,res_frame in enumerate(recon):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
+                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames.part(i*2,2)))
                 index = index + 1
             #print('total batch time:',time.perf_counter()-starttime)            
     logger.info('musereal inference processor stop')
@@ -218,7 +232,7 @@ class MuseReal(BaseReal):
 
         self.batch_size = opt.batch_size
         self.idx = 0
-        self.res_frame_queue = mp.Queue(self.batch_size*2)
+        self.res_frame_queue = RingQueue(self.batch_size*2)
 
         self.vae, self.unet, self.pe, self.timesteps, self.audio_processor = model
         self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
@@ -246,12 +260,7 @@ class MuseReal(BaseReal):
         self.asr.run_step()
         whisper_chunks = self.asr.get_next_feat()
         whisper_batch = np.stack(whisper_chunks)
-        latent_batch = []
-        for i in range(self.batch_size):
-            idx = self.__mirror_index(self.idx+i)
-            latent = self.input_latent_list_cycle[idx]
-            latent_batch.append(latent)
-        latent_batch = torch.cat(latent_batch, dim=0)
+        latent_batch = self.input_latent_list_cycle[[self.__mirror_index(self.idx+i) for i in range(self.batch_size)]]
         logger.info('infer=======')
         # for i, (whisper_batch,latent_batch) in enumerate(gen):
         audio_feature_batch = torch.from_numpy(whisper_batch)
@@ -276,29 +285,34 @@ class MuseReal(BaseReal):
             self.last_silent_frame = None  # 静音帧缓存
             self.last_speaking_frame = None  # 说话帧缓存
         
+        frame_index = -1 #与inference中的index一致
         while not quit_event.is_set():
             try:
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            frame_index += 1
+            packet = None
             
             if enable_transition:
                 # 检测状态变化
-                current_speaking = not (audio_frames[0][1]!=0 and audio_frames[1][1]!=0)
+                current_speaking = not audio_frames.is_silent()
                 if current_speaking != self.last_speaking:
                     logger.info(f"状态切换：{'说话' if self.last_speaking else '静音'} → {'说话' if current_speaking else '静音'}")
                     self.transition_start = time.time()
                 self.last_speaking = current_speaking
 
-            if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: 
+            if audio_frames.is_silent(): 
                 self.speaking = False
-                audiotype = audio_frames[0][1]
+                audiotype = int(audio_frames.types[0])
                 if self.custom_index.get(audiotype) is not None:
                     mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
                     target_frame = self.custom_img_cycle[audiotype][mirindex]
+                    custom_index = self.custom_index[audiotype]
                     self.custom_index[audiotype] += 1
                 else:
                     target_frame = self.frame_list_cycle[idx]
+                    custom_index = None
                 
                 if enable_transition:
                     # 说话→静音过渡
@@ -307,10 +321,15 @@ class MuseReal(BaseReal):
                         combine_frame = cv2.addWeighted(self.last_speaking_frame, 1-alpha, target_frame, alpha, 0)
                     else:
                         combine_frame = target_frame
-                    # 缓存静音帧
-                    self.last_silent_frame = combine_frame.copy()
+                    # 缓存静音帧，frame_list_cycle/custom_img_cycle不会被修改，不需要拷贝
+                    self.last_silent_frame = combine_frame
                 else:
                     combine_frame = target_frame
+                if combine_frame is target_frame: #不在过渡中的静音帧
+                    if custom_index is not None:
+                        packet = self.get_custom_packet(audiotype, custom_index)
+                    else:
+                        packet = self.get_idle_packet(frame_index, idx)
             else:
                 self.speaking = True
                 bbox = self.coord_list_cycle[idx]
@@ -338,18 +357,22 @@ class MuseReal(BaseReal):
                     combine_frame = current_frame
 
             image = combine_frame
-            new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-            asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+            if packet is not None: #静音循环直接发预编码包
+                video_track._queue.put((packet,None))
+            else:
+                self.idle_splicer.stop()
+                new_frame = VideoFrame.from_ndarray(image, format="bgr24")
+                video_track._queue.put((new_frame,None))
             self.record_video_data(image)
 
-            for audio_frame in audio_frames:
-                frame,type,eventpoint = audio_frame
-                frame = (frame * 32767).astype(np.int16)
+            audio_out = []
+            for frame,type,eventpoint in audio_frames: #int16，read()时整批转换
                 new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                 new_frame.planes[0].update(frame.tobytes())
                 new_frame.sample_rate=16000
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                audio_out.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
+            audio_track._queue.put_many(audio_out)
         logger.info('musereal process_frames thread stop') 
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
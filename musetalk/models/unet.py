@@ -4,6 +4,7 @@ import math
 import json
 
 from diffusers import UNet2DConditionModel
+from weights import load_weights
 import sys
 import time
 import numpy as np
@@ -37,8 +38,7 @@ class UNet():
         self.model = UNet2DConditionModel(**unet_config)
         self.pe = PositionalEncoding(d_model=384)
         self.device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
-        weights = torch.load(model_path) if torch.cuda.is_available() else torch.load(model_path, map_location=self.device)
-        self.model.load_state_dict(weights)
+        load_weights(self.model, model_path) #有model.safetensors时内存映射加载
         if use_float16:
             self.model = self.model.half()
         self.model.to(self.device)
@@ -4,6 +4,9 @@ import json
 import os
 import pickle
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import cv2
 import numpy as np
@@ -12,8 +15,9 @@ import torchvision.transforms as transforms
 from PIL import Image
 from diffusers import AutoencoderKL
 from face_alignment import NetworkSize
-from mmpose.apis import inference_topdown, init_model
-from mmpose.structures import merge_data_samples
+from mmengine.dataset import Compose, pseudo_collate
+from mmengine.registry import init_default_scope
+from mmpose.apis import init_model
 from tqdm import tqdm
 
 try:
@@ -21,37 +25,90 @@ try:
 except ModuleNotFoundError:
     from musetalk.utils.face_parsing import FaceParsing
 
+IO_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def check_writes(writes):
+    """writes: [(路径, cv2.imwrite的future)]。imwrite写失败只返回False，这里改成抛异常"""
+    for path, future in writes:
+        if not future.result():
+            raise IOError(f"failed to write {path}")
+
 
 def video2imgs(vid_path, save_path, ext='.png', cut_frame=10000000):
     cap = cv2.VideoCapture(vid_path)
     count = 0
-    while True:
-        if count > cut_frame:
-            break
-        ret, frame = cap.read()
-        if ret:
-            cv2.putText(frame, "LiveTalking", (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (128,128,128), 1)
-            cv2.imwrite(f"{save_path}/{count:08d}.png", frame)
-            count += 1
-        else:
-            break
+    writes = []
+    # png编码会释放GIL，边解码边在线程池里写
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+        while True:
+            if count > cut_frame:
+                break
+            ret, frame = cap.read()
+            if ret:
+                cv2.putText(frame, "LiveTalking", (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (128,128,128), 1)
+                path = f"{save_path}/{count:08d}.png"
+                writes.append((path, pool.submit(cv2.imwrite, path, frame)))
+                count += 1
+            else:
+                break
+    check_writes(writes)
 
 
 def read_imgs(img_list):
-    frames = []
     print('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+        return list(tqdm(pool.map(cv2.imread, img_list), total=len(img_list)))
+
+
+class StageTimer:
+    """按阶段累计耗时和帧数，最后输出每个阶段的fps"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, name, frames):
+        t = time.perf_counter()
+        yield
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed, count = self.stages.get(name, (0.0, 0))
+        self.stages[name] = (elapsed + time.perf_counter() - t, count + frames)
+
+    def report(self):
+        total = 0.0
+        for name, (elapsed, count) in self.stages.items():
+            total += elapsed
+            print(f'{name:>10}: {count} frames {elapsed:8.2f}s {count / max(elapsed, 1e-9):8.2f} fps')
+        frames = max((count for _, count in self.stages.values()), default=0)
+        print(f'{"total":>10}: {frames} frames {total:8.2f}s {frames / max(total, 1e-9):8.2f} fps')
+
+
+def detect_landmarks(frames):
+    """整图作为人体框，一批图片一次test_step(inference_topdown每次只处理一张)。
+    返回每张图的68个人脸关键点，int32 [68, 2]"""
+    data_list = []
+    for img in frames:
+        h, w = img.shape[:2]
+        data_info = dict(img=img, bbox=np.array([[0, 0, w, h]], dtype=np.float32),
+                         bbox_score=np.ones(1, dtype=np.float32))
+        data_info.update(model.dataset_meta)
+        data_list.append(pose_pipeline(data_info))
+    with torch.no_grad():
+        results = model.test_step(pseudo_collate(data_list))
+    return [r.pred_instances.keypoints[0][23:91].astype(np.int32) for r in results]
 
 
-def get_landmark_and_bbox(img_list, upperbondrange=0):
-    frames = read_imgs(img_list)
-    batch_size_fa = 1
-    batches = [frames[i:i + batch_size_fa] for i in range(0, len(frames), batch_size_fa)]
+def detect_faces(frames):
+    # s3fd要求同一批图片大小相同，图片目录里大小不一时逐张检测
+    if all(f.shape == frames[0].shape for f in frames):
+        return fa.get_detections_for_batch(np.asarray(frames))
+    return [fa.get_detections_for_batch(np.asarray([f]))[0] for f in frames]
+
+
+def get_landmark_and_bbox(frames, upperbondrange=0, batch_size=8):
     coords_list = []
-    landmarks = []
     if upperbondrange != 0:
         print('get key_landmark and face bounding boxes with the bbox_shift:', upperbondrange)
     else:
@@ -59,19 +116,16 @@ def get_landmark_and_bbox(img_list, upperbondrange=0):
     average_range_minus = []
     average_range_plus = []
     coord_placeholder = (0.0, 0.0, 0.0, 0.0)
-    for fb in tqdm(batches):
-        results = inference_topdown(model, np.asarray(fb)[0])
-        results = merge_data_samples(results)
-        keypoints = results.pred_instances.keypoints
-        face_land_mark = keypoints[0][23:91]
-        face_land_mark = face_land_mark.astype(np.int32)
+    for i in tqdm(range(0, len(frames), batch_size)):
+        fb = frames[i:i + batch_size]
+        landmarks = detect_landmarks(fb)
 
         # get bounding boxes by face detetion
-        bbox = fa.get_detections_for_batch(np.asarray(fb))
+        bbox = detect_faces(fb)
 
         # adjust the bounding box refer to landmark
         # Add the bounding box to a tuple and append it to the coordinates list
-        for j, f in enumerate(bbox):
+        for face_land_mark, f in zip(landmarks, bbox):
             if f is None:  # no face in the image
                 coords_list += [coord_placeholder]
                 continue
@@ -93,11 +147,10 @@ def get_landmark_and_bbox(img_list, upperbondrange=0):
 
             if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:  # if the landmark bbox is not suitable, reuse the bbox
                 coords_list += [f]
-                w, h = f[2] - f[0], f[3] - f[1]
                 print("error bbox:", f)
             else:
                 coords_list += [f_landmark]
-    return coords_list, frames
+    return coords_list
 
 
 class FaceAlignment:
@@ -193,6 +246,18 @@ def get_latents_for_unet(img):
     return latent_model_input
 
 
+def get_latents_for_unet_batch(imgs):
+    """imgs: 256x256 BGR uint8列表。和get_latents_for_unet相同，半遮挡图和原图拼成一批一次encode，
+    返回每张图[1, 8, 32, 32]的列表"""
+    x = torch.from_numpy(np.ascontiguousarray(np.stack(imgs)[..., ::-1])).to(device)
+    x = x.permute(0, 3, 1, 2).float().div_(255)
+    masked = x * (get_mask_tensor() > 0.5).to(device)
+    latents = encode_latents(torch.cat([masked, x]).sub_(0.5).div_(0.5))
+    masked_latents, ref_latents = latents.chunk(2)
+    latent_model_input = torch.cat([masked_latents, ref_latents], dim=1)
+    return [latent_model_input[i:i + 1].clone() for i in range(len(imgs))]
+
+
 def get_crop_box(box, expand):
     x, y, x1, y1 = box
     x_c, y_c = (x + x1) // 2, (y + y1) // 2
@@ -239,6 +304,37 @@ def get_image_prepare_material(image, face_box, upper_boundary_ratio=0.5, expand
     return mask_array, crop_box
 
 
+def crop_padded(image, box):
+    # 和PIL的Image.crop一样，超出图像的部分补0
+    x_s, y_s, x_e, y_e = box
+    h, w = image.shape[:2]
+    out = np.zeros((y_e - y_s, x_e - x_s) + image.shape[2:], dtype=image.dtype)
+    sx, sy, ex, ey = max(x_s, 0), max(y_s, 0), min(x_e, w), min(y_e, h)
+    if ex > sx and ey > sy:
+        out[sy - y_s:ey - y_s, sx - x_s:ex - x_s] = image[sy:ey, sx:ex]
+    return out
+
+
+def get_image_prepare_material_batch(frames, face_boxes, upper_boundary_ratio=0.5, expand=1.2):
+    """get_image_prepare_material的批量版本：人脸分割整批推理，
+    之后在uint8数组上用OpenCV缩放、只保留人脸框下半部分并模糊，不再经过PIL"""
+    crop_boxes = [get_crop_box(face_box, expand)[0] for face_box in face_boxes]
+    segs = fp.batch([crop_padded(frame, crop_box)[:, :, ::-1] for frame, crop_box in zip(frames, crop_boxes)])
+    masks = []
+    for seg, face_box, crop_box in zip(segs, face_boxes, crop_boxes):
+        x, y, x1, y1 = face_box
+        x_s, y_s, x_e, y_e = crop_box
+        width, height = x_e - x_s, y_e - y_s
+        seg = cv2.resize(seg, (width, height), interpolation=cv2.INTER_CUBIC)
+        # keep upper_boundary_ratio of talking area
+        top = max(y - y_s, int(height * upper_boundary_ratio))
+        mask = np.zeros_like(seg)
+        mask[top:y1 - y_s, x - x_s:x1 - x_s] = seg[top:y1 - y_s, x - x_s:x1 - x_s]
+        blur_kernel_size = int(0.1 * width // 2 * 2) + 1
+        masks.append(cv2.GaussianBlur(mask, (blur_kernel_size, blur_kernel_size), 0))
+    return masks, crop_boxes
+
+
 ##todo 简单根据文件后缀判断  要更精确的可以自己修改 使用 magic
 def is_video_file(file_path):
     video_exts = ['.mp4', '.mkv', '.flv', '.avi', '.mov']  # 这里列出了一些常见的视频文件扩展名，可以根据需要添加更多
@@ -254,7 +350,7 @@ def create_dir(dir_path):
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
-def create_musetalk_human(file, avatar_id):
+def create_musetalk_human(file, avatar_id, batch_size=8):
     # 保存文件设置 可以不动
     save_path = os.path.join(current_dir, f'../data/avatars/avator_{avatar_id}')
     save_full_path = os.path.join(current_dir, f'../data/avatars/avator_{avatar_id}/full_imgs')
@@ -287,41 +383,73 @@ def create_musetalk_human(file, avatar_id):
         for filename in files:
             shutil.copyfile(f"{file}/{filename}", f"{save_full_path}/{filename}")
     input_img_list = sorted(glob.glob(os.path.join(save_full_path, '*.[jpJP][pnPN]*[gG]')))
-    print("extracting landmarks...")
-    coord_list, frame_list = get_landmark_and_bbox(input_img_list, 5)
-    input_latent_list = []
-    idx = -1
+    timer = StageTimer()
+    with timer('read', len(input_img_list)):
+        frame_list = read_imgs(input_img_list)
+    coord_list, input_latent_list, mask_list_cycle, mask_coords_list_cycle = prepare_avatar(
+        frame_list, 5, batch_size, timer)
+    with timer('write', len(frame_list)):
+        writes = []
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+            for i, mask in enumerate(mask_list_cycle):
+                path = f"{mask_out_path}/{str(i).zfill(8)}.png"
+                writes.append((path, pool.submit(cv2.imwrite, path, mask)))
+        check_writes(writes)
+
+        with open(mask_coords_path, 'wb') as f:
+            pickle.dump(mask_coords_list_cycle, f)
+
+        with open(coords_path, 'wb') as f:
+            pickle.dump(coord_list, f)
+        torch.save(input_latent_list, os.path.join(latents_out_path))
+    timer.report()
+
+
+def prepare_avatar(frame_list, bbox_shift, batch_size, timer):
+    """人脸框、latents和融合用的mask，各阶段都按batch_size成批处理"""
+    with timer('landmark', len(frame_list)):
+        print("extracting landmarks...")
+        coord_list = get_landmark_and_bbox(frame_list, bbox_shift, batch_size)
     # maker if the bbox is not sufficient
     coord_placeholder = (0.0, 0.0, 0.0, 0.0)
-    for bbox, frame in zip(coord_list, frame_list):
-        idx = idx + 1
-        if bbox == coord_placeholder:
-            continue
-        x1, y1, x2, y2 = bbox
-        crop_frame = frame[y1:y2, x1:x2]
-        resized_crop_frame = cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
-        latents = get_latents_for_unet(resized_crop_frame)
-        input_latent_list.append(latents)
-
-    frame_list_cycle = frame_list #+ frame_list[::-1]
-    coord_list_cycle = coord_list #+ coord_list[::-1]
-    input_latent_list_cycle = input_latent_list #+ input_latent_list[::-1]
-    mask_coords_list_cycle = []
-    mask_list_cycle = []
-    for i, frame in enumerate(tqdm(frame_list_cycle)):
-        cv2.imwrite(f"{save_full_path}/{str(i).zfill(8)}.png", frame)
-        face_box = coord_list_cycle[i]
-        mask, crop_box = get_image_prepare_material(frame, face_box)
-        cv2.imwrite(f"{mask_out_path}/{str(i).zfill(8)}.png", mask)
-        mask_coords_list_cycle += [crop_box]
-        mask_list_cycle.append(mask)
-
-    with open(mask_coords_path, 'wb') as f:
-        pickle.dump(mask_coords_list_cycle, f)
-
-    with open(coords_path, 'wb') as f:
-        pickle.dump(coord_list_cycle, f)
-    torch.save(input_latent_list_cycle, os.path.join(latents_out_path))
+    valid = [i for i, bbox in enumerate(coord_list) if bbox != coord_placeholder]
+    input_latent_list = []
+    with timer('latents', len(valid)):
+        for i in tqdm(range(0, len(valid), batch_size)):
+            crops = []
+            for idx in valid[i:i + batch_size]:
+                x1, y1, x2, y2 = coord_list[idx]
+                crop_frame = frame_list[idx][y1:y2, x1:x2]
+                crops.append(cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4))
+            input_latent_list += get_latents_for_unet_batch(crops)
+
+    mask_list = []
+    mask_coords_list = []
+    with timer('mask', len(frame_list)):
+        for i in tqdm(range(0, len(frame_list), batch_size)):
+            masks, crop_boxes = get_image_prepare_material_batch(frame_list[i:i + batch_size],
+                                                                 coord_list[i:i + batch_size])
+            mask_list += masks
+            mask_coords_list += crop_boxes
+    return coord_list, input_latent_list, mask_list, mask_coords_list
+
+
+def benchmark(file, frames, batch_size):
+    """取视频前frames帧跑一遍准备流程，不写文件，输出各阶段的fps"""
+    cap = cv2.VideoCapture(file)
+    frame_list = []
+    while len(frame_list) < frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_list.append(frame)
+    cap.release()
+    print(f'benchmark on {device}, {len(frame_list)} frames, batch_size {batch_size}')
+    # 第一批用来预热，不计入结果
+    prepare_avatar(frame_list[:batch_size], 5, batch_size, StageTimer())
+    timer = StageTimer()
+    prepare_avatar(frame_list, 5, batch_size, timer)
+    timer.report()
 
 
 # initialize the mmpose model
@@ -330,6 +458,8 @@ fa = FaceAlignment(1, flip_input=False, device=device)
 config_file = os.path.join(current_dir, 'utils/dwpose/rtmpose-l_8xb32-270e_coco-ubody-wholebody-384x288.py')
 checkpoint_file = os.path.abspath(os.path.join(current_dir, '../models/dwpose/dw-ll_ucoco_384.pth'))
 model = init_model(config_file, checkpoint_file, device=device)
+init_default_scope(model.cfg.get('default_scope', 'mmpose'))
+pose_pipeline = Compose(model.cfg.test_dataloader.dataset.pipeline)
 vae = AutoencoderKL.from_pretrained(os.path.abspath(os.path.join(current_dir, '../models/sd-vae-ft-mse')))
 vae.to(device)
 fp = FaceParsing(os.path.abspath(os.path.join(current_dir, '../models/face-parse-bisent/resnet18-5c106cde.pth')),
@@ -345,5 +475,18 @@ if __name__ == '__main__':
                         type=str,
                         default='3',
                         )
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=8,
+                        help="frames per batch for landmark detection, face parsing and vae encoding",
+                        )
+    parser.add_argument("--benchmark",
+                        type=int,
+                        default=0,
+                        help="only measure the preparation fps on the first N frames of --file",
+                        )
     args = parser.parse_args()
-    create_musetalk_human(args.file, args.avatar_id)
+    if args.benchmark > 0:
+        benchmark(args.file, args.benchmark, args.batch_size)
+    else:
+        create_musetalk_human(args.file, args.avatar_id, args.batch_size)
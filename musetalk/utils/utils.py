@@ -3,11 +3,9 @@ import cv2
 import numpy as np
 import torch
 
+# 推理不需要ffmpeg，导入时不再打印提示；设置了FFMPEG_PATH时仍加到PATH里
 ffmpeg_path = os.getenv('FFMPEG_PATH')
-if ffmpeg_path is None:
-    print("please download ffmpeg-static and export to FFMPEG_PATH. \nFor example: export FFMPEG_PATH=/musetalk/ffmpeg-4.4-amd64-static")
-elif ffmpeg_path not in os.getenv('PATH'):
-    print("add ffmpeg to path")
+if ffmpeg_path is not None and ffmpeg_path not in os.getenv('PATH'):
     os.environ["PATH"] = f"{ffmpeg_path}:{os.environ['PATH']}"
 
     
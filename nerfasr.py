@@ -26,6 +26,65 @@ from queue import Queue
 
 from baseasr import BaseASR
 
+
+class FeatWindows:
+    '''feat_queue(循环队列)上取每个视频帧的[D, 16]音频特征窗口，每帧前进2行。
+    att>0时返回最近8个窗口组成的[8, D, 16]，开头用4个全0窗口填充。
+    输出和原来的实现完全一致：没有跨过队尾的窗口原来保存的是feat_queue的切片视图，
+    之后run_step覆盖的行也会反映到输出里，所以这些窗口在next()时才从feat_queue取；
+    跨过队尾的窗口原来经过torch.cat复制，这里同样在窗口加入时保存副本。
+    8个窗口都没有跨过队尾时(绝大多数帧)是feat_queue上连续的30行，unfold之后一次拷贝'''
+    def __init__(self, feat_queue, att):
+        self.feat_queue = feat_queue
+        self.att = att
+        size, dim = feat_queue.shape
+        device = feat_queue.device
+        # TODO: hard coded 16 and 8 window size...
+        self.front = size - 8 # fake padding
+        self.tail = 8
+        n = size // 2 # window s starts at feat_queue row 2 * s
+        # window_index[s]: feat_queue rows of window s
+        self.window_index = (torch.arange(0, size, 2, device=device)[:, None] + torch.arange(16, device=device)) % size
+        # front + 16 >= size: the old code went through torch.cat, i.e. a copy
+        self.wrapped = [s * 2 + 16 >= size for s in range(n)]
+        # any of windows s .. s + 7 wrapped
+        self.any_wrapped = [any(self.wrapped[(s + i) % n] for i in range(8)) for s in range(n)]
+        self.copies = {} # window -> [16, D] copy
+        self.zeros = torch.zeros(16, dim, dtype=feat_queue.dtype, device=device)
+        self.n = n
+        self.r = self.front // 2 # oldest real window
+        self.pad = 4 # 4 zero padding...
+
+    def next(self):
+        if self.att <= 0:
+            front = self.front
+            self.front = (self.front + 2) % self.feat_queue.shape[0]
+            self.tail = (self.tail + 2) % self.feat_queue.shape[0]
+            return self.feat_queue[self.window_index[front // 2]].t().unsqueeze(0) # [1, D, 16]
+        r = self.r
+        if not self.pad and not self.any_wrapped[r]:
+            # discard old
+            self.r = r + 1 if r + 1 < self.n else 0
+            # none of the 8 windows wraps: they are rows 2r .. 2r + 29, one strided copy
+            return self.feat_queue[2 * r:2 * r + 30].unfold(0, 16, 2).contiguous() # [8, D, 16]
+        k = 8 - self.pad
+        # windows added by this call: 4 at the first call, then the newest one
+        for i in (range(k) if self.pad == 4 else (k - 1,)):
+            s = (r + i) % self.n
+            if self.wrapped[s]:
+                self.copies[s] = self.feat_queue[self.window_index[s]]
+        feats = [self.zeros] * self.pad
+        for i in range(k):
+            s = (r + i) % self.n
+            feats.append(self.copies[s] if self.wrapped[s] else self.feat_queue[2 * s:2 * s + 16])
+        if self.pad:
+            self.pad -= 1
+        else:
+            # discard old
+            self.r = r + 1 if r + 1 < self.n else 0
+        return torch.stack([feat.t() for feat in feats], dim=0) # [8, D, 16]
+
+
 class NerfASR(BaseASR):
     def __init__(self, opt, parent, audio_processor,audio_model):
         super().__init__(opt,parent)
@@ -46,9 +105,8 @@ class NerfASR(BaseASR):
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
 
-        # pad left frames
-        if self.stride_left_size > 0:
-            self.frames.extend([np.zeros(self.chunk, dtype=np.float32)] * self.stride_left_size)
+        # pad left frames (output_queue is zero-initialized, the window starts before the first frame)
+        self.window_frames = self.stride_left_size
 
         # create wav2vec model
         # print(f'[INFO] loading ASR model {self.opt.asr_model}...')
@@ -67,11 +125,8 @@ class NerfASR(BaseASR):
         self.feat_buffer_idx = 0
         self.feat_queue = torch.zeros(self.feat_buffer_size * self.context_size, self.audio_dim, dtype=torch.float32, device=self.device)
 
-        # TODO: hard coded 16 and 8 window size...
-        self.front = self.feat_buffer_size * self.context_size - 8 # fake padding
-        self.tail = 8
         # attention window...
-        self.att_feats = [torch.zeros(self.audio_dim, 16, dtype=torch.float32, device=self.device)] * 4 # 4 zero padding...
+        self.windows = FeatWindows(self.feat_queue, self.opt.att)
 
         # warm up steps needed: mid + right + window_size + attention_size
         self.warm_up_steps = self.context_size + self.stride_left_size + self.stride_right_size #+ self.stride_left_size   #+ 8 + 2 * 3
@@ -93,57 +148,20 @@ class NerfASR(BaseASR):
 
     def get_next_feat(self): #get audio embedding to nerf
         # return a [1/8, 16] window, for the next input to nerf side.
-        if self.opt.att>0:
-            while len(self.att_feats) < 8:
-                # [------f+++t-----]
-                if self.front < self.tail:
-                    feat = self.feat_queue[self.front:self.tail]
-                # [++t-----------f+]
-                else:
-                    feat = torch.cat([self.feat_queue[self.front:], self.feat_queue[:self.tail]], dim=0)
-
-                self.front = (self.front + 2) % self.feat_queue.shape[0]
-                self.tail = (self.tail + 2) % self.feat_queue.shape[0]
-
-                # print(self.front, self.tail, feat.shape)
-
-                self.att_feats.append(feat.permute(1, 0))
-            
-            att_feat = torch.stack(self.att_feats, dim=0) # [8, 44, 16]
-
-            # discard old
-            self.att_feats = self.att_feats[1:]
-        else:
-            # [------f+++t-----]
-            if self.front < self.tail:
-                feat = self.feat_queue[self.front:self.tail]
-            # [++t-----------f+]
-            else:
-                feat = torch.cat([self.feat_queue[self.front:], self.feat_queue[:self.tail]], dim=0)
-
-            self.front = (self.front + 2) % self.feat_queue.shape[0]
-            self.tail = (self.tail + 2) % self.feat_queue.shape[0]
-
-            att_feat = feat.permute(1, 0).unsqueeze(0)
-
-
-        return att_feat
+        return self.windows.next()
 
     def run_step(self):
 
-        # get a frame of audio
-        frame,type,eventpoint = self.get_audio_frame()
-        self.frames.append(frame)
-        # put to output
-        self.output_queue.put((frame,type,eventpoint))
+        # get a frame of audio, put to output
+        self.push_frames(1)
         # context not enough, do not run network.
-        if len(self.frames) < self.stride_left_size + self.context_size + self.stride_right_size:
+        if self.window_frames < self.stride_left_size + self.context_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        inputs = self.get_window() # [N * chunk]
 
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        # discard the old part
+        self.trim_window()
 
         #print(f'[INFO] frame_to_text... ')
         #t = time.time()
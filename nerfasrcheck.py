@@ -0,0 +1,98 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 检查NerfASR的FeatWindows与原来逐帧拼接的实现输出完全一致。
+# 按run_step的方式每context_size步写入一块随机特征，每两步取一次窗口，覆盖循环队列回绕。
+# python nerfasrcheck.py
+
+import argparse
+import time
+
+import torch
+
+from nerfasr import FeatWindows
+
+
+class ReferenceWindows:
+    '''原NerfASR.get_next_feat的实现'''
+    def __init__(self, feat_queue, att):
+        self.feat_queue = feat_queue
+        self.att = att
+        self.front = feat_queue.shape[0] - 8
+        self.tail = 8
+        self.att_feats = [torch.zeros(feat_queue.shape[1], 16, dtype=torch.float32, device=feat_queue.device)] * 4
+
+    def _window(self):
+        if self.front < self.tail:
+            feat = self.feat_queue[self.front:self.tail]
+        else:
+            feat = torch.cat([self.feat_queue[self.front:], self.feat_queue[:self.tail]], dim=0)
+        self.front = (self.front + 2) % self.feat_queue.shape[0]
+        self.tail = (self.tail + 2) % self.feat_queue.shape[0]
+        return feat.permute(1, 0)
+
+    def next(self):
+        if self.att <= 0:
+            return self._window().unsqueeze(0)
+        while len(self.att_feats) < 8:
+            self.att_feats.append(self._window())
+        att_feat = torch.stack(self.att_feats, dim=0)
+        self.att_feats = self.att_feats[1:]
+        return att_feat
+
+
+def check(att, context_size, audio_dim, frames, device):
+    buffer_size = 4
+    feat_queue = torch.zeros(buffer_size * context_size, audio_dim, device=device)
+    reference = ReferenceWindows(feat_queue, att)
+    windows = FeatWindows(feat_queue, att)
+    block = 0
+    for step in range(frames * 2):
+        if step % context_size == 0:  # run_step写入一块新特征
+            start = block * context_size
+            feat_queue[start:start + context_size] = torch.randn(context_size, audio_dim, device=device)
+            block = (block + 1) % buffer_size
+        if step % 2 == 1:
+            expected, actual = reference.next(), windows.next()
+            if expected.shape != actual.shape or not torch.equal(expected, actual):
+                raise SystemExit(f'mismatch att={att} m={context_size} at frame {step // 2}')
+
+
+def speed(att, context_size, audio_dim, frames, device):
+    feat_queue = torch.randn(4 * context_size, audio_dim, device=device)
+    for name, cls in (('reference', ReferenceWindows), ('FeatWindows', FeatWindows)):
+        windows = cls(feat_queue, att)
+        t = time.perf_counter()
+        for _ in range(frames):
+            windows.next()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        print(f'{name:>12}: {(time.perf_counter() - t) / frames * 1e6:.1f}us/frame')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--audio_dim', type=int, default=44)
+    opt = parser.parse_args()
+
+    for att in (0, 2):
+        for context_size in (8, 13, 50):
+            check(att, context_size, opt.audio_dim, opt.frames, opt.device)
+    print('FeatWindows matches the reference implementation')
+    speed(2, 50, opt.audio_dim, opt.frames, opt.device)
@@ -28,7 +28,6 @@ import glob
 
 from nerfasr import NerfASR
 
-import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
 
@@ -36,9 +35,9 @@ from basereal import BaseReal
 from ernerf.nerf_triplane.provider import NeRFDataset_Test
 from ernerf.nerf_triplane.utils import *
 from ernerf.nerf_triplane.network import NeRFNetwork
-from transformers import AutoModelForCTC, AutoProcessor, Wav2Vec2Processor, HubertModel
 
 from logger import logger
+import metrics
 from tqdm import tqdm
 def read_imgs(img_list):
     frames = []
@@ -90,6 +89,7 @@ def load_model(opt):
     model.eye_areas = test_loader._data.eye_area
 
     logger.info(f'[INFO] loading ASR model {opt.asr_model}...')
+    from transformers import AutoModelForCTC, AutoProcessor, Wav2Vec2Processor, HubertModel
     if 'hubert' in opt.asr_model:
         audio_processor = Wav2Vec2Processor.from_pretrained(opt.asr_model)
         audio_model = HubertModel.from_pretrained(opt.asr_model).to(device) 
@@ -138,6 +138,11 @@ class NeRFReal(BaseReal):
         # playing seq from dataloader, or pause.
         self.loader = iter(self.data_loader)
         frame_total_num = self.data_loader._data.end_index
+        # --nerf_batch K: render K consecutive frames per model.render call
+        self.nerf_batch = getattr(opt, 'nerf_batch', 1)
+        if self.nerf_batch > 1:
+            self.batch_loader = self.data_loader._data.dataloader(self.nerf_batch)
+            self.loader = iter(self.batch_loader)
         self.fullbody_list_cycle = avatar
         
 
@@ -158,6 +163,10 @@ class NeRFReal(BaseReal):
         # build asr
         self.asr = NerfASR(opt,self,audio_processor,audio_model)
         self.asr.warm_up()
+
+        self._infer_seconds = metrics.INFER_BATCH_SECONDS.labels('ernerf')
+        self._silent_batches = metrics.INFER_BATCHES.labels('ernerf', 'silent')
+        self._speaking_batches = metrics.INFER_BATCHES.labels('ernerf', 'speaking')
         
         '''
         video_path = 'video_stream'
@@ -232,24 +241,12 @@ class NeRFReal(BaseReal):
             # use the live audio stream
             data['auds'] = self.asr.get_next_feat()
 
-        audiotype1 = 0
-        audiotype2 = 0
         #send audio
-        for i in range(2):
-            frame,type,eventpoint = self.asr.get_audio_out()
-            if i==0:
-                audiotype1 = type
-            else:
-                audiotype2 = type
-            #print(f'[INFO] get_audio_out shape ',frame.shape)
-            if self.opt.transport=='rtmp':                
-                self.streamer.stream_frame_audio(frame)
-            else: #webrtc
-                frame = (frame * 32767).astype(np.int16)
-                new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
-                new_frame.planes[0].update(frame.tobytes())
-                new_frame.sample_rate=16000
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+        audio = self.asr.get_audio_out(2)
+        audiotype1 = int(audio.types[0])
+        audiotype2 = int(audio.types[1])
+        for frame,type,eventpoint in audio:
+            self.put_audio(frame,eventpoint,loop,audio_track)
 
         # if self.opt.transport=='rtmp':
         #     for _ in range(2):
@@ -286,9 +283,15 @@ class NeRFReal(BaseReal):
                 self.streamer.stream_frame(image)
             else:
                 new_frame = VideoFrame.from_ndarray(image, format="rgb24")
-                asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                video_track._queue.put((new_frame,None))
         else: #推理视频+贴回
+            t = time.perf_counter()
             outputs = self.trainer.test_gui_with_data(data, self.W, self.H)
+            self._infer_seconds.observe(time.perf_counter() - t)
+            if self.speaking:
+                self._speaking_batches.inc()
+            else:
+                self._silent_batches.inc()
             #print('-------ernerf time: ',time.time()-t)
             #print(f'[INFO] outputs shape ',outputs['image'].shape)
             image = (outputs['image'] * 255).astype(np.uint8)
@@ -297,7 +300,7 @@ class NeRFReal(BaseReal):
                     self.streamer.stream_frame(image)
                 else:
                     new_frame = VideoFrame.from_ndarray(image, format="rgb24")
-                    asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                    video_track._queue.put((new_frame,None))
             else: #fullbody human
                 #print("frame index:",data['index'])
                 #image_fullbody = cv2.imread(os.path.join(self.opt.fullbody_img, str(data['index'][0])+'.jpg'))
@@ -311,13 +314,80 @@ class NeRFReal(BaseReal):
                     self.streamer.stream_frame(image_fullbody)
                 else:
                     new_frame = VideoFrame.from_ndarray(image_fullbody, format="rgb24")
-                    asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                    video_track._queue.put((new_frame,None))
             #self.pipe.stdin.write(image.tostring())        
        
         #ender.record()
         #torch.cuda.synchronize()
         #t = starter.elapsed_time(ender)
             
+    def put_audio(self,frame,eventpoint,loop=None,audio_track=None):
+        # frame: int16 pcm
+        if self.opt.transport=='rtmp':
+            self.streamer.stream_frame_audio(frame.astype(np.float32) / 32767)
+        else: #webrtc
+            new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
+            new_frame.planes[0].update(frame.tobytes())
+            new_frame.sample_rate=16000
+            audio_track._queue.put((new_frame,eventpoint))
+
+    def put_video(self,image,loop=None,video_track=None):
+        if self.opt.transport=='rtmp':
+            self.streamer.stream_frame(image)
+        else:
+            new_frame = VideoFrame.from_ndarray(image, format="rgb24")
+            video_track._queue.put((new_frame,None))
+
+    def test_batch(self,loop=None,audio_track=None,video_track=None):
+        '''批量渲染：一次model.render渲染K帧，返回本次处理的帧数'''
+        try:
+            data = next(self.loader)
+        except StopIteration:
+            self.loader = iter(self.batch_loader)
+            data = next(self.loader)
+        B = len(data['index'])
+
+        # run 2 ASR steps per frame (audio is at 50FPS, video is at 25FPS)
+        for _ in range(2*B):
+            self.asr.run_step()
+        if self.opt.asr:
+            data['auds'] = torch.stack([self.asr.get_next_feat() for _ in range(B)])
+
+        audio_batch = self.asr.get_audio_out(2*B)
+        audio = [audio_batch.part(i*2,2) for i in range(B)]
+        # 两帧音频都不是推理音频(静音或自定义音频)并且有自定义视频时，该帧用自定义视频
+        custom = [frames.is_silent() and self.custom_index.get(int(frames.types[0])) is not None
+                  for frames in audio]
+        self.speaking = not audio_batch.is_silent()
+
+        images = None
+        if not all(custom):
+            t = time.perf_counter()
+            images = self.trainer.test_gui_batch(data, self.W, self.H)['image']
+            self._infer_seconds.observe(time.perf_counter() - t)
+            if self.speaking:
+                self._speaking_batches.inc()
+            else:
+                self._silent_batches.inc()
+
+        for i in range(B):
+            for frame,type,eventpoint in audio[i]:
+                self.put_audio(frame,eventpoint,loop,audio_track)
+            if custom[i]:
+                audiotype = int(audio[i].types[0])
+                mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
+                image = cv2.cvtColor(self.custom_img_cycle[audiotype][mirindex], cv2.COLOR_BGR2RGB)
+                self.custom_index[audiotype] += 1
+            elif self.opt.fullbody:
+                image = cv2.cvtColor(self.fullbody_list_cycle[data['index'][i]], cv2.COLOR_BGR2RGB)
+                start_x = self.opt.fullbody_offset_x
+                start_y = self.opt.fullbody_offset_y
+                image[start_y:start_y+images.shape[1], start_x:start_x+images.shape[2]] = images[i]
+            else:
+                image = images[i]
+            self.put_video(image,loop,video_track)
+        return B
+
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
         #if self.opt.asr:
         #     self.asr.warm_up()
@@ -358,14 +428,18 @@ class NeRFReal(BaseReal):
             # update texture every frame
             # audio stream thread...
             t = time.perf_counter()
-            # run 2 ASR steps (audio is at 50FPS, video is at 25FPS)
-            for _ in range(2):
-                self.asr.run_step()
-            self.test_step(loop,audio_track,video_track)
+            if self.nerf_batch > 1:
+                nframes = self.test_batch(loop,audio_track,video_track)
+            else:
+                # run 2 ASR steps (audio is at 50FPS, video is at 25FPS)
+                for _ in range(2):
+                    self.asr.run_step()
+                self.test_step(loop,audio_track,video_track)
+                nframes = 1
             totaltime += (time.perf_counter() - t)
-            count += 1
-            _totalframe += 1
-            if count==100:
+            count += nframes
+            _totalframe += nframes
+            if count>=100:
                 logger.info(f"------actual avg infer fps:{count/totaltime:.4f}")
                 count=0
                 totaltime=0
@@ -0,0 +1,135 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# wav2lip / ultralight的onnxruntime推理后端(CPU)，调用方式与torch模型相同：
+# model(*tensors) -> tensor，inference()不需要改动。启动时加 --backend onnx 使用。
+# int8量化模型(quantize.py生成)用 --backend int8 加载。
+# 导出：python onnxbackend.py export --model wav2lip
+#       python onnxbackend.py export --model ultralight --avatar_id ultralight_avatar1
+# 与pytorch结果对比：python onnxbackend.py parity --model wav2lip
+# 吞吐对比：python benchmark.py --model wav2lip --backend torch onnx
+
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from logger import logger
+
+# 各模型的输入名和不含batch维的输入形状，顺序与forward参数一致
+INPUTS = {
+    'wav2lip': [('audio', (1, 80, 16)), ('face', (6, 256, 256))],
+    'ultralight': [('face', (6, 160, 160)), ('audio', (32, 32, 32))],
+}
+
+
+def onnx_path(model, avatar_id=''):
+    if model == 'wav2lip':
+        return "./models/wav2lip.onnx"
+    return f"./data/avatars/{avatar_id}/ultralight.onnx"
+
+
+def backend_file(base, backend):
+    """base为不带扩展名的模型路径，返回onnx/int8后端对应的文件"""
+    return base + ('.int8.onnx' if backend == 'int8' else '.onnx')
+
+
+class OrtModel:
+    """onnxruntime CPU推理，接口与torch模型一致：输入torch tensor，输出cpu上的torch tensor"""
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 优化后的图缓存到磁盘，下次启动跳过图优化
+        optimized_path = os.path.splitext(path)[0] + '.opt.onnx'
+        if os.path.exists(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(path):
+            path = optimized_path
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            sess_options.optimized_model_filepath = optimized_path
+        sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        sess_options.intra_op_num_threads = threads if threads > 0 else (os.cpu_count() or 1)
+        sess_options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, sess_options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        logger.info(f'onnxruntime loaded {path}, {sess_options.intra_op_num_threads} threads')
+
+    def __call__(self, *inputs):
+        feed = {name: np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+                for name, x in zip(self.input_names, inputs)}
+        return torch.from_numpy(self.session.run(None, feed)[0])
+
+    def eval(self):
+        return self
+
+
+def export(model, name, path, opset=17):
+    names = [n for n, _ in INPUTS[name]]
+    dummy = tuple(torch.randn(1, *shape) for _, shape in INPUTS[name])
+    model = model.float().cpu().eval()
+    torch.onnx.export(model, dummy, path,
+                      input_names=names, output_names=['output'],
+                      dynamic_axes={n: {0: 'batch'} for n in names + ['output']},
+                      opset_version=opset)
+    logger.info(f'exported {name} to {path}')
+
+
+def load_torch_model(opt):
+    if opt.model == 'wav2lip':
+        import lipreal
+        lipreal.device = 'cpu'
+        return lipreal.load_model("./models/wav2lip.pth")
+    import lightreal
+    lightreal.device = 'cpu'
+    return lightreal.load_avatar(opt.avatar_id)[0]
+
+
+@torch.no_grad()
+def parity(opt, path):
+    model = load_torch_model(opt)
+    ort_model = OrtModel(path, opt.threads)
+    worst = 0.0
+    for batch_size in opt.batch_sizes:
+        inputs = tuple(torch.rand(batch_size, *shape) for _, shape in INPUTS[opt.model])
+        expected = model(*inputs).numpy()
+        actual = ort_model(*inputs).numpy()
+        diff = np.abs(expected - actual).max()
+        worst = max(worst, diff)
+        print(f'batch {batch_size:>3}: max abs diff {diff:.2e}')
+    if worst > opt.atol:
+        raise SystemExit(f'parity check failed: {worst:.2e} > {opt.atol:.0e}')
+    print('parity ok')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['export', 'parity'])
+    parser.add_argument('--model', type=str, default='wav2lip', choices=list(INPUTS))
+    parser.add_argument('--avatar_id', type=str, default='', help="ultralight weights are per avatar")
+    parser.add_argument('--output', type=str, default='', help="defaults to next to the .pth")
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--atol', type=float, default=1e-3)
+    opt = parser.parse_args()
+
+    path = opt.output or onnx_path(opt.model, opt.avatar_id)
+    if opt.command == 'export':
+        export(load_torch_model(opt), opt.model, path, opt.opset)
+    else:
+        parity(opt, path)
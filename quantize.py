@@ -0,0 +1,187 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# wav2lip / ultralight的int8静态量化。用avatar的face_imgs和一段语音的音频特征做校准，
+# 在导出的onnx上量化，生成的 *.int8.onnx 用 --backend int8 加载。
+# 量化后给出嘴部区域相对fp32的PSNR/SSIM，以及fp32/int8的吞吐对比。
+# python onnxbackend.py export --model wav2lip
+# python quantize.py --model wav2lip --avatar_id wav2lip256_avatar1 --wav test.wav
+
+import argparse
+
+import cv2
+import numpy as np
+import torch
+
+from benchmark import run
+from logger import logger
+from onnxbackend import INPUTS, OrtModel, load_torch_model, onnx_path
+
+VIDEO_FPS = 25
+
+
+def mouth_region(model, height, width):
+    # 模型重新生成的、包含嘴部的区域
+    if model == 'wav2lip':
+        return slice(height//2, height), slice(0, width)
+    return slice(80, 150), slice(5, 155)  # ultralight被涂黑区域(5,5,150,145)的下半部分
+
+
+def face_inputs(opt):
+    if opt.model == 'wav2lip':
+        import lipreal
+        lipreal.device = 'cpu'
+        return lipreal.load_avatar(opt.avatar_id)[1]
+    import lightreal
+    lightreal.device = 'cpu'
+    return lightreal.load_avatar(opt.avatar_id)[4]
+
+
+def audio_inputs(opt, wav):
+    """按推理时的方式算出每个视频帧对应的音频特征，第一维为帧"""
+    if opt.model == 'wav2lip':
+        from wav2lip import audio
+        mel = audio.melspectrogram(wav)
+        chunks = []
+        for i in range(int(mel.shape[1] * VIDEO_FPS / 80)):
+            start_idx = min(int(i * 80. / VIDEO_FPS), mel.shape[1] - 16)
+            chunks.append(mel[:, start_idx:start_idx + 16])
+        return torch.from_numpy(np.asarray(chunks, dtype=np.float32)).unsqueeze(1)
+    from ultralight.audio2feature import Audio2Feature
+    audio_processor = Audio2Feature()
+    feats = audio_processor.get_hubert_from_16k_speech(wav)
+    nframes = int(feats.shape[0] * VIDEO_FPS / 50)
+    chunks = audio_processor.feature2chunks(feature_array=feats, fps=VIDEO_FPS, batch_size=nframes)
+    return torch.from_numpy(chunks).view(-1, 32, 32, 32)
+
+
+def calibration_set(opt):
+    from replay import load_wav
+    faces = face_inputs(opt)
+    feats = audio_inputs(opt, load_wav(opt.wav))
+    n = min(opt.num, faces.shape[0], feats.shape[0])
+    faces = faces[torch.linspace(0, faces.shape[0] - 1, n).long()]
+    feats = feats[torch.linspace(0, feats.shape[0] - 1, n).long()]
+    if opt.model == 'wav2lip':
+        return feats, faces
+    return faces, feats
+
+
+class CalibrationReader:
+    """onnxruntime.quantization的CalibrationDataReader，每次给一个batch"""
+    def __init__(self, names, inputs, batch_size):
+        self.batches = []
+        for i in range(0, inputs[0].shape[0], batch_size):
+            self.batches.append({name: x[i:i+batch_size].numpy() for name, x in zip(names, inputs)})
+        self.iter = iter(self.batches)
+
+    def get_next(self):
+        return next(self.iter, None)
+
+    def rewind(self):
+        self.iter = iter(self.batches)
+
+
+def quantize(opt, fp32_path, int8_path, inputs):
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    prep_path = fp32_path.replace('.onnx', '.prep.onnx')
+    quant_pre_process(fp32_path, prep_path)
+    names = [n for n, _ in INPUTS[opt.model]]
+    quantize_static(prep_path, int8_path, CalibrationReader(names, inputs, opt.calib_batch),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax if opt.calib == 'minmax' else CalibrationMethod.Percentile)
+    logger.info(f'saved {int8_path}')
+
+
+def to_images(pred):
+    return (pred.clamp(0, 1).numpy().transpose(0, 2, 3, 1) * 255.).round().astype(np.uint8)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def ssim(a, b):
+    # 灰度图上的SSIM，高斯窗口11x11 sigma 1.5
+    a = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    b = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    blur = lambda x: cv2.GaussianBlur(x, (11, 11), 1.5)
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return ssim_map.mean()
+
+
+@torch.no_grad()
+def quality_report(opt, model, int8_model, inputs):
+    expected, actual = [], []
+    for i in range(0, inputs[0].shape[0], opt.calib_batch):
+        batch = tuple(x[i:i+opt.calib_batch] for x in inputs)
+        expected.append(to_images(model(*batch)))
+        actual.append(to_images(int8_model(*batch)))
+    expected, actual = np.concatenate(expected), np.concatenate(actual)
+    rows, cols = mouth_region(opt.model, *expected.shape[1:3])
+    psnrs = [psnr(e[rows, cols], a[rows, cols]) for e, a in zip(expected, actual)]
+    ssims = [ssim(np.ascontiguousarray(e[rows, cols]), np.ascontiguousarray(a[rows, cols])) for e, a in zip(expected, actual)]
+    print(f'mouth region vs fp32 over {len(psnrs)} frames: '
+          f'PSNR mean {np.mean(psnrs):.2f}dB min {np.min(psnrs):.2f}dB, SSIM mean {np.mean(ssims):.4f} min {np.min(ssims):.4f}')
+
+
+def throughput_report(opt, models, faces, feat_shape):
+    print(f"{'model':>8}{'batch':>6}{'ms/batch':>12}{'fps':>10}")
+    for name, model in models:
+        if opt.model == 'wav2lip':
+            forward = lambda img_batch, mel_batch, model=model: model(mel_batch, img_batch)
+        else:
+            forward = model
+        for batch_size in opt.batch_sizes:
+            timings = run(forward, faces, feat_shape, batch_size, opt.iters, 3)
+            print(f'{name:>8}{batch_size:>6}{timings.mean()*1000:>12.2f}{batch_size/timings.mean():>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='wav2lip', choices=list(INPUTS))
+    parser.add_argument('--avatar_id', type=str, default='avator_1', help="face_imgs used for calibration")
+    parser.add_argument('--wav', type=str, required=True, help="speech used for calibration audio features")
+    parser.add_argument('--num', type=int, default=256, help="number of calibration frames")
+    parser.add_argument('--calib_batch', type=int, default=16)
+    parser.add_argument('--calib', type=str, default='minmax', choices=['minmax', 'percentile'])
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--iters', type=int, default=10)
+    opt = parser.parse_args()
+
+    fp32_path = onnx_path(opt.model, opt.avatar_id)
+    int8_path = fp32_path.replace('.onnx', '.int8.onnx')
+    inputs = calibration_set(opt)
+    quantize(opt, fp32_path, int8_path, inputs)
+
+    model = load_torch_model(opt)
+    int8_model = OrtModel(int8_path, opt.threads)
+    quality_report(opt, model, int8_model, inputs)
+
+    faces = inputs[1] if opt.model == 'wav2lip' else inputs[0]
+    feat_shape = dict(INPUTS[opt.model])['audio']
+    throughput_report(opt, [('fp32', model), ('onnx', OrtModel(fp32_path, opt.threads)), ('int8', int8_model)],
+                      faces, feat_shape)
@@ -0,0 +1,283 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 离线回放：把一段wav按 asr.run_step -> inference -> process_frames 跑完整条流水线，
+# 不做实时节流、不走网络，输出到空sink或文件，并给出cProfile结果和各阶段耗时表。
+# python replay.py --model wav2lip --avatar_id wav2lip256_avatar1 --wav test.wav --profile_out replay.prof
+
+import argparse
+import asyncio
+import cProfile
+import pstats
+import sys
+import threading
+import time
+from threading import Thread, Event
+
+import numpy as np
+import resampy
+import soundfile as sf
+
+from logger import logger
+
+# (阶段名, 文件名后缀, 函数名)；文件名为'~'表示C实现的内置函数，按函数名子串匹配
+STAGES = [
+    ('asr.run_step',    'asr.py',                  'run_step'),
+    ('  mel',           'wav2lip/audio.py',        'melspectrogram'),
+    ('  whisper',       'audio2feature.py',        'audio2feat'),
+    ('  hubert',        'audio2feature.py',        'get_hubert_from_16k_speech'),
+    ('inference',       'real.py',                 'inference'),
+    ('  model forward', 'torch/nn/modules/module.py', '_call_impl'),
+    ('process_frames',  'real.py',                 'process_frames'),
+    ('  blending',      'blending.py',             'get_image_blending'),
+    ('  resize',        '~',                       'cv2.resize'),
+    ('  to VideoFrame', '~',                       'from_ndarray'),
+    ('sink encode',     'replay.py',               'write'),
+]
+
+
+class NullQueue:
+    """代替PlayerStreamTrack._queue(FrameRing)，process_frames直接往这里put"""
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.count = 0
+        self.last_eventpoint = None
+
+    def qsize(self):
+        return 0
+
+    def put(self, item):
+        self.count += 1
+        frame, eventpoint = item
+        if eventpoint:
+            self.last_eventpoint = eventpoint
+        if self.sink is not None:
+            self.sink.write(frame)
+
+    def put_many(self, items):
+        for item in items:
+            self.put(item)
+
+
+class NullTrack:
+    def __init__(self, kind, sink=None):
+        self.kind = kind
+        self._queue = NullQueue(sink)
+
+
+class FileSink:
+    """把回放结果编码写入文件，编码耗时会计入 'sink encode' 阶段"""
+    def __init__(self, path):
+        import av
+        self.container = av.open(path, mode='w')
+        self.vstream = None
+        self.astream = self.container.add_stream('aac', rate=16000)
+        self.vcount = 0
+
+    def write(self, frame):
+        from av import VideoFrame
+        if isinstance(frame, VideoFrame):
+            if self.vstream is None:
+                self.vstream = self.container.add_stream('libx264', rate=25)
+                self.vstream.width = frame.width
+                self.vstream.height = frame.height
+                self.vstream.pix_fmt = 'yuv420p'
+            frame.pts = self.vcount
+            self.vcount += 1
+            packets = self.vstream.encode(frame)
+        else:
+            frame.pts = None
+            packets = self.astream.encode(frame)
+        self.container.mux(packets)
+
+    def close(self):
+        if self.vstream is not None:
+            self.container.mux(self.vstream.encode(None))
+        self.container.mux(self.astream.encode(None))
+        self.container.close()
+
+
+class ThreadProfiler:
+    """对上下文内启动的所有线程做cProfile，最后合并成一份pstats"""
+    def __init__(self):
+        self.profiles = []
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._orig_run = threading.Thread.run
+        self.main = cProfile.Profile()
+        if sys.version_info < (3, 12):
+            profiler = self
+            def run(thread):
+                prof = cProfile.Profile()
+                with profiler._lock:
+                    profiler.profiles.append(prof)
+                    profiler.threads.append(thread)
+                prof.enable()
+                try:
+                    profiler._orig_run(thread)
+                finally:
+                    prof.disable()
+            threading.Thread.run = run
+        # python3.12起cProfile基于sys.monitoring，对所有线程生效，只能有一个profiler
+        self.main.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.main.disable()
+        threading.Thread.run = self._orig_run
+
+    def join(self, timeout=5):
+        for thread in list(self.threads):
+            thread.join(timeout)
+
+    def stats(self):
+        st = pstats.Stats(self.main)
+        for prof in self.profiles:
+            st.add(prof)
+        return st
+
+
+def stage_table(st, walltime):
+    rows = []
+    for name, filesuffix, funcname in STAGES:
+        calls = 0
+        cumtime = 0.0
+        for (filename, _, func), (cc, nc, tt, ct, callers) in st.stats.items():
+            if filesuffix == '~':
+                if filename != '~' or funcname not in func:
+                    continue
+            elif func != funcname or not filename.replace('\\', '/').endswith(filesuffix):
+                continue
+            calls += nc
+            cumtime += ct
+        if calls > 0:
+            rows.append((name, calls, cumtime))
+    lines = [f"{'stage':<18}{'calls':>10}{'total(s)':>12}{'per call(ms)':>15}{'% wall':>9}"]
+    for name, calls, cumtime in rows:
+        lines.append(f'{name:<18}{calls:>10}{cumtime:>12.3f}{cumtime*1000/calls:>15.3f}{cumtime*100/walltime:>9.1f}')
+    return '\n'.join(lines)
+
+
+def load_wav(path, sample_rate=16000):
+    stream, sr = sf.read(path, dtype='float32')
+    if stream.ndim > 1:
+        stream = stream[:, 0]
+    if sr != sample_rate and stream.shape[0] > 0:
+        stream = resampy.resample(x=stream, sr_orig=sr, sr_new=sample_rate)
+    return stream
+
+
+def load_model_and_avatar(opt):
+    if opt.model == 'wav2lip':
+        from lipreal import LipReal, load_avatar, load_model, warm_up
+        model = load_model("./models/wav2lip.pth")
+        avatar = load_avatar(opt.avatar_id)
+        warm_up(opt.batch_size, model, 256)
+        return LipReal, model, avatar
+    elif opt.model == 'musetalk':
+        from musereal import MuseReal, load_avatar, load_model, warm_up
+        model = load_model()
+        avatar = load_avatar(opt.avatar_id)
+        warm_up(opt.batch_size, model)
+        return MuseReal, model, avatar
+    elif opt.model == 'ultralight':
+        from lightreal import LightReal, load_avatar, load_model, warm_up
+        model = load_model(opt)
+        avatar = load_avatar(opt.avatar_id)
+        warm_up(opt.batch_size, avatar, 160)
+        return LightReal, model, avatar
+    raise ValueError(f'replay does not support model {opt.model}')
+
+
+def replay(opt):
+    realcls, model, avatar = load_model_and_avatar(opt)
+    stream = load_wav(opt.wav)
+    chunk = 16000 // opt.fps
+    nchunks = stream.shape[0] // chunk
+    logger.info(f'replay {opt.wav}: {nchunks} audio chunks, {nchunks*chunk/16000:.2f}s')
+
+    sink = FileSink(opt.output) if opt.sink == 'file' else None
+    audio_track = NullTrack('audio', sink)
+    video_track = NullTrack('video', sink)
+
+    loop = asyncio.new_event_loop()
+
+    opt.sessionid = 0
+    nerfreal = realcls(opt, model, avatar)
+    for i in range(nchunks):
+        eventpoint = {'status': 'end', 'text': opt.wav} if i == nchunks - 1 else None
+        nerfreal.put_audio_frame(stream[i*chunk:(i+1)*chunk], eventpoint)
+
+    quit_event = Event()
+    with ThreadProfiler() as profiler:
+        loopthread = Thread(target=loop.run_forever, daemon=True)
+        loopthread.start()
+        starttime = time.perf_counter()
+        renderthread = Thread(target=nerfreal.render, args=(quit_event, loop, audio_track, video_track))
+        renderthread.start()
+        while audio_track._queue.last_eventpoint is None:
+            if not renderthread.is_alive():
+                break
+            time.sleep(0.01)
+        walltime = time.perf_counter() - starttime
+        quit_event.set()
+        renderthread.join()
+        loop.call_soon_threadsafe(loop.stop)
+        profiler.join()
+    if sink is not None:
+        sink.close()
+
+    st = profiler.stats()
+    if opt.profile_out:
+        st.dump_stats(opt.profile_out)
+        logger.info(f'profile saved to {opt.profile_out}')
+    vframes = video_track._queue.count
+    print(f'replayed {nchunks*chunk/16000:.2f}s audio in {walltime:.3f}s, '
+          f'{vframes} video frames, {vframes/walltime:.2f} fps')
+    print(stage_table(st, walltime))
+    if opt.top > 0:
+        st.sort_stats('cumulative').print_stats(opt.top)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wav', type=str, required=True, help="audio to replay, tts result can be recorded to a wav first")
+    parser.add_argument('--model', type=str, default='wav2lip')  # musetalk ultralight
+    parser.add_argument('--avatar_id', type=str, default='avator_1')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--fps', type=int, default=50)
+    parser.add_argument('-l', type=int, default=10)
+    parser.add_argument('-m', type=int, default=8)
+    parser.add_argument('-r', type=int, default=10)
+    parser.add_argument('--W', type=int, default=450)
+    parser.add_argument('--H', type=int, default=450)
+    parser.add_argument('--tts', type=str, default='edgetts')
+    parser.add_argument('--REF_FILE', type=str, default=None)
+    parser.add_argument('--REF_TEXT', type=str, default=None)
+    parser.add_argument('--TTS_SERVER', type=str, default='http://127.0.0.1:9880')
+    parser.add_argument('--sink', type=str, default='null', help="null or file")
+    parser.add_argument('--output', type=str, default='replay.mp4', help="output file when --sink file")
+    parser.add_argument('--profile_out', type=str, default='', help="dump pstats file, view with snakeviz or python -m pstats")
+    parser.add_argument('--top', type=int, default=0, help="print top N functions by cumulative time")
+    opt = parser.parse_args()
+    opt.customopt = []
+    opt.transport = 'webrtc'
+    opt.idle_packets = 0
+
+    replay(opt)
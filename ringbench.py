@@ -0,0 +1,76 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 线程间队列单元素开销：一个生产线程put，主线程get，分别测mp.Queue、queue.Queue和RingQueue。
+# 元素和实际运行时一致：20ms音频帧(output_queue)、一批mel特征(feat_queue)、一批推理结果(res_frame_queue)
+# python ringbench.py --batch_size 16 --items 5000
+
+import argparse
+import multiprocessing as mp
+import queue
+import time
+from threading import Thread
+
+import numpy as np
+
+from ringqueue import RingQueue
+
+
+def make_items(batch_size, modelres):
+    audio = np.random.rand(320).astype(np.float32)
+    mel = [np.random.rand(80, 16).astype(np.float32) for _ in range(batch_size)]
+    res = np.random.randint(0, 255, (modelres, modelres, 3), dtype=np.uint8)
+    return {
+        'audio frame': (audio, 0, None),
+        'feat batch': mel,
+        'res frame': (res, 0, [(audio, 0, None), (audio, 0, None)]),
+    }
+
+
+def run(q, item, items):
+    def produce():
+        for _ in range(items):
+            q.put(item)
+
+    producer = Thread(target=produce, daemon=True)
+    t = time.perf_counter()
+    producer.start()
+    for _ in range(items):
+        q.get(block=True, timeout=5)
+    elapsed = time.perf_counter() - t
+    producer.join()
+    return elapsed / items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--modelres', type=int, default=256)
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--capacity', type=int, default=32)
+    opt = parser.parse_args()
+
+    queues = [
+        ('mp.Queue', lambda: mp.Queue(opt.capacity)),
+        ('queue.Queue', lambda: queue.Queue(opt.capacity)),
+        ('RingQueue', lambda: RingQueue(opt.capacity)),
+    ]
+    for name, item in make_items(opt.batch_size, opt.modelres).items():
+        print(f'{name}:')
+        for qname, factory in queues:
+            per_item = run(factory(), item, opt.items)
+            print(f'{qname:>14}: {per_item * 1e6:8.1f}us/item')
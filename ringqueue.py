@@ -0,0 +1,98 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 同一进程内线程之间传音频帧、特征批和推理结果用的环形队列。
+# asr -> 推理线程 -> process_frames 都是线程，用mp.Queue时每个元素都要pickle再经过管道和feeder线程，
+# 这里元素按引用放进预先分配好的槽位里。只有真正跨进程的地方才需要mp.Queue。
+# 单帧开销对比：python ringbench.py
+
+import time
+from queue import Empty, Full
+from threading import Condition, Lock
+
+
+class RingQueue:
+    """固定容量的线程间队列，接口和queue.Queue一致：put/get支持block和timeout，
+    满/空时抛出queue.Full/queue.Empty"""
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._head = 0  # 下一个出队的槽位
+        self._size = 0
+        lock = Lock()
+        self._not_empty = Condition(lock)
+        self._not_full = Condition(lock)
+
+    def _wait(self, cond, ready, block, timeout, exc):
+        if ready():
+            return
+        if not block:
+            raise exc
+        if timeout is None:
+            while not ready():
+                cond.wait()
+            return
+        if timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        deadline = time.monotonic() + timeout
+        while not ready():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise exc
+            cond.wait(remaining)
+
+    def put(self, item, block=True, timeout=None):
+        with self._not_full:
+            self._wait(self._not_full, lambda: self._size < self.capacity, block, timeout, Full)
+            self._slots[(self._head + self._size) % self.capacity] = item
+            self._size += 1
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            self._wait(self._not_empty, lambda: self._size > 0, block, timeout, Empty)
+            item = self._slots[self._head]
+            self._slots[self._head] = None  # 不再引用已取走的帧
+            self._head = (self._head + 1) % self.capacity
+            self._size -= 1
+            self._not_full.notify()
+            return item
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def clear(self):
+        with self._not_full:
+            self._slots = [None] * self.capacity
+            self._head = 0
+            self._size = 0
+            self._not_full.notify_all()
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def full(self):
+        return self._size == self.capacity
@@ -0,0 +1,278 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 多进程部署：启动K个app.py worker进程(各自加载一份模型，可绑定GPU或CPU核)，
+# 本进程在--listenport上做前端路由。/offer分配给负载最低的worker，之后带sessionid的
+# /human /humanaudio /record等按会话所在的worker转发。webrtc媒体流由浏览器直接连worker。
+# worker退出后自动重启。/workers返回各worker的健康状态和负载。
+# python router.py --workers 2 --gpus 0,1 -- --transport webrtc --model wav2lip --avatar_id wav2lip256_avatar1 --max_session 4
+# 按CPU核绑定：--cpus "0-7;8-15"
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+import aiohttp_cors
+from aiohttp import web
+
+import metrics
+from logger import logger
+
+
+def parse_cpus(spec):
+    cpus = set()
+    for part in spec.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+class Worker:
+    def __init__(self, index, stride, port, app_args, gpu=None, cpus=None):
+        self.index = index
+        self.stride = stride  # worker数，各worker的会话id按index取余数区分
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.app_args = app_args
+        self.gpu = gpu
+        self.cpus = cpus
+        self.proc = None
+        self.healthy = False
+        self.active = 0
+        self.max_session = 1
+        self.sessions = set()
+        self.pending = 0  # 已分配、还在协商中的/offer
+        self.restarts = 0
+        self.started = 0.0
+
+    def start(self):
+        env = dict(os.environ)
+        if self.gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = self.gpu
+        preexec_fn = None
+        if self.cpus:
+            env['OMP_NUM_THREADS'] = str(len(self.cpus))
+            preexec_fn = lambda: os.sched_setaffinity(0, self.cpus)
+        cmd = [sys.executable, 'app.py'] + self.app_args + ['--listenport', str(self.port),
+                                                           '--session_id_base', str(self.index),
+                                                           '--session_id_stride', str(self.stride)]
+        self.proc = subprocess.Popen(cmd, env=env, preexec_fn=preexec_fn)
+        self.started = time.time()
+        self.healthy = False
+        logger.info(f'worker {self.index}: pid {self.proc.pid} port {self.port} gpu {self.gpu} cpus {self.cpus}')
+
+    def load(self):
+        return (self.active + self.pending) / max(self.max_session, 1)
+
+    def has_capacity(self):
+        return self.healthy and self.active + self.pending < self.max_session
+
+    def info(self):
+        return {'index': self.index, 'port': self.port, 'pid': self.proc.pid if self.proc else None,
+                'healthy': self.healthy, 'active': self.active, 'pending': self.pending,
+                'max_session': self.max_session, 'sessions': sorted(self.sessions),
+                'restarts': self.restarts, 'gpu': self.gpu,
+                'cpus': sorted(self.cpus) if self.cpus else None}
+
+
+class Router:
+    def __init__(self, workers, health_interval=1.0):
+        self.workers = workers
+        self.health_interval = health_interval
+        self.session_worker = {}  # sessionid -> Worker
+        self.client = None
+        metrics.GaugeCallback('livetalking_router_worker_up', 'worker answered the last health check', ['worker'],
+                              lambda: [((w.index,), int(w.healthy)) for w in self.workers])
+        metrics.GaugeCallback('livetalking_router_worker_sessions', 'sessions per worker', ['worker'],
+                              lambda: [((w.index,), w.active) for w in self.workers])
+        metrics.GaugeCallback('livetalking_router_worker_restarts', 'times the worker process was restarted', ['worker'],
+                              lambda: [((w.index,), w.restarts) for w in self.workers])
+
+    async def on_startup(self, app):
+        self.client = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        app['supervise'] = asyncio.ensure_future(self.supervise())
+
+    async def on_shutdown(self, app):
+        app['supervise'].cancel()
+        await self.client.close()
+        for worker in self.workers:
+            if worker.proc and worker.proc.poll() is None:
+                worker.proc.terminate()
+
+    async def supervise(self):
+        while True:
+            for worker in self.workers:
+                if worker.proc.poll() is not None:
+                    logger.warning(f'worker {worker.index} exited with {worker.proc.returncode}, restarting')
+                    for sessionid in worker.sessions:
+                        self.session_worker.pop(sessionid, None)
+                    worker.sessions.clear()
+                    worker.active = worker.pending = 0
+                    worker.restarts += 1
+                    worker.start()
+                    continue
+                await self.check(worker)
+            await asyncio.sleep(self.health_interval)
+
+    async def check(self, worker):
+        # 请求发出后/offer新建的会话不在这次的返回里，不能当成已结束
+        known = set(worker.sessions)
+        try:
+            async with self.client.get(worker.url + '/health', timeout=aiohttp.ClientTimeout(total=2)) as response:
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            worker.healthy = False  # 还在加载模型，或者卡住了
+            return
+        worker.healthy = True
+        worker.max_session = data['max_session']
+        sessions = set(data['sessions'])
+        for sessionid in known - sessions:  # 会话已结束
+            if self.session_worker.get(sessionid) is worker:
+                del self.session_worker[sessionid]
+        added = worker.sessions - known - sessions
+        worker.sessions = sessions | added
+        worker.active = data['active'] + len(added)
+        for sessionid in sessions:
+            self.session_worker[sessionid] = worker
+
+    async def forward(self, worker, path, **kwargs):
+        async with self.client.post(worker.url + path, **kwargs) as response:
+            body = await response.read()
+            return web.Response(body=body, status=response.status,
+                                content_type=response.content_type)
+
+    async def offer(self, request):
+        candidates = [w for w in self.workers if w.has_capacity()]
+        if not candidates:
+            return web.Response(content_type="application/json",
+                                text=json.dumps({"code": -1, "msg": "已达到最大会话数限制"}), status=429)
+        worker = min(candidates, key=Worker.load)
+        worker.pending += 1
+        try:
+            async with self.client.post(worker.url + '/offer', data=await request.read(),
+                                        headers={'Content-Type': 'application/json'}) as response:
+                body = await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            logger.error(f'worker {worker.index} /offer failed: {e!r}')
+            return web.Response(content_type="application/json",
+                                text=json.dumps({"code": -1, "msg": "worker unavailable"}), status=502)
+        finally:
+            worker.pending -= 1
+        if status == 200:
+            sessionid = json.loads(body).get('sessionid')
+            if sessionid is not None:
+                other = self.session_worker.get(sessionid)
+                if other is not None and other is not worker:
+                    logger.error(f'session {sessionid} of worker {worker.index} already on worker {other.index}')
+                self.session_worker[sessionid] = worker
+                worker.sessions.add(sessionid)
+                worker.active += 1
+        return web.Response(body=body, status=status, content_type="application/json")
+
+    def worker_for(self, sessionid):
+        worker = self.session_worker.get(sessionid)
+        if worker is None:
+            raise web.HTTPNotFound(content_type="application/json",
+                                   text=json.dumps({"code": -1, "msg": f"session {sessionid} not found"}))
+        return worker
+
+    async def session_json(self, request):
+        # /human /set_audiotype /record /is_speaking，body为带sessionid的json
+        body = await request.read()
+        worker = self.worker_for(json.loads(body).get('sessionid', 0))
+        return await self.forward(worker, request.path, data=body,
+                                  headers={'Content-Type': 'application/json'})
+
+    async def humanaudio(self, request):
+        form = await request.post()
+        worker = self.worker_for(int(form.get('sessionid', 0)))
+        data = aiohttp.FormData()
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                data.add_field(key, value.file.read(), filename=value.filename, content_type=value.content_type)
+            else:
+                data.add_field(key, value)
+        return await self.forward(worker, request.path, data=data)
+
+    async def workers_handler(self, request):
+        return web.Response(content_type="application/json",
+                            text=json.dumps([w.info() for w in self.workers]))
+
+    async def metrics_handler(self, request):
+        return web.Response(body=metrics.generate_latest().encode('utf-8'),
+                            headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+def build_workers(opt, app_args):
+    gpus = opt.gpus.split(',') if opt.gpus else []
+    cpus = [parse_cpus(spec) for spec in opt.cpus.split(';')] if opt.cpus else []
+    workers = []
+    for i in range(opt.workers):
+        workers.append(Worker(i, opt.workers, opt.worker_port + i, app_args,
+                              gpus[i % len(gpus)] if gpus else None,
+                              cpus[i % len(cpus)] if cpus else None))
+    return workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage='python router.py [router options] -- [app.py options]')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--listenport', type=int, default=8010)
+    parser.add_argument('--worker_port', type=int, default=8100, help="worker i listens on worker_port+i")
+    parser.add_argument('--gpus', type=str, default='', help="comma separated CUDA devices, assigned round robin")
+    parser.add_argument('--cpus', type=str, default='', help="per-worker cpu lists separated by ';', e.g. '0-7;8-15'")
+    parser.add_argument('--health_interval', type=float, default=1.0)
+    argv = sys.argv[1:]
+    app_args = []
+    if '--' in argv:
+        app_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    opt = parser.parse_args(argv)
+
+    workers = build_workers(opt, app_args)
+    for worker in workers:
+        worker.start()
+    router = Router(workers, opt.health_interval)
+
+    appasync = web.Application()
+    appasync.on_startup.append(router.on_startup)
+    appasync.on_shutdown.append(router.on_shutdown)
+    appasync.router.add_post("/offer", router.offer)
+    for path in ("/human", "/set_audiotype", "/record", "/is_speaking"):
+        appasync.router.add_post(path, router.session_json)
+    appasync.router.add_post("/humanaudio", router.humanaudio)
+    appasync.router.add_get("/workers", router.workers_handler)
+    appasync.router.add_get("/metrics", router.metrics_handler)
+    appasync.router.add_static("/", path="web")
+
+    cors = aiohttp_cors.setup(appasync, defaults={
+        "*": aiohttp_cors.ResourceOptions(allow_credentials=True, expose_headers="*", allow_headers="*")
+    })
+    for route in list(appasync.router.routes()):
+        cors.add(route)
+
+    logger.info(f'router on http://<serverip>:{opt.listenport}/, {opt.workers} workers from port {opt.worker_port}')
+    web.run_app(appasync, host="0.0.0.0", port=opt.listenport)
@@ -0,0 +1,116 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 预先创建好的空闲会话池。会话对象的构造(tts、asr warm_up、自定义视频等)放到后台线程里做，
+# /offer直接取一个现成的，不再等待构造。会话在render()之前不启动任何线程，放在池里只占内存。
+# 启动时加 --session_pool N 开启，0为关闭(每次/offer现场构造)。
+
+import queue
+import time
+from threading import Event, Lock, Thread
+
+import metrics
+from logger import logger
+
+POOL_REQUESTS = metrics.Counter('livetalking_session_pool_requests_total',
+                                '/offer session requests, hit = taken from the warm pool', ['result'])
+SESSION_BUILD_SECONDS = metrics.Histogram('livetalking_session_build_seconds',
+                                          'time to construct a session object', ['source'],
+                                          buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+class SessionPool:
+    """build(sessionid)构造会话；new_id()生成会话id；capacity()返回当前还能再创建几个会话，
+    池里的会话也算在内，避免超过--max_session占用的内存。
+    池里的会话还不在nerfreals里，会话id由reserve_id()分配并占用，调用方把会话放进nerfreals后release_id()"""
+    def __init__(self, build, new_id, size, capacity):
+        self.build_fn = build
+        self.new_id = new_id
+        self.size = size
+        self.capacity = capacity
+        self.pool = queue.Queue()
+        self.id_lock = Lock()  # 保护下面两项
+        self.reserved = set()  # 已分配、还没放进nerfreals的会话id(包括池里的)
+        # 正在现场构造的/offer数。/offer不等后台补充，直接构造；有/offer在构造时后台补充先暂停，
+        # 不和它抢cpu/gpu
+        self.demand = 0
+        self.wakeup = Event()
+        self._hit = POOL_REQUESTS.labels('hit')
+        self._miss = POOL_REQUESTS.labels('miss')
+        metrics.GaugeCallback('livetalking_session_pool_size', 'warm sessions waiting in the pool',
+                              ['state'], lambda: [(('idle',), self.pool.qsize()), (('target',), self.size)])
+
+    def start(self):
+        if self.size > 0:
+            Thread(target=self._refill, daemon=True, name='session-pool').start()
+
+    def reserve_id(self):
+        with self.id_lock:
+            while True:
+                sessionid = self.new_id()
+                if sessionid not in self.reserved:
+                    self.reserved.add(sessionid)
+                    return sessionid
+
+    def release_id(self, sessionid):
+        with self.id_lock:
+            self.reserved.discard(sessionid)
+
+    def build(self, sessionid, source='offer'):
+        if source == 'offer':
+            with self.id_lock:
+                self.demand += 1
+        try:
+            t = time.perf_counter()
+            nerfreal = self.build_fn(sessionid)
+            SESSION_BUILD_SECONDS.labels(source).observe(time.perf_counter() - t)
+        finally:
+            if source == 'offer':
+                with self.id_lock:
+                    self.demand -= 1
+                self.wakeup.set()
+        return nerfreal
+
+    def take(self):
+        """取一个预先构造好的会话，返回(sessionid, nerfreal)，池空时返回None，由调用方现场构造"""
+        try:
+            item = self.pool.get_nowait()
+        except queue.Empty:
+            self._miss.inc()
+            self.wakeup.set()
+            return None
+        self._hit.inc()
+        self.wakeup.set()
+        return item
+
+    def _refill(self):
+        while True:
+            if (self.demand > 0 or self.pool.qsize() >= self.size
+                    or self.capacity() <= self.pool.qsize()):
+                self.wakeup.wait(timeout=1)
+                self.wakeup.clear()
+                continue
+            sessionid = self.reserve_id()
+            try:
+                nerfreal = self.build(sessionid, 'pool')
+            except Exception:
+                self.release_id(sessionid)
+                logger.exception('session pool: build failed')
+                time.sleep(5)
+                continue
+            self.pool.put((sessionid, nerfreal))
+            logger.info(f'session pool: {sessionid} ready, {self.pool.qsize()}/{self.size} idle')
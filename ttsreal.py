@@ -17,10 +17,7 @@
 from __future__ import annotations
 import time
 import numpy as np
-import soundfile as sf
-import resampy
 import asyncio
-import edge_tts
 
 import os
 import hmac
@@ -30,8 +27,7 @@ import json
 import uuid
 
 from typing import Iterator
-
-import requests
+# soundfile、resampy(依赖numba)、edge_tts、requests导入较慢，在用到的函数里才导入
 
 import queue
 from queue import Queue
@@ -44,6 +40,7 @@ if TYPE_CHECKING:
     from basereal import BaseReal
 
 from logger import logger
+import metrics
 class State(Enum):
     RUNNING=0
     PAUSE=1
@@ -118,6 +115,8 @@ class EdgeTTS(BaseTTS):
         self.input_stream.truncate() 
 
     def __create_bytes_stream(self,byte_stream):
+        import resampy
+        import soundfile as sf
         #byte_stream=BytesIO(buffer)
         stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
         logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
@@ -134,6 +133,8 @@ class EdgeTTS(BaseTTS):
         return stream
     
     async def __main(self,voicename: str, text: str):
+        import edge_tts
+        start = time.perf_counter()
         try:
             communicate = edge_tts.Communicate(text, voicename)
 
@@ -141,6 +142,7 @@ class EdgeTTS(BaseTTS):
             first = True
             async for chunk in communicate.stream():
                 if first:
+                    metrics.TTS_FIRST_CHUNK_SECONDS.labels(self.opt.tts).observe(time.perf_counter()-start)
                     first = False
                 if chunk["type"] == "audio" and self.state==State.RUNNING:
                     #self.push_audio(chunk["data"])
@@ -167,6 +169,7 @@ class FishTTS(BaseTTS):
         )
 
     def fish_speech(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+        import requests
         start = time.perf_counter()
         req={
             'text':text,
@@ -198,6 +201,7 @@ class FishTTS(BaseTTS):
                 if first:
                     end = time.perf_counter()
                     logger.info(f"fish_speech Time to first chunk: {end-start}s")
+                    metrics.TTS_FIRST_CHUNK_SECONDS.labels(self.opt.tts).observe(end-start)
                     first = False
                 if chunk and self.state==State.RUNNING:
                     yield chunk
@@ -206,6 +210,7 @@ class FishTTS(BaseTTS):
             logger.exception('fishtts')
 
     def stream_tts(self,audio_stream,msg):
+        import resampy
         text,textevent = msg
         first = True
         for chunk in audio_stream:
@@ -243,6 +248,7 @@ class SovitsTTS(BaseTTS):
         )
 
     def gpt_sovits(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+        import requests
         start = time.perf_counter()
         req={
             'text':text,
@@ -279,6 +285,7 @@ class SovitsTTS(BaseTTS):
                 if first:
                     end = time.perf_counter()
                     logger.info(f"gpt_sovits Time to first chunk: {end-start}s")
+                    metrics.TTS_FIRST_CHUNK_SECONDS.labels(self.opt.tts).observe(end-start)
                     first = False
                 if chunk and self.state==State.RUNNING:
                     yield chunk
@@ -287,6 +294,8 @@ class SovitsTTS(BaseTTS):
             logger.exception('sovits')
 
     def __create_bytes_stream(self,byte_stream):
+        import resampy
+        import soundfile as sf
         #byte_stream=BytesIO(buffer)
         stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
         logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
@@ -340,6 +349,7 @@ class CosyVoiceTTS(BaseTTS):
         )
 
     def cosy_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+        import requests
         start = time.perf_counter()
         payload = {
             'tts_text': text,
@@ -362,6 +372,7 @@ class CosyVoiceTTS(BaseTTS):
                 if first:
                     end = time.perf_counter()
                     logger.info(f"cosy_voice Time to first chunk: {end-start}s")
+                    metrics.TTS_FIRST_CHUNK_SECONDS.labels(self.opt.tts).observe(end-start)
                     first = False
                 if chunk and self.state==State.RUNNING:
                     yield chunk
@@ -369,6 +380,7 @@ class CosyVoiceTTS(BaseTTS):
             logger.exception('cosyvoice')
 
     def stream_tts(self,audio_stream,msg):
+        import resampy
         text,textevent = msg
         first = True
         for chunk in audio_stream:
@@ -453,6 +465,7 @@ class TencentTTS(BaseTTS):
         )
 
     def tencent_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
+        import requests
         start = time.perf_counter()
         session_id = str(uuid.uuid1())
         params = self.__gen_params(session_id, text)
@@ -483,6 +496,7 @@ class TencentTTS(BaseTTS):
                     except:
                         end = time.perf_counter()
                         logger.info(f"tencent Time to first chunk: {end-start}s")
+                        metrics.TTS_FIRST_CHUNK_SECONDS.labels(self.opt.tts).observe(end-start)
                         first = False                    
                 if chunk and self.state==State.RUNNING:
                     yield chunk
@@ -535,11 +549,13 @@ class XTTS(BaseTTS):
         )
 
     def get_speaker(self,ref_audio,server_url):
+        import requests
         files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
         response = requests.post(f"{server_url}/clone_speaker", files=files)
         return response.json()
 
     def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
+        import requests
         start = time.perf_counter()
         speaker["text"] = text
         speaker["language"] = language
@@ -563,6 +579,7 @@ class XTTS(BaseTTS):
                 if first:
                     end = time.perf_counter()
                     logger.info(f"xtts Time to first chunk: {end-start}s")
+                    metrics.TTS_FIRST_CHUNK_SECONDS.labels(self.opt.tts).observe(end-start)
                     first = False
                 if chunk:
                     yield chunk
@@ -570,6 +587,7 @@ class XTTS(BaseTTS):
             print(e)
     
     def stream_tts(self,audio_stream,msg):
+        import resampy
         text,textevent = msg
         first = True
         for chunk in audio_stream:
@@ -80,17 +80,14 @@ class Audio2Feature():
         return selected_feature,selected_idx
 
     def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [8,8],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps
-        i = 0
-        #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-
-        return whisper_chunks
+        """
+        与逐帧调用get_sliced_feature结果相同，但一次性按下标取出整批特征
+        :return: 连续的float32数组 [batch_size, sum(audio_feat_length)*2, 1024]
+        """
+        length = len(feature_array)
+        indices = []
+        for i in range(batch_size):
+            center_idx = int((i+start)*50/fps)
+            indices.append(range(center_idx-audio_feat_length[0]*2, center_idx+audio_feat_length[1]*2))
+        indices = np.clip(np.array(indices), 0, length-1)
+        return np.ascontiguousarray(np.asarray(feature_array)[indices], dtype=np.float32)
@@ -1,47 +1,30 @@
+# 流式生成wav2lip avatar：解码线程边读视频边送人脸检测，检测按批进行，
+# 裁剪缩放和原图编码放到进程池里，结果按帧序直接追加到打包格式(见avatarpack.py)，
+# 不再先把每帧写成PNG再读回来。每--checkpoint_every帧写一次progress.json，
+# 中断后用同样的参数重新运行会从检查点继续。
+# python genavatar.py --video_path xxx.mp4 --avatar_id wav2lip256_avatar1 --img_size 256
 import argparse
 import json
 import os
 import pickle
-import random
-import string
-import subprocess
+import queue
 import sys
-from glob import glob
-from os import listdir, path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
 
 import cv2
 import face_detection
 import numpy as np
-import scipy
 import torch
 from tqdm import tqdm
 
-parser = argparse.ArgumentParser(
-    description="Inference code to lip-sync videos in the wild using Wav2Lip models"
-)
-parser.add_argument("--img_size", default=96, type=int)
-parser.add_argument("--avatar_id", default="wav2lip_avatar1", type=str)
-parser.add_argument("--video_path", default="", type=str)
-parser.add_argument(
-    "--nosmooth",
-    default=False,
-    action="store_true",
-    help="Prevent smoothing face detections over a short temporal window",
-)
-parser.add_argument(
-    "--pads",
-    nargs="+",
-    type=int,
-    default=[0, 10, 0, 0],
-    help="Padding (top, bottom, left, right). Please adjust to include chin at least",
-)
-parser.add_argument(
-    "--face_det_batch_size", type=int, help="Batch size for face detection", default=16
-)
-args = parser.parse_args()
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from avatarpack import META_FILE, PackWriter
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-print("Using {} for inference.".format(device))
+
+SMOOTH_T = 5  # 人脸框平滑窗口
 
 
 def osmakedirs(path_list):
@@ -49,64 +32,81 @@ def osmakedirs(path_list):
         os.makedirs(path) if not os.path.exists(path) else None
 
 
-def video2imgs(vid_path, save_path, ext=".png", cut_frame=10000000):
+def read_frames(vid_path, start=0):
+    """逐帧解码，跳过前start帧(断点续做时已经处理过)"""
     cap = cv2.VideoCapture(vid_path)
-    count = 0
+    for _ in range(start):
+        if not cap.grab():
+            return
     while True:
-        if count > cut_frame:
-            break
         ret, frame = cap.read()
-        if ret:
-            cv2.putText(
-                frame,
-                "LiveTalking",
-                (10, 20),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.3,
-                (128, 128, 128),
-                1,
-            )
-            cv2.imwrite(f"{save_path}/{count:08d}.png", frame)
-            count += 1
-        else:
+        if not ret:
             break
+        cv2.putText(
+            frame,
+            "LiveTalking",
+            (10, 20),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.3,
+            (128, 128, 128),
+            1,
+        )
+        yield frame
+    cap.release()
 
 
-def read_imgs(img_list):
-    frames = []
-    print("reading images...")
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
+def prefetch(iterable, size):
+    # 解码放到单独线程里，和人脸检测重叠
+    q = queue.Queue(size)
 
+    def worker():
+        for item in iterable:
+            q.put(item)
+        q.put(None)
 
-def get_smoothened_boxes(boxes, T):
-    for i in range(len(boxes)):
-        if i + T > len(boxes):
-            window = boxes[len(boxes) - T :]
-        else:
-            window = boxes[i : i + T]
-        boxes[i] = np.mean(window, axis=0)
-    return boxes
+    Thread(target=worker, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        yield item
 
 
-def face_detect(images):
-    detector = face_detection.FaceAlignment(
-        face_detection.LandmarksType._2D, flip_input=False, device=device
-    )
+class BoxSmoother:
+    """与原get_smoothened_boxes结果一致的流式版本：第i帧取[i, i+T)的平均，
+    最后不足T帧的取最后T个(其中前面的已经是平滑后的值)，结果截断为整数"""
 
-    batch_size = args.face_det_batch_size
+    def __init__(self, T, tail=()):
+        self.T = T
+        self.pending = deque()
+        self.tail = deque(tail, maxlen=T)  # 最近输出的平滑结果
+
+    def push(self, box):
+        self.pending.append(np.asarray(box))
+        if len(self.pending) < self.T:
+            return None
+        box = np.mean(self.pending, axis=0).astype(int)
+        self.pending.popleft()
+        self.tail.append(box)
+        return box
+
+    def flush(self):
+        state = list(self.tail) + list(self.pending)
+        start = len(self.tail)
+        for i in range(start, len(state)):
+            state[i] = np.mean(state[len(state) - self.T:], axis=0).astype(int)
+        self.pending.clear()
+        return state[start:]
 
-    while 1:
-        predictions = []
+
+def detect_batch(detector, frames, batch_size):
+    """返回(检测结果, 之后使用的batch_size)。显存不够时减半重试"""
+    while True:
         try:
-            for i in tqdm(range(0, len(images), batch_size)):
-                predictions.extend(
-                    detector.get_detections_for_batch(
-                        np.array(images[i : i + batch_size])
-                    )
-                )
+            predictions = []
+            for i in range(0, len(frames), batch_size):
+                predictions.extend(detector.get_detections_for_batch(np.array(frames[i : i + batch_size])))
+            return predictions, batch_size
         except RuntimeError:
             if batch_size == 1:
                 raise RuntimeError(
@@ -114,63 +114,186 @@ def face_detect(images):
                 )
             batch_size //= 2
             print("Recovering from OOM error; New batch size: {}".format(batch_size))
-            continue
-        break
-
-    results = []
-    pady1, pady2, padx1, padx2 = args.pads
-    for rect, image in zip(predictions, images):
-        if rect is None:
-            cv2.imwrite(
-                "temp/faulty_frame.jpg", image
-            )  # check this frame where the face was not detected.
-            raise ValueError(
-                "Face not detected! Ensure the video contains a face in all the frames."
-            )
-
-        y1 = max(0, rect[1] - pady1)
-        y2 = min(image.shape[0], rect[3] + pady2)
-        x1 = max(0, rect[0] - padx1)
-        x2 = min(image.shape[1], rect[2] + padx2)
-
-        results.append([x1, y1, x2, y2])
-
-    boxes = np.array(results)
-    if not args.nosmooth:
-        boxes = get_smoothened_boxes(boxes, T=5)
-    results = [
-        [image[y1:y2, x1:x2], (y1, y2, x1, x2)]
-        for image, (x1, y1, x2, y2) in zip(images, boxes)
-    ]
 
-    del detector
-    return results
 
+def pad_box(rect, image, pads):
+    pady1, pady2, padx1, padx2 = pads
+    y1 = max(0, rect[1] - pady1)
+    y2 = min(image.shape[0], rect[3] + pady2)
+    x1 = max(0, rect[0] - padx1)
+    x2 = min(image.shape[1], rect[2] + padx2)
+    return [x1, y1, x2, y2]
 
-if __name__ == "__main__":
+
+def crop_and_encode(frame, box, img_size, full_ext):
+    # 进程池里执行：裁剪缩放人脸，编码原图
+    x1, y1, x2, y2 = box
+    face = cv2.resize(frame[y1:y2, x1:x2], (img_size, img_size))
+    ok, full = cv2.imencode(full_ext, frame)
+    if not ok:
+        raise RuntimeError("encode frame failed")
+    return face, full.tobytes()
+
+
+def checkpoint_key(args):
+    st = os.stat(args.video_path)
+    return {
+        "video_path": os.path.abspath(args.video_path),
+        "video_size": st.st_size,
+        "video_mtime": st.st_mtime,
+        "img_size": args.img_size,
+        "pads": args.pads,
+        "nosmooth": args.nosmooth,
+        "full_ext": args.full_ext,
+    }
+
+
+def save_checkpoint(path, key, writer, coord_list, tail):
+    writer.flush()
+    state = dict(key, frames=writer.frames, coords=coord_list,
+                 tail=[[int(v) for v in box] for box in tail])
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path, key):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    if any(state.get(k) != v for k, v in key.items()):
+        print("progress.json was written for another video or other options, start over")
+        return None
+    return state
+
+
+def build(args):
     avatar_path = f"./results/avatars/{args.avatar_id}"
-    full_imgs_path = f"{avatar_path}/full_imgs"
-    face_imgs_path = f"{avatar_path}/face_imgs"
     coords_path = f"{avatar_path}/coords.pkl"
-    osmakedirs([avatar_path, full_imgs_path, face_imgs_path])
-    print(args)
+    progress_path = f"{avatar_path}/progress.json"
+    osmakedirs([avatar_path])
+    if os.path.exists(os.path.join(avatar_path, META_FILE)):
+        os.remove(os.path.join(avatar_path, META_FILE))
+
+    key = checkpoint_key(args)
+    state = load_checkpoint(progress_path, key)
+    writer = PackWriter(avatar_path, args.img_size, args.full_ext)
+    if state is None:
+        writer.reset()
+        coord_list = []
+        tail = []
+    else:
+        writer.truncate(state["frames"])
+        coord_list = [tuple(c) for c in state["coords"]]
+        tail = state["tail"]
+        print(f"resume from frame {writer.frames}")
+    start = writer.frames
+    smoother = BoxSmoother(SMOOTH_T, tail) if not args.nosmooth else None
 
-    # if os.path.isfile(args.video_path):
-    video2imgs(args.video_path, full_imgs_path, ext="png")
-    input_img_list = sorted(glob(os.path.join(full_imgs_path, "*.[jpJP][pnPN]*[gG]")))
-
-    frames = read_imgs(input_img_list)
-    face_det_results = face_detect(frames)
-    coord_list = []
-    idx = 0
-    for frame, coords in face_det_results:
-        # x1, y1, x2, y2 = bbox
-        resized_crop_frame = cv2.resize(
-            frame, (args.img_size, args.img_size)
-        )  # ,interpolation = cv2.INTER_LANCZOS4)
-        cv2.imwrite(f"{face_imgs_path}/{idx:08d}.png", resized_crop_frame)
-        coord_list.append(coords)
-        idx = idx + 1
+    total = int(cv2.VideoCapture(args.video_path).get(cv2.CAP_PROP_FRAME_COUNT)) or None
+    progress = tqdm(total=total, initial=start)
+    detector = face_detection.FaceAlignment(
+        face_detection.LandmarksType._2D, flip_input=False, device=device
+    )
+    batch_size = args.face_det_batch_size
+    frames = prefetch(read_frames(args.video_path, start), 2 * batch_size)
+    waiting = deque()  # 检测过、等平滑结果的原图
+    inflight = deque()  # 进程池里的(future, coords)
+    last_checkpoint = start
+
+    def collect(block):
+        nonlocal last_checkpoint
+        while inflight and (block or inflight[0][0].done() or len(inflight) > 4 * args.workers):
+            future, coords = inflight.popleft()
+            face, full = future.result()
+            writer.append(face, full)
+            coord_list.append(coords)
+            progress.update(1)
+        if writer.frames - last_checkpoint >= args.checkpoint_every and not inflight:
+            save_checkpoint(progress_path, key, writer, coord_list, smoother.tail if smoother else [])
+            last_checkpoint = writer.frames
+
+    def submit(pool, box):
+        frame = waiting.popleft()
+        x1, y1, x2, y2 = (int(v) for v in box)
+        inflight.append((pool.submit(crop_and_encode, frame, (x1, y1, x2, y2), args.img_size, args.full_ext),
+                         (y1, y2, x1, x2)))
+
+    def detect(pool, batch):
+        nonlocal batch_size
+        predictions, batch_size = detect_batch(detector, batch, batch_size)
+        for rect, image in zip(predictions, batch):
+            if rect is None:
+                cv2.imwrite("temp/faulty_frame.jpg", image)  # check this frame where the face was not detected.
+                raise ValueError("Face not detected! Ensure the video contains a face in all the frames.")
+            waiting.append(image)
+            box = pad_box(rect, image, args.pads)
+            if smoother is not None:
+                box = smoother.push(box)
+            if box is not None:
+                submit(pool, box)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) < batch_size:
+                continue
+            detect(pool, batch)
+            batch = []
+            # 检查点要求前面的帧都已写完，攒够帧数后等一次进程池
+            collect(block=writer.frames + len(inflight) - last_checkpoint >= args.checkpoint_every)
+        if batch:
+            detect(pool, batch)
+        if smoother is not None:
+            for box in smoother.flush():
+                submit(pool, box)
+        collect(block=True)
+    progress.close()
+    del detector
 
     with open(coords_path, "wb") as f:
         pickle.dump(coord_list, f)
+    writer.finish()
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    print(f"{writer.frames} frames written to {avatar_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inference code to lip-sync videos in the wild using Wav2Lip models"
+    )
+    parser.add_argument("--img_size", default=96, type=int)
+    parser.add_argument("--avatar_id", default="wav2lip_avatar1", type=str)
+    parser.add_argument("--video_path", default="", type=str)
+    parser.add_argument(
+        "--nosmooth",
+        default=False,
+        action="store_true",
+        help="Prevent smoothing face detections over a short temporal window",
+    )
+    parser.add_argument(
+        "--pads",
+        nargs="+",
+        type=int,
+        default=[0, 10, 0, 0],
+        help="Padding (top, bottom, left, right). Please adjust to include chin at least",
+    )
+    parser.add_argument(
+        "--face_det_batch_size", type=int, help="Batch size for face detection", default=16
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="processes for crop/resize/encode"
+    )
+    parser.add_argument(
+        "--full_ext", type=str, default=".png", choices=[".png", ".jpg"], help="encoding of the full frames"
+    )
+    parser.add_argument(
+        "--checkpoint_every", type=int, default=500, help="frames between progress.json checkpoints"
+    )
+    args = parser.parse_args()
+    print("Using {} for inference.".format(device))
+    print(args)
+    build(args)
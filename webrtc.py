@@ -20,6 +20,7 @@ import json
 import logging
 import threading
 import time
+from collections import deque
 from typing import Tuple, Dict, Optional, Set, Union
 from av.frame import Frame
 from av.packet import Packet
@@ -43,6 +44,65 @@ from aiortc import (
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 from logger import logger as mylogger
+import metrics
+
+
+class FrameRing:
+    """推理线程 -> aiortc的帧队列。put()在推理线程里直接入队(deque的append/popleft是原子操作，不加锁)，
+    不再每帧往事件循环提交一个协程；只有recv()已经在等待时才call_soon_threadsafe唤醒一次，
+    积压的帧由get()直接取走。"""
+
+    def __init__(self):
+        self._items = deque()
+        self._waiter = None  # recv()等待中的future
+
+    def put(self, item):
+        self._items.append(item)
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    def put_many(self, items):
+        """一次放入多帧(如一个视频帧对应的两帧音频)，最多唤醒一次"""
+        self._items.extend(items)
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    async def get(self):
+        while not self._items:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiter = waiter
+            if self._items:  # 注册waiter之前刚好有put
+                self._waiter = None
+                break
+            await waiter
+        return self._items.popleft()
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def request_keyframe(sender):
+    # _send_keyframe是aiortc的私有方法(requirements.txt里固定了版本)，
+    # 升级后没有这个方法时只记一次日志，画面要等浏览器发PLI后才恢复
+    send_keyframe = getattr(sender, '_send_keyframe', None)
+    if send_keyframe is None:
+        if not getattr(request_keyframe, 'warned', False):
+            request_keyframe.warned = True
+            mylogger.warning('aiortc RTCRtpSender has no _send_keyframe, cannot force a keyframe after idle packets')
+        return
+    send_keyframe()
 
 
 class PlayerStreamTrack(MediaStreamTrack):
@@ -54,9 +114,12 @@ class PlayerStreamTrack(MediaStreamTrack):
         super().__init__()  # don't forget this!
         self.kind = kind
         self._player = player
-        self._queue = asyncio.Queue()
+        self._queue = FrameRing()
         self.timelist = [] #记录最近包的时间戳
+        self._frames_sent = metrics.WEBRTC_FRAMES_SENT.labels(kind)
         if self.kind == 'video':
+            self.sender = None #RTCRtpSender，从预编码包切回原始帧时用来请求关键帧
+            self._last_packet = False
             self.framecount = 0
             self.lasttime = time.perf_counter()
             self.totaltime = 0
@@ -132,7 +195,13 @@ class PlayerStreamTrack(MediaStreamTrack):
         if frame is None:
             self.stop()
             raise Exception
+        self._frames_sent.inc()
         if self.kind == 'video':
+            is_packet = isinstance(frame, Packet)
+            if self._last_packet and not is_packet and self.sender is not None:
+                # 编码器的参考帧已经不是解码端的画面，下一帧要编成关键帧
+                request_keyframe(self.sender)
+            self._last_packet = is_packet
             self.totaltime += (time.perf_counter() - self.lasttime)
             self.framecount += 1
             self.lasttime = time.perf_counter()
@@ -0,0 +1,96 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 模型权重加载。.pth/.bin旁边有同名.safetensors时直接内存映射加载：不执行pickle，
+# cpu上零拷贝，同一台机器上多个进程共享权重页。转换工具：
+# python weights.py                          转换wav2lip、musetalk unet/vae和所有ultralight avatar
+# python weights.py models/xxx.pth ...       转换指定文件
+
+import argparse
+import glob
+import os
+
+import torch
+
+from logger import logger
+
+DEFAULT_CHECKPOINTS = [
+    './models/wav2lip.pth',
+    './models/musetalk/pytorch_model.bin',
+    './models/sd-vae-ft-mse/diffusion_pytorch_model.bin',  # diffusers会自动优先读取同目录的.safetensors
+]
+
+
+def safetensors_path(path):
+    base = os.path.splitext(path)[0]
+    if os.path.basename(base) == 'pytorch_model':
+        return os.path.join(os.path.dirname(base), 'model.safetensors')
+    return base + '.safetensors'
+
+
+def clean_state_dict(checkpoint):
+    """取出state_dict并去掉DataParallel的module.前缀"""
+    if 'state_dict' in checkpoint:
+        checkpoint = checkpoint['state_dict']
+    return {k.replace('module.', ''): v for k, v in checkpoint.items()}
+
+
+def load_state_dict(path, device='cpu'):
+    sfpath = safetensors_path(path)
+    if os.path.exists(sfpath):
+        from safetensors.torch import load_file
+        return load_file(sfpath, device=str(device))
+    return clean_state_dict(torch.load(path, map_location=device))
+
+
+def load_weights(model, path, device='cpu'):
+    """把权重加载到model。safetensors在cpu上时直接把映射的tensor作为参数，不再拷贝一次"""
+    state_dict = load_state_dict(path, device)
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:  # torch<2.1没有assign
+        model.load_state_dict(state_dict)
+    return model
+
+
+def convert(path):
+    from safetensors.torch import save_file
+    state_dict = clean_state_dict(torch.load(path, map_location='cpu'))
+    state_dict = {k: v.contiguous() for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    # 共享存储的tensor(如tied weights)save_file会报错，拷贝一份
+    seen = set()
+    for k, v in state_dict.items():
+        ptr = v.untyped_storage().data_ptr()
+        if ptr in seen:
+            state_dict[k] = v.clone()
+        seen.add(ptr)
+    dst = safetensors_path(path)
+    save_file(state_dict, dst)
+    logger.info(f'{path} -> {dst}, {len(state_dict)} tensors')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='*', help="checkpoints to convert, default all known models")
+    opt = parser.parse_args()
+
+    paths = opt.paths or DEFAULT_CHECKPOINTS + sorted(glob.glob('./data/avatars/*/ultralight.pth'))
+    for path in paths:
+        if os.path.exists(path):
+            convert(path)
+        else:
+            logger.info(f'{path} not found, skip')